@@ -0,0 +1,188 @@
+"""
+Chế độ phục vụ ASGI: trang chủ (/), POST /analyze, luồng mà trình duyệt dùng (POST
+/analyze/submit rồi theo dõi /jobs/<id>/events qua SSE) và các route /jobs/* chạy async trên
+Quart. Lời gọi Gemini đi qua API async (generate_content_async của SDK hoặc httpx.AsyncClient
+của gemini_rest.py), kiểm tra key/quota và các thao tác SQLite chạy bằng asyncio.to_thread.
+Một request hay một job đang chờ Gemini chỉ giữ một coroutine thay vì một OS thread, nên một
+process giữ được hàng trăm lời gọi đồng thời (giới hạn bởi ASYNC_UPSTREAM_MAX_CONCURRENCY).
+Job tạo từ đây chạy trên event loop (JobManager.submit_async) và không stream token: các
+phần kết quả được gửi qua SSE khi lời gọi Gemini xong.
+
+Các route còn lại (permalink, lịch sử, batch, metrics...) vẫn do app Flask trong main.py
+xử lý, được bọc qua asgiref (WsgiToAsgi) nếu đã cài. WsgiToAsgi chạy mọi request trên cùng
+một thread nên không route nào giữ kết nối lâu được để lại cho Flask. Không có asgiref thì
+các route đó cần chạy song song server WSGI phía sau cùng proxy.
+
+Cách chạy (từ thư mục gốc của repo, cần `pip install quart uvicorn asgiref`):
+  uvicorn asgi:app --host 0.0.0.0 --port 5000
+Chạy nhiều process được (--workers N): job và cache nằm trong SQLite dùng chung của
+DATA_DIR, chỉ metrics là riêng của từng process giống chế độ WSGI.
+
+Stream SSE của job chỉ bật trong chế độ này (main.JOB_EVENTS_STREAM): dưới worker WSGI đồng
+bộ mỗi stream giữ một thread nên trang chờ polling /jobs/<id> thay vì dùng SSE.
+"""
+
+import uuid
+import asyncio
+import functools
+
+from quart import Quart, Response, render_template, request, redirect, jsonify, abort
+from werkzeug.exceptions import HTTPException
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # asgiref là tùy chọn, xem docstring
+    WsgiToAsgi = None
+
+import main
+
+# Mỗi stream SSE ở đây chỉ là một coroutine, không giữ thread
+main.JOB_EVENTS_STREAM = True
+
+quart_app = Quart(__name__)
+# Mặc định Quart cắt response sau 60 giây, ngắn hơn deadline của một lời gọi Gemini
+quart_app.config['RESPONSE_TIMEOUT'] = main.GEMINI_REQUEST_DEADLINE + 60
+quart_app.config['MAX_CONTENT_LENGTH'] = main.app.config.get('MAX_CONTENT_LENGTH')
+
+# Các đường dẫn do Quart phục vụ (cùng mọi đường dẫn bắt đầu bằng ASYNC_PREFIXES);
+# còn lại chuyển cho app Flask
+ASYNC_PATHS = {'/', '/analyze', '/analyze/submit'}
+ASYNC_PREFIXES = ('/static/', '/jobs/')
+
+def flask_url(endpoint, **values):
+    """URL của một route thuộc app Flask (không có trong url_map của Quart)."""
+    return main.app.url_map.bind('').build(endpoint, values)
+
+@quart_app.route('/', methods=['GET'])
+async def index():
+    # index_status đọc trạng thái API từ SQLite dùng chung (SharedState), không chạy trên event loop
+    api_status, api_status_class = await asyncio.to_thread(main.index_status)
+    return await render_template('index.html', api_status=api_status, api_status_class=api_status_class)
+
+@quart_app.route('/analyze', methods=['POST'])
+async def analyze():
+    form = await request.form
+    user_key = form.get('api_key', '').strip()
+    valid, err = await asyncio.to_thread(main.validate_and_consume_key, user_key)
+    if not valid:
+        return await render_template('index.html', error_message=err)
+
+    if not main.model_name_global:
+        return await render_template('result.html', error_message="Lỗi: Gemini API chưa được cấu hình đúng.",
+                                     text_to_html=main.text_to_html)
+
+    problem, code, lang = main.read_analysis_form(form)
+
+    if not problem or not code:
+        return await render_template('index.html', error_message="Vui lòng nhập đề bài và mã nguồn.",
+                                     api_status=f"Model: {main.model_name_global}")
+
+    cache_key = main.make_cache_key(problem, code, lang, main.analysis_model_id(), main.GENERATION_CONFIG)
+    owner = main.owner_id(user_key)
+    syntax_task = None
+    if main.SYNTAX_FAST_PATH and await asyncio.to_thread(main.response_cache.get, cache_key, record_stats=False) is None:
+        # Như chế độ WSGI: kiểm tra một lần trên syntax_executor, run_analysis_async dùng lại kết quả
+        syntax_task = asyncio.wrap_future(main.syntax_executor.submit(main.syntax_checker.check, code, lang))
+        if main.has_syntax_errors(await syntax_task):
+            # Trang job hiện lỗi biên dịch ngay, phân tích của model đến sau
+            result_id = uuid.uuid4().hex
+            job_id = main.job_manager.submit_async(
+                functools.partial(main.run_analysis_and_store_async, syntax_task=syntax_task),
+                problem, code, lang, owner, result_id, cache_key,
+                language=lang, cache_key=cache_key, owner=owner, result_id=result_id,
+            )
+            if job_id is not None:
+                return redirect(flask_url('job_result', job_id=job_id), code=303)
+
+    result, error = await main.run_analysis_async(problem, code, lang, syntax_task=syntax_task)
+    if error:
+        return await render_template('result.html', error_message=f"Lỗi phân tích: {error}",
+                                     text_to_html=main.text_to_html)
+
+    result_id = await asyncio.to_thread(main.result_store.save, owner, problem, code, lang, result, cache_key)
+    return redirect(flask_url('result_view', result_id=result_id), code=303)
+
+@quart_app.route('/analyze/submit', methods=['POST'])
+async def analyze_submit():
+    form = await request.form
+    user_key = form.get('api_key', '').strip()
+    problem, code, lang = main.read_analysis_form(form)
+    if not problem or not code:
+        return jsonify(error="Vui lòng nhập đề bài và mã nguồn."), 400
+    if not main.model_name_global:
+        return jsonify(error="Lỗi: Gemini API chưa được cấu hình đúng."), 503
+
+    valid, err = await asyncio.to_thread(main.validate_and_consume_key, user_key)
+    if not valid:
+        return jsonify(error=err), 403
+
+    cache_key = main.make_cache_key(problem, code, lang, main.analysis_model_id(), main.GENERATION_CONFIG)
+    owner, result_id = main.owner_id(user_key), uuid.uuid4().hex
+    job_id = main.job_manager.submit_async(main.run_analysis_and_store_async, problem, code, lang, owner, result_id,
+                                           cache_key, language=lang, cache_key=cache_key, owner=owner,
+                                           result_id=result_id)
+    if job_id is None:
+        await asyncio.to_thread(main.quota_ledger.refund, user_key)
+        resp = jsonify(error="Hệ thống đang quá tải, vui lòng thử lại sau.")
+        resp.headers['Retry-After'] = '10'
+        return resp, 503
+
+    job = await asyncio.to_thread(main.job_manager.get, job_id)
+    return jsonify(main.job_status(job, url=flask_url)), 202
+
+@quart_app.route('/jobs/<job_id>', methods=['GET'])
+async def job_status_view(job_id):
+    job = await asyncio.to_thread(main.job_manager.get, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(main.job_status(job, url=flask_url))
+
+@quart_app.route('/jobs/<job_id>/result', methods=['GET'])
+async def job_result(job_id):
+    # Trang kết quả dùng cache trang đã render và send_html của main.py (cần request của
+    # Flask), nên chạy view Flask trong thread với request context dựng từ request này
+    path, method, headers = request.full_path, request.method, list(request.headers.items())
+
+    def run():
+        with main.app.test_request_context(path, method=method, headers=headers):
+            try:
+                return main.app.make_response(main.job_result(job_id))
+            except HTTPException as e:
+                return e.get_response()
+
+    resp = await asyncio.to_thread(run)
+    return Response(resp.get_data(), status=resp.status_code, headers=list(resp.headers.items()))
+
+@quart_app.route('/jobs/<job_id>/events', methods=['GET'])
+async def job_events(job_id):
+    if await asyncio.to_thread(main.job_manager.get, job_id) is None:
+        abort(404)
+
+    async def generate():
+        stream = main.JobEventStream(url=flask_url)
+        while not stream.finished:
+            job = await main.job_manager.wait_async(job_id, stream.version, timeout=15)
+            if job is None:
+                return
+            for event in stream.events(job):
+                yield event
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Luồng SSE sống tới khi job xong, không bị cắt theo RESPONSE_TIMEOUT
+    response.timeout = None
+    return response
+
+@quart_app.after_serving
+async def close_rest_client():
+    if main.rest_client_global is not None:
+        await main.rest_client_global.aclose()
+
+flask_asgi = WsgiToAsgi(main.app) if WsgiToAsgi is not None else None
+
+async def app(scope, receive, send):
+    path = scope.get('path', '')
+    if flask_asgi is None or scope['type'] == 'lifespan' or path in ASYNC_PATHS or path.startswith(ASYNC_PREFIXES):
+        await quart_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -0,0 +1,363 @@
+"""
+Backend REST cho Gemini API, thay cho google-generativeai SDK khi cần giảm chi phí mỗi lời gọi.
+
+- Một connection pool dùng chung, giữ kết nối keep-alive giữa các lời gọi (không tốn lại
+  TCP + TLS handshake); dùng HTTP/2 qua httpx nếu đã cài `httpx[http2]`, không thì
+  requests.Session với HTTPAdapter.
+- Mở sẵn kết nối lúc khởi động (warm) để request đầu tiên không chịu handshake.
+- JSON đọc/ghi thẳng trên bytes bằng orjson nếu có, không thì dùng json chuẩn.
+- Lỗi HTTP được đổi thành google.api_core.exceptions giống SDK, nên code thử lại dựa trên
+  e.code / Retry-After dùng chung cho cả hai backend.
+- generate_content_async dùng httpx.AsyncClient (pool riêng, tạo khi gọi lần đầu trong
+  event loop) cho chế độ ASGI; không có httpx thì chạy bản đồng bộ trong thread.
+
+RestModel có cùng giao diện với genai.GenerativeModel ở những chỗ main.py và
+others/local_assistant.py dùng: generate_content (kể cả stream=True), generate_content_async, count_tokens, start_chat.
+RestCachedContent tương ứng genai.caching.CachedContent (context caching: tạo, gia hạn TTL,
+xóa) và GeminiRestClient.model_from_cached_content tương ứng GenerativeModel.from_cached_content.
+"""
+
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+
+from google.api_core import exceptions as api_exceptions
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn
+    orjson = None
+
+try:
+    import httpx
+except ImportError:  # httpx là tùy chọn, không có thì dùng requests
+    httpx = None
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_ENDPOINT = "https://generativelanguage.googleapis.com"
+API_VERSION = "v1beta"
+
+# Lỗi hết thời gian của các thư viện HTTP, được báo lại thành DeadlineExceeded (504)
+TIMEOUT_ERRORS = (requests.Timeout,) + ((httpx.TimeoutException,) if httpx is not None else ())
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class UsageMetadata:
+    def __init__(self, usage):
+        self.prompt_token_count = usage.get("promptTokenCount", 0)
+        self.candidates_token_count = usage.get("candidatesTokenCount", 0)
+        self.total_token_count = usage.get("totalTokenCount", 0)
+        self.cached_content_token_count = usage.get("cachedContentTokenCount", 0)
+
+class RestResponse:
+    """Phản hồi generateContent, có .text và .usage_metadata như response của SDK."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.usage_metadata = UsageMetadata(payload.get("usageMetadata") or {})
+        candidates = payload.get("candidates") or []
+        self.finish_reason = candidates[0].get("finishReason") if candidates else None
+        parts = (candidates[0].get("content") or {}).get("parts") if candidates else None
+        self._text = "".join(part.get("text", "") for part in parts) if parts else None
+
+    @property
+    def text(self):
+        if self._text is None:
+            # SDK cũng báo ValueError khi phản hồi không có phần text
+            raise ValueError(f"Phản hồi không có nội dung text (finishReason={self.finish_reason})")
+        return self._text
+
+class TokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+def to_contents(prompt):
+    """Đổi prompt (chuỗi hoặc danh sách message kiểu SDK) thành trường contents của API."""
+    if isinstance(prompt, str):
+        return [{"role": "user", "parts": [{"text": prompt}]}]
+    contents = []
+    for message in prompt:
+        parts = message["parts"] if isinstance(message["parts"], list) else [message["parts"]]
+        contents.append({
+            "role": message.get("role", "user"),
+            "parts": [{"text": part} if isinstance(part, str) else part for part in parts],
+        })
+    return contents
+
+def to_ttl(ttl):
+    """TTL (số giây hoặc timedelta) sang dạng chuỗi "<giây>s" của API."""
+    seconds = ttl.total_seconds() if hasattr(ttl, "total_seconds") else ttl
+    return f"{int(seconds)}s"
+
+def to_generation_config(config):
+    """generation_config kiểu SDK (snake_case) sang tên trường của REST API (camelCase)."""
+    if not config:
+        return None
+    names = {"max_output_tokens": "maxOutputTokens", "top_p": "topP", "top_k": "topK",
+             "candidate_count": "candidateCount", "stop_sequences": "stopSequences",
+             "response_mime_type": "responseMimeType"}
+    return {names.get(key, key): value for key, value in config.items()}
+
+class GeminiRestClient:
+    """Client REST dùng chung một connection pool cho mọi model và mọi thread."""
+
+    def __init__(self, api_key, endpoint=None, pool_size=16, timeout=600, http2=True, async_pool_size=256):
+        self.api_key = api_key
+        self.base_url = f"{(endpoint or DEFAULT_ENDPOINT).rstrip('/')}/{API_VERSION}"
+        self.pool_size = pool_size
+        self.async_pool_size = async_pool_size
+        self.timeout = timeout
+        self.headers = {"x-goog-api-key": api_key, "Content-Type": "application/json"}
+        # HTTP/2 cần httpx và gói h2; một kết nối HTTP/2 chở được nhiều request song song
+        self.http2 = bool(http2 and httpx is not None and find_spec("h2") is not None)
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                headers=self.headers,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        else:
+            self._client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+            self._client.headers.update(self.headers)
+        self._async_client = None
+
+    @property
+    def transport(self):
+        return "httpx/http2" if self.http2 else "requests/http1.1"
+
+    def model(self, model_name, generation_config=None):
+        return RestModel(self, model_name, generation_config)
+
+    @staticmethod
+    def _resource(model_name):
+        return model_name if model_name.startswith(("models/", "tunedModels/")) else f"models/{model_name}"
+
+    def _url(self, model_name, method=None):
+        name = self._resource(model_name)
+        return f"{self.base_url}/{name}:{method}" if method else f"{self.base_url}/{name}"
+
+    @staticmethod
+    def _raise_for_status(resp, content):
+        if resp.status_code < 400:
+            return
+        try:
+            error = loads(content).get("error", {})
+            message = error.get("message") or str(error)
+        except ValueError:
+            message = content[:500].decode("utf-8", "replace") if isinstance(content, bytes) else str(content)
+        raise api_exceptions.from_http_status(resp.status_code, message, response=resp)
+
+    def _request(self, method, url, body=None, timeout=None):
+        data = dumps(body) if body is not None else None
+        try:
+            if self.http2:
+                resp = self._client.request(method, url, content=data, timeout=timeout or self.timeout)
+            else:
+                resp = self._client.request(method, url, data=data, timeout=timeout or self.timeout)
+        except TIMEOUT_ERRORS as e:
+            raise api_exceptions.DeadlineExceeded(str(e)) from e
+        content = resp.content
+        self._raise_for_status(resp, content)
+        return loads(content)
+
+    def _stream_lines(self, url, body, timeout=None):
+        data = dumps(body)
+        try:
+            if self.http2:
+                with self._client.stream("POST", url, params={"alt": "sse"}, content=data,
+                                         timeout=timeout or self.timeout) as resp:
+                    if resp.status_code >= 400:
+                        self._raise_for_status(resp, resp.read())
+                    yield from resp.iter_lines()
+            else:
+                resp = self._client.post(url, params={"alt": "sse"}, data=data, stream=True,
+                                         timeout=timeout or self.timeout)
+                with resp:
+                    if resp.status_code >= 400:
+                        self._raise_for_status(resp, resp.content)
+                    for line in resp.iter_lines():
+                        yield line.decode("utf-8") if isinstance(line, bytes) else line
+        except TIMEOUT_ERRORS as e:
+            raise api_exceptions.DeadlineExceeded(str(e)) from e
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                http2=self.http2,
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.async_pool_size,
+                                    max_keepalive_connections=self.async_pool_size),
+            )
+        return self._async_client
+
+    async def _request_async(self, method, url, body=None, timeout=None):
+        if httpx is None:
+            return await asyncio.to_thread(self._request, method, url, body, timeout)
+        data = dumps(body) if body is not None else None
+        try:
+            resp = await self._get_async_client().request(method, url, content=data, timeout=timeout or self.timeout)
+        except httpx.TimeoutException as e:
+            raise api_exceptions.DeadlineExceeded(str(e)) from e
+        content = resp.content
+        self._raise_for_status(resp, content)
+        return loads(content)
+
+    def generate_content(self, model_name, body, timeout=None):
+        return RestResponse(self._request("POST", self._url(model_name, "generateContent"), body, timeout))
+
+    async def generate_content_async(self, model_name, body, timeout=None):
+        payload = await self._request_async("POST", self._url(model_name, "generateContent"), body, timeout)
+        return RestResponse(payload)
+
+    def stream_generate_content(self, model_name, body, timeout=None):
+        for line in self._stream_lines(self._url(model_name, "streamGenerateContent"), body, timeout):
+            if line.startswith("data:"):
+                yield RestResponse(loads(line[5:].strip()))
+
+    def count_tokens(self, model_name, contents, timeout=None):
+        body = {"generateContentRequest": {"model": self._resource(model_name), "contents": contents}}
+        payload = self._request("POST", self._url(model_name, "countTokens"), body, timeout)
+        return TokenCount(payload.get("totalTokens", 0))
+
+    def get_model(self, model_name, timeout=None):
+        return self._request("GET", self._url(model_name), timeout=timeout)
+
+    def create_cached_content(self, model_name, contents=None, ttl=None, system_instruction=None,
+                              display_name=None, timeout=None):
+        """Tạo cached content (context caching) từ prompt/danh sách message kiểu SDK."""
+        body = {"model": self._resource(model_name)}
+        if contents:
+            body["contents"] = to_contents(contents)
+        if system_instruction:
+            body["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        if ttl is not None:
+            body["ttl"] = to_ttl(ttl)
+        if display_name:
+            body["displayName"] = display_name
+        payload = self._request("POST", f"{self.base_url}/cachedContents", body, timeout)
+        return RestCachedContent(self, payload)
+
+    def get_cached_content(self, name, timeout=None):
+        return RestCachedContent(self, self._request("GET", f"{self.base_url}/{name}", timeout=timeout))
+
+    def model_from_cached_content(self, cached_content, generation_config=None):
+        """RestModel trả lời dựa trên cached content (tương đương GenerativeModel.from_cached_content)."""
+        return RestModel(self, cached_content.model, generation_config, cached_content=cached_content.name)
+
+    def warm(self, model_name, connections=None):
+        """
+        Mở sẵn `connections` kết nối (mặc định bằng pool_size) bằng các request metadata nhẹ
+        chạy song song, để lời gọi thật đầu tiên không phải chờ handshake.
+        Với HTTP/2 chỉ cần một kết nối. Trả về số request warm thành công.
+        """
+        count = 1 if self.http2 else (connections or self.pool_size)
+
+        def ping(_):
+            try:
+                self.get_model(model_name, timeout=10)
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            return sum(pool.map(ping, range(count)))
+
+    def close(self):
+        self._client.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+class RestCachedContent:
+    """Cached content đã tạo trên server; có name, model, expire_time, usage_metadata như SDK."""
+
+    def __init__(self, client, payload):
+        self.client = client
+        self._apply(payload)
+
+    def _apply(self, payload):
+        self.name = payload.get("name")
+        self.model = payload.get("model")
+        self.display_name = payload.get("displayName")
+        self.expire_time = payload.get("expireTime")
+        self.usage_metadata = UsageMetadata(payload.get("usageMetadata") or {})
+
+    def update(self, *, ttl=None, timeout=None):
+        """Gia hạn TTL (tính từ bây giờ)."""
+        payload = self.client._request("PATCH", f"{self.client.base_url}/{self.name}?updateMask=ttl",
+                                       {"ttl": to_ttl(ttl)}, timeout)
+        self._apply(payload)
+
+    def delete(self, timeout=None):
+        self.client._request("DELETE", f"{self.client.base_url}/{self.name}", timeout=timeout)
+
+class RestModel:
+    """Tương đương genai.GenerativeModel nhưng gọi qua GeminiRestClient."""
+
+    def __init__(self, client, model_name, generation_config=None, cached_content=None):
+        self.client = client
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.cached_content = cached_content  # tên "cachedContents/..." hoặc None
+
+    def _body(self, prompt, generation_config):
+        body = {"contents": to_contents(prompt)}
+        if self.cached_content:
+            body["cachedContent"] = self.cached_content
+        config = to_generation_config(generation_config or self.generation_config)
+        if config:
+            body["generationConfig"] = config
+        return body
+
+    def generate_content(self, prompt, generation_config=None, stream=False, request_options=None):
+        timeout = (request_options or {}).get("timeout")
+        body = self._body(prompt, generation_config)
+        if stream:
+            return self.client.stream_generate_content(self.model_name, body, timeout)
+        return self.client.generate_content(self.model_name, body, timeout)
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+        timeout = (request_options or {}).get("timeout")
+        return await self.client.generate_content_async(self.model_name, self._body(prompt, generation_config), timeout)
+
+    def count_tokens(self, prompt, request_options=None):
+        return self.client.count_tokens(self.model_name, to_contents(prompt),
+                                        (request_options or {}).get("timeout"))
+
+    def start_chat(self, history=None):
+        return RestChat(self, history)
+
+class RestChat:
+    """Hội thoại nhiều lượt: lịch sử giữ ở client và gửi kèm mỗi lượt như ChatSession của SDK."""
+
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+        self._lock = threading.Lock()
+
+    def send_message(self, content):
+        with self._lock:
+            message = {"role": "user", "parts": [content]}
+            response = self.model.generate_content(self.history + [message])
+            self.history.append(message)
+            self.history.append({"role": "model", "parts": [response.text]})
+            return response
@@ -7,13 +7,45 @@ Dependencies:
 
 import os
 import sys
+import re
 import json
+import time
+import random
+import atexit
+import sqlite3
+import hashlib
+import hmac
+import secrets
 import textwrap
+import tokenize
+import io
+import ast
+import zlib
+import difflib
+import gzip
+import threading
+import uuid
+import asyncio
+import subprocess
+import contextlib
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait as wait_futures, FIRST_COMPLETED
 import google.generativeai as genai
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, jsonify, Response, url_for, abort, redirect, stream_with_context
 from markupsafe import Markup
 from dotenv import load_dotenv
 
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn, không có thì chỉ nén gzip
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard là tùy chọn, không có thì kết quả lưu nén bằng zlib
+    zstandard = None
+
 # Khởi tạo Flask app
 app = Flask(__name__)
 
@@ -23,78 +55,892 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Load biến môi trường từ .env
 load_dotenv(os.path.join(BASE_DIR, '.env'))
 
+# Địa chỉ Gemini API thay thế, ví dụ server giả others/fake_gemini_server.py khi
+# chạy thử/đo tải offline; khi đặt biến này thì không bắt buộc GEMINI_API_KEY
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+
 # Lấy key Gemini từ .env
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or ("local" if GEMINI_API_ENDPOINT else None)
 if not GEMINI_API_KEY:
     print("❌ Chưa thiết lập GEMINI_API_KEY trong .env")
     sys.exit(1)
 
+# Thư mục chứa dữ liệu runtime (cache, quota, ...), có thể đổi qua .env
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(BASE_DIR, 'data'))
+
+# Metrics cho /metrics (định dạng text của Prometheus), tính riêng cho từng process
+class Counter:
+    """Bộ đếm tăng dần, có thể chia theo nhãn."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """Histogram thời gian (giây) với các bucket cố định, có thể chia theo nhãn."""
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{format_labels(names, key + (repr(float(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(names, key + ('+Inf',))} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+STAGE_SECONDS = Histogram(
+    "analyze_stage_seconds",
+    "Thời gian từng bước xử lý: validate_and_consume_key, create_prompt, gemini_call, json_extraction, render.",
+    ("stage",),
+)
+GEMINI_TOKENS = Counter("gemini_tokens_total", "Số token theo usage_metadata của Gemini.", ("kind",))
+ANALYSIS_CACHE = Counter("analysis_cache_requests_total", "Tra cache phân tích (hit/miss).", ("cache", "result"))
+UPSTREAM_ERRORS = Counter("gemini_upstream_errors_total", "Lỗi khi gọi Gemini theo mã HTTP và loại lỗi.",
+                          ("status", "error"))
+GEMINI_RETRIES = Counter("gemini_retries_total", "Số lần thử lại lời gọi Gemini.")
+GEMINI_QUEUE_WAIT = Histogram("gemini_queue_wait_seconds",
+                              "Tổng thời gian một lời gọi Gemini chờ rate limiter phía client.")
+HEDGES = Counter("gemini_hedges_total", "Request hedge: bên thắng (primary/hedge) hoặc bỏ qua vì hết slot.",
+                 ("outcome",))
+ROUTE_SECONDS = Histogram("gemini_route_seconds", "Thời gian gọi model theo tuyến định tuyến và model.",
+                          ("route", "model"))
+ROUTE_REQUESTS = Counter("gemini_route_requests_total", "Số lời gọi model theo tuyến, model và kết quả.",
+                         ("route", "model", "outcome"))
+ROUTE_PROMPT_TOKENS = Histogram("gemini_route_prompt_tokens", "Số token prompt của các bài nộp theo tuyến.",
+                                ("route",), buckets=(500, 1000, 2000, 4000, 8000, 16000, 64000, 256000, 1000000))
+ROUTE_DIFFICULTY = Histogram("gemini_route_difficulty", "Điểm độ khó ước lượng của các bài nộp theo tuyến.",
+                             ("route",), buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 4, 8))
+METRICS = [STAGE_SECONDS, GEMINI_TOKENS, ANALYSIS_CACHE, UPSTREAM_ERRORS, GEMINI_RETRIES, GEMINI_QUEUE_WAIT,
+           HEDGES, ROUTE_SECONDS, ROUTE_REQUESTS, ROUTE_PROMPT_TOKENS, ROUTE_DIFFICULTY]
+
+class SQLiteConnection:
+    """
+    Connection SQLite dùng chung cho các kho trên đĩa: gọi instance để lấy connection của
+    thread hiện tại (WAL, synchronous=NORMAL, autocommit; transaction tự mở bằng BEGIN).
+    Connection không dùng được qua fork (gunicorn --preload) nên process con mở connection riêng.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __call__(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+# Trạng thái dùng chung giữa các worker process (gunicorn prefork) trên cùng máy:
+# health của Gemini API, bộ đếm cache, lease cho việc định kỳ và single-flight
+SHARED_STATE_PATH = os.path.join(DATA_DIR, 'shared_state.sqlite3')
+
+class SharedState:
+    """
+    Kho key-value nhỏ trên SQLite (WAL) dùng chung giữa các process.
+    Mỗi thao tác là một câu lệnh trên khóa chính (cỡ vài chục µs), không chờ vòng lặp.
+    claim() là lease có hạn để chỉ một process làm một việc (kiểm tra API, dọn cache, gọi model
+    cho một bài nộp khi bật SINGLEFLIGHT_CROSS_PROCESS);
+    add() cộng bộ đếm nguyên tử, nơi gọi nên gộp lô trước khi ghi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = SQLiteConnection(path)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def get(self, name):
+        """Trả về (value, updated_at theo time.time()), hoặc (None, None) nếu chưa có."""
+        row = self._conn().execute("SELECT value, updated_at FROM state WHERE name = ?", (name,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else (None, None)
+
+    def set(self, name, value):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO state (name, value, updated_at) VALUES (?, ?, ?)",
+            (name, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+
+    def add(self, counts):
+        """Cộng dồn nhiều bộ đếm trong một transaction."""
+        counts = [(name, amount) for name, amount in counts.items() if amount]
+        if not counts:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                counts,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def counters(self, prefix):
+        rows = self._conn().execute(
+            "SELECT name, value FROM counters WHERE name >= ? AND name < ?", (prefix, prefix + "\uffff")
+        )
+        return {name[len(prefix):]: value for name, value in rows}
+
+    def claim(self, name, owner, ttl):
+        """Giành lease `name` trong ttl giây nếu chưa ai giữ, lease đã hết hạn hoặc đang là của owner."""
+        now = time.time()
+        return self._conn().execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (name, owner, now + ttl, now),
+        ).rowcount == 1
+
+    def release(self, name, owner):
+        self._conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+shared_state = SharedState(SHARED_STATE_PATH)
+
 # Đường dẫn tuyệt đối tới key.json
-KEY_FILE = os.path.join(BASE_DIR, 'key.json')
+KEY_FILE = os.getenv('KEY_FILE', os.path.join(BASE_DIR, 'key.json'))
+
+# Cấu hình quota cho API key của người dùng
+KEY_USAGE_LIMIT = int(os.getenv('KEY_USAGE_LIMIT', '10'))
+QUOTA_DB_PATH = os.path.join(DATA_DIR, 'quota.sqlite3')
+QUOTA_FLUSH_INTERVAL = float(os.getenv('QUOTA_FLUSH_INTERVAL', '5'))
+QUOTA_NEGATIVE_TTL = float(os.getenv('QUOTA_NEGATIVE_TTL', '60'))
 
-def load_keys():
-    if not os.path.exists(KEY_FILE):
-        with open(KEY_FILE, 'w') as f:
-            json.dump({}, f)
-    with open(KEY_FILE) as f:
+def load_keys(path=KEY_FILE):
+    if not os.path.exists(path):
+        save_keys({}, path)
+    with open(path) as f:
         return json.load(f)
 
-def save_keys(keys):
-    with open(KEY_FILE, 'w') as f:
+def save_keys(keys, path=KEY_FILE):
+    # Ghi ra file tạm rồi thay thế nguyên tử, tránh để lại key.json ghi dở
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
         json.dump(keys, f, indent=2)
+    os.replace(tmp_path, path)
+
+class QuotaLedger:
+    """
+    Sổ quota dùng chung giữa các thread và worker process.
+
+    Bộ đếm nằm trong SQLite (WAL, synchronous=NORMAL): mỗi lần dùng key là một câu
+    UPDATE có điều kiện, nguyên tử giữa các process, không đọc/ghi lại cả key.json.
+    key.json vẫn là nơi quản trị viên thêm/xóa key: file chỉ được nhập lại khi bị sửa
+    từ bên ngoài, và được ghi ra theo lô (tối đa mỗi flush_interval giây).
+    Key không hợp lệ hoặc đã hết lượt được nhớ trong cache âm (negative_ttl giây)
+    để các đợt gửi key sai không chạm tới đĩa.
+    """
+
+    # Số key tối đa trong cache âm, tránh bị làm đầy bộ nhớ bởi key rác
+    NEGATIVE_CACHE_MAX = 10000
+    # Khoảng cách tối thiểu giữa hai lần stat() key.json
+    KEY_FILE_CHECK_INTERVAL = 1.0
+
+    def __init__(self, db_path, key_file, limit, flush_interval, negative_ttl):
+        self.db_path = db_path
+        self.key_file = key_file
+        self.limit = limit
+        self.flush_interval = flush_interval
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._negative = {}
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self._last_key_file_check = 0.0
+        self._conn = SQLiteConnection(db_path)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, used INTEGER NOT NULL DEFAULT 0)")
+        # flushed: giá trị của key trong key.json ở lần đồng bộ gần nhất; thêm cột cho DB cũ
+        if "flushed" not in {row[1] for row in conn.execute("PRAGMA table_info(keys)")}:
+            conn.execute("ALTER TABLE keys ADD COLUMN flushed INTEGER")
+            conn.execute("UPDATE keys SET flushed = used")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._sync_key_file(force=True)
+
+    def _sync_key_file(self, force=False):
+        """
+        Nhập lại key.json nếu file đã bị sửa bởi người khác (không phải do flush). File được
+        gộp vào DB chứ không thay thế: key mới được thêm, key bị xóa khỏi file bị thu hồi, còn
+        với key có ở cả hai, phần quản trị viên sửa (giá trị trong file trừ giá trị đã flush)
+        được cộng vào bộ đếm. Nhờ vậy sửa số lượt (kể cả đặt lại về 0) có hiệu lực mà các lượt
+        dùng chưa kịp flush không bị mất.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_key_file_check < self.KEY_FILE_CHECK_INTERVAL:
+            return
+        self._last_key_file_check = now
+        conn = self._conn()
+        if not self._key_file_changed(conn):
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._merge_key_file(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _key_file_changed(self, conn):
+        try:
+            mtime = str(os.stat(self.key_file).st_mtime_ns)
+        except FileNotFoundError:
+            return True
+        row = conn.execute("SELECT value FROM meta WHERE name = 'key_file_mtime'").fetchone()
+        return row is None or row[0] != mtime
+
+    def _merge_key_file(self, conn):
+        """Gộp key.json vào bảng keys nếu file đã đổi; phải gọi trong transaction BEGIN IMMEDIATE."""
+        if not self._key_file_changed(conn):
+            return
+        keys = load_keys(self.key_file)
+        removed = [(key,) for (key,) in conn.execute("SELECT key FROM keys") if key not in keys]
+        conn.executemany("DELETE FROM keys WHERE key = ?", removed)
+        conn.executemany(
+            "INSERT INTO keys (key, used, flushed) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET used = MAX(0, used + excluded.flushed - COALESCE(flushed, used)), "
+            "flushed = excluded.flushed",
+            [(key, used, used) for key, used in keys.items()],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('key_file_mtime', ?)",
+            (str(os.stat(self.key_file).st_mtime_ns),),
+        )
+        with self._lock:
+            self._negative.clear()
+
+    def _remember_negative(self, key, message):
+        with self._lock:
+            if len(self._negative) >= self.NEGATIVE_CACHE_MAX:
+                self._negative.clear()
+            self._negative[key] = (time.monotonic() + self.negative_ttl, message)
+
+    def consume(self, key):
+        """Trừ một lượt dùng của key. Trả về (True, None) hoặc (False, thông báo lỗi)."""
+        if not key:
+            return False, "API Key không hợp lệ."
+
+        with self._lock:
+            cached = self._negative.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                return False, cached[1]
+            with self._lock:
+                self._negative.pop(key, None)
+
+        self._sync_key_file()
+        conn = self._conn()
+        updated = conn.execute(
+            "UPDATE keys SET used = used + 1 WHERE key = ? AND used < ?", (key, self.limit)
+        ).rowcount
+        if updated:
+            with self._lock:
+                self._dirty = True
+            self._maybe_flush()
+            return True, None
+
+        if conn.execute("SELECT 1 FROM keys WHERE key = ?", (key,)).fetchone() is None:
+            message = "API Key không hợp lệ."
+        else:
+            message = f"API Key đã hết hạn dùng ({self.limit} lần)."
+        self._remember_negative(key, message)
+        return False, message
+
+    def knows(self, key):
+        """Key có trong sổ quota hay không (không trừ lượt)."""
+        if not key:
+            return False
+        self._sync_key_file()
+        return self._conn().execute("SELECT 1 FROM keys WHERE key = ?", (key,)).fetchone() is not None
+
+    def refund(self, key):
+        """Hoàn lại một lượt dùng (khi yêu cầu bị từ chối sau khi đã trừ quota)."""
+        conn = self._conn()
+        if conn.execute("UPDATE keys SET used = used - 1 WHERE key = ? AND used > 0", (key,)).rowcount:
+            with self._lock:
+                self._dirty = True
+                self._negative.pop(key, None)
+
+    def _maybe_flush(self):
+        with self._lock:
+            due = self._dirty and time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush_pending(self):
+        if self._dirty:
+            self.flush()
+
+    def flush(self):
+        """
+        Ghi toàn bộ bộ đếm ra key.json (một lần cho cả lô thay đổi). Thay đổi của quản trị
+        viên trong file được gộp vào ngay trong transaction trước khi ghi, nên không bị ghi đè
+        dù chưa tới lượt kiểm tra KEY_FILE_CHECK_INTERVAL.
+        """
+        with self._lock:
+            self._dirty = False
+            self._last_flush = time.monotonic()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._merge_key_file(conn)
+            keys = dict(conn.execute("SELECT key, used FROM keys ORDER BY key"))
+            save_keys(keys, self.key_file)
+            conn.execute("UPDATE keys SET flushed = used")
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('key_file_mtime', ?)",
+                (str(os.stat(self.key_file).st_mtime_ns),),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+quota_ledger = QuotaLedger(QUOTA_DB_PATH, KEY_FILE, KEY_USAGE_LIMIT, QUOTA_FLUSH_INTERVAL, QUOTA_NEGATIVE_TTL)
+# Ghi nốt các lượt dùng chưa flush khi process kết thúc
+atexit.register(lambda: quota_ledger.flush_pending())
 
 def validate_and_consume_key(key):
-    keys = load_keys()
-    if key not in keys:
-        return False, "API Key không hợp lệ."
-    if keys[key] >= 10:
-        return False, "API Key đã hết hạn dùng (10 lần)."
-    keys[key] += 1
-    save_keys(keys)
-    return True, None
-
-# Biến global cho Gemini
+    with STAGE_SECONDS.time(stage="validate_and_consume_key"):
+        return quota_ledger.consume(key)
+
+# Cấu hình sinh nội dung, dùng chung cho lời gọi model và khóa cache
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 20480,
+}
+
+# Cấu hình cache phản hồi
+RESPONSE_CACHE_PATH = os.path.join(DATA_DIR, 'response_cache.sqlite3')
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+
+def make_cache_key(problem_description, source_code, language, model_name, generation_config):
+    """
+    Tạo khóa cache theo nội dung: hash SHA-256 của (đề bài đã chuẩn hóa khoảng trắng,
+    mã nguồn, ngôn ngữ, tên model, cấu hình sinh).
+    """
+    normalized_problem = " ".join(problem_description.split())
+    payload = json.dumps(
+        [normalized_problem, source_code, language, model_name, generation_config],
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Cache phản hồi Gemini lưu trên đĩa (SQLite), khóa theo hash nội dung, dùng chung cho
+    mọi worker. Bản ghi hết TTL bị bỏ qua và xóa; khi tổng dung lượng vượt max_bytes,
+    bản ghi ít được truy cập gần đây nhất (LRU) bị loại trước.
+
+    Chi phí mỗi lần tra được giữ cố định khi nhiều process dùng chung: thời điểm truy cập
+    chỉ được ghi lại khi đã cũ hơn ACCESS_RESOLUTION giây (lần hit thường chỉ đọc, không
+    tranh khóa ghi), việc dọn dẹp (quét tổng dung lượng) chỉ một process làm mỗi
+    EVICT_INTERVAL giây, và bộ đếm hit/miss được gộp rồi cộng vào SharedState mỗi
+    COUNTER_FLUSH_INTERVAL giây.
+    """
+
+    ACCESS_RESOLUTION = 60.0
+    EVICT_INTERVAL = 5.0
+    COUNTER_FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, max_bytes, ttl, state):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.state = state
+        self._pending = {"hits": 0, "misses": 0, "evictions": 0}
+        self._last_counter_flush = time.monotonic()
+        self._last_evict_check = 0.0
+        self._lock = threading.Lock()
+        self._conn = SQLiteConnection(path)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn().execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        # Trang kết quả đã render (nén sẵn) lưu cạnh phản hồi; thêm cột cho DB cũ
+        columns = {row[1] for row in self._conn().execute("PRAGMA table_info(responses)")}
+        for column, kind in (("html_version", "TEXT"), ("html_etag", "TEXT"),
+                             ("html_gzip", "BLOB"), ("html_br", "BLOB")):
+            if column not in columns:
+                self._conn().execute(f"ALTER TABLE responses ADD COLUMN {column} {kind}")
+        # Lease single-flight trước đây nằm ở đây, giờ dùng SharedState.claim
+        self._conn().execute("DROP TABLE IF EXISTS leases")
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._pending[name] += amount
+            due = time.monotonic() - self._last_counter_flush >= self.COUNTER_FLUSH_INTERVAL
+        if due:
+            self.flush_counters()
+
+    def flush_counters(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {"hits": 0, "misses": 0, "evictions": 0}
+            self._last_counter_flush = time.monotonic()
+        self.state.add({f"response_cache.{name}": amount for name, amount in pending.items()})
+
+    def get(self, key, record_stats=True):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value, created_at, accessed_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[1] > self.ttl:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            if record_stats:
+                self._count("misses")
+            return None
+        if now - row[2] > self.ACCESS_RESOLUTION:
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        if record_stats:
+            self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, data, size, now, now),
+        )
+        # Chỉ một process quét dọn mỗi EVICT_INTERVAL giây; giữa hai lần quét cache có thể
+        # vượt max_bytes một chút
+        with self._lock:
+            due = time.monotonic() - self._last_evict_check >= self.EVICT_INTERVAL
+            if due:
+                self._last_evict_check = time.monotonic()
+        if due and self.state.claim("response_cache.evict", str(os.getpid()), self.EVICT_INTERVAL):
+            self._evict(now)
+
+    def get_rendered(self, key, version):
+        """Trang đã render cho key với phiên bản template `version`: (etag, gzip, br) hoặc None."""
+        row = self._conn().execute(
+            "SELECT html_etag, html_gzip, html_br FROM responses WHERE key = ? AND html_version = ?",
+            (key, version),
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put_rendered(self, key, version, etag, html_gzip, html_br=None):
+        # Kích thước bản ghi tính cả trang đã nén để LRU phản ánh đúng dung lượng
+        extra = len(html_gzip) + len(html_br or b"")
+        self._conn().execute(
+            "UPDATE responses SET html_version = ?, html_etag = ?, html_gzip = ?, html_br = ?, "
+            "size = LENGTH(CAST(value AS BLOB)) + ? WHERE key = ?",
+            (version, etag, html_gzip, html_br, extra, key),
+        )
+
+    def _evict(self, now):
+        conn = self._conn()
+        expired = conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        if total > self.max_bytes:
+            victims = []
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                if total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                total -= size
+            conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+            evicted = len(victims)
+        if expired or evicted:
+            self._count("evictions", expired + evicted)
+
+    def stats(self):
+        """Thống kê của cả nhóm worker (bộ đếm của process khác có thể trễ tới một giây)."""
+        self.flush_counters()
+        entries, size = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        counters = self.state.counters("response_cache.")
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, shared_state)
+atexit.register(response_cache.flush_counters)
+
+# Kho kết quả phân tích lâu dài (permalink /result/<id> và lịch sử theo key)
+RESULT_STORE_PATH = os.path.join(DATA_DIR, 'results.sqlite3')
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '20'))
+OWNER_SECRET_PATH = os.path.join(DATA_DIR, 'owner_secret')
+
+def load_owner_secret(path=OWNER_SECRET_PATH):
+    """
+    Khóa bí mật cho owner_id: lấy từ OWNER_ID_SECRET, không có thì sinh một lần và lưu trong
+    DATA_DIR (O_EXCL: các worker khởi động cùng lúc đều đọc lại đúng một khóa).
+    """
+    secret = os.getenv('OWNER_ID_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path, 'rb') as f:
+                secret = f.read()
+            if secret:
+                return secret
+            time.sleep(0.01)  # process khác vừa tạo file, chưa ghi xong
+        raise RuntimeError(f"File khóa {path} rỗng, xóa file hoặc đặt OWNER_ID_SECRET.")
+    secret = secrets.token_hex(32).encode('ascii')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+OWNER_SECRET = load_owner_secret()
+
+def owner_id(api_key):
+    """
+    Định danh chủ kết quả suy ra từ API key (HMAC với khóa của server); không lưu key gốc.
+    Không có khóa thì không dò ngược được key từ đường dẫn /history/<owner>.
+    """
+    return hmac.new(OWNER_SECRET, f"owner:{api_key}".encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+def problem_hash(problem_description):
+    return hashlib.sha256(" ".join(problem_description.split()).encode('utf-8')).hexdigest()
+
+class ResultStore:
+    """
+    Lưu mỗi lần phân tích (đề bài, mã nguồn, kết quả) vào SQLite dưới dạng JSON nén
+    (zstd nếu có, không thì zlib) để xem lại qua permalink mà không phải phân tích lại.
+    Có index theo chủ (owner), hash đề bài và thời gian để liệt kê lịch sử theo trang.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = SQLiteConnection(path)
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                problem_hash TEXT NOT NULL,
+                cache_key TEXT,
+                language TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                data BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS results_owner_time ON results (owner, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_problem_time ON results (problem_hash, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_time ON results (created_at)")
+
+    @staticmethod
+    def _compress(data):
+        if zstandard is not None:
+            return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+        return "zlib", zlib.compress(data, 9)
+
+    @staticmethod
+    def _decompress(codec, blob):
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Kết quả được nén bằng zstd nhưng chưa cài thư viện zstandard.")
+            return zstandard.ZstdDecompressor().decompress(blob)
+        return zlib.decompress(blob)
+
+    def save(self, owner, problem_description, source_code, language, result, cache_key=None, result_id=None):
+        """Lưu một kết quả; trả về ID dùng cho permalink."""
+        result_id = result_id or uuid.uuid4().hex
+        record = {
+            "problem_description": problem_description,
+            "source_code": source_code,
+            "language": language,
+            "result": result,
+        }
+        codec, blob = self._compress(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+        summary = dict(summarize_analysis(result), problem_excerpt=problem_description[:120])
+        self._conn().execute(
+            "INSERT OR REPLACE INTO results (id, owner, problem_hash, cache_key, language, summary, codec, data, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (result_id, owner, problem_hash(problem_description), cache_key, language,
+             json.dumps(summary, ensure_ascii=False), codec, blob, time.time()),
+        )
+        return result_id
+
+    def get(self, result_id):
+        row = self._conn().execute(
+            "SELECT codec, data, cache_key, created_at FROM results WHERE id = ?", (result_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = json.loads(self._decompress(row[0], row[1]))
+        record.update(id=result_id, cache_key=row[2], created_at=row[3])
+        return record
+
+    def history(self, owner, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Các kết quả của owner, mới nhất trước. Phân trang theo thời gian (keyset):
+        truyền created_at của mục cuối trang trước làm `before`. Chỉ đọc cột tóm tắt.
+        Trả về (items, next_before) với next_before là None nếu hết.
+        """
+        rows = self._conn().execute(
+            "SELECT id, language, summary, created_at FROM results "
+            "WHERE owner = ? AND created_at < ? ORDER BY created_at DESC LIMIT ?",
+            (owner, before if before is not None else float('inf'), limit + 1),
+        ).fetchall()
+        items = [
+            dict(json.loads(summary), id=result_id, language=language, created_at=created_at)
+            for result_id, language, summary, created_at in rows[:limit]
+        ]
+        next_before = items[-1]["created_at"] if len(rows) > limit else None
+        return items, next_before
+
+result_store = ResultStore(RESULT_STORE_PATH)
+
+# Biến global cho Gemini: model_name_global là model context lớn (mặc định)
 model_name_global = None
 gemini_model_global = None
+# Mỗi model một GenerativeModel tạo sẵn, khóa theo tên model
+gemini_models = {}
+
+# Backend gọi Gemini: "sdk" (google-generativeai) hoặc "rest" (gemini_rest.py, connection
+# pool keep-alive, HTTP/2 nếu có httpx[http2]); số kết nối tối đa và có mở sẵn kết nối không
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'sdk').lower()
+GEMINI_REST_POOL = int(os.getenv('GEMINI_REST_POOL', '16'))
+GEMINI_REST_PREWARM = os.getenv('GEMINI_REST_PREWARM', '1') == '1'
+rest_client_global = None
+# Số lời gọi Gemini đồng thời tối đa trong một process ở chế độ ASGI (asgi.py)
+ASYNC_UPSTREAM_MAX_CONCURRENCY = int(os.getenv('ASYNC_UPSTREAM_MAX_CONCURRENCY', '256'))
+
+# Model chính (context 1M token) và model nhanh cho bài nộp nhỏ; để trống
+# GEMINI_FAST_MODEL để tắt định tuyến và luôn dùng model chính
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-pro-latest')
+GEMINI_FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-1.5-flash-latest')
+# Ngưỡng định tuyến sang model nhanh: số token của prompt và điểm độ khó ước lượng
+ROUTE_FAST_MAX_TOKENS = int(os.getenv('ROUTE_FAST_MAX_TOKENS', '8000'))
+ROUTE_FAST_MAX_DIFFICULTY = float(os.getenv('ROUTE_FAST_MAX_DIFFICULTY', '1.0'))
+# Hạn chót cứng (giây) cho một lần phân tích, tính cả thời gian chờ và thử lại
+GEMINI_REQUEST_DEADLINE = float(os.getenv('GEMINI_REQUEST_DEADLINE', '300'))
+# Hedging: nếu quá phân vị HEDGE_QUANTILE độ trễ mà chưa có phản hồi thì gửi thêm một
+# request (tới GEMINI_HEDGE_MODEL nếu có) và lấy kết quả về trước; 0 để tắt
+GEMINI_HEDGE = os.getenv('GEMINI_HEDGE', '1') == '1'
+GEMINI_HEDGE_MODEL = os.getenv('GEMINI_HEDGE_MODEL', '')
+HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', '0.95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+
+# Thời gian (giây) coi kết quả kiểm tra kết nối Gemini là còn mới
+API_HEALTH_TTL = float(os.getenv('API_HEALTH_TTL', '300'))
+# Đặt GEMINI_EAGER_PROBE=1 để kiểm tra kết nối đồng bộ ngay lúc import (hành vi cũ)
+GEMINI_EAGER_PROBE = os.getenv('GEMINI_EAGER_PROBE', '0') == '1'
+
+class ApiHealth:
+    """
+    Trạng thái kết nối tới Gemini, được kiểm tra ở thread nền và lưu trong SharedState
+    trong ttl giây. Mỗi lượt chỉ một worker kiểm tra (lease), các worker khác đọc kết quả
+    chung. Việc kiểm tra chỉ đọc metadata của model (genai.get_model), không sinh nội dung.
+    """
+
+    # Thời gian chờ tối đa (giây) cho một lần kiểm tra
+    PROBE_TIMEOUT = 10
+
+    def __init__(self, ttl, state):
+        self.ttl = ttl
+        self.state = state
+        self._lock = threading.Lock()
+        self._probe_pid = None  # process đang chạy probe (thread không sống sót qua fork)
+
+    def probe(self):
+        try:
+            if not gemini_model_global:
+                raise RuntimeError("Model chưa được khởi tạo")
+            if rest_client_global is not None:
+                rest_client_global.get_model(model_name_global, timeout=self.PROBE_TIMEOUT)
+            else:
+                genai.get_model(f"models/{model_name_global}", request_options={"timeout": self.PROBE_TIMEOUT, "retry": None})
+            ok, message = True, None
+        except Exception as e:
+            ok, message = False, str(e)
+            print(f"❌ Lỗi xác thực Gemini API: {e}")
+        self.state.set("api_health", {"ok": ok, "message": message, "model": model_name_global})
+        self.state.release("api_health.probe", str(os.getpid()))
+        with self._lock:
+            self._probe_pid = None
+        return ok
+
+    def refresh_async(self):
+        with self._lock:
+            if self._probe_pid == os.getpid():
+                return
+            # Worker khác đang kiểm tra thì dùng kết quả của worker đó
+            if not self.state.claim("api_health.probe", str(os.getpid()), 2 * self.PROBE_TIMEOUT):
+                return
+            self._probe_pid = os.getpid()
+        threading.Thread(target=self.probe, name='gemini-health', daemon=True).start()
+
+    def get(self):
+        """Trả về (ok, message); tự khởi động kiểm tra nền nếu kết quả đã cũ."""
+        value, updated_at = self.state.get("api_health")
+        # Kết quả của cấu hình model khác (trước khi khởi động lại) coi như chưa kiểm tra
+        if value is not None and value.get("model") != model_name_global:
+            value = None
+        if value is None or time.time() - updated_at > self.ttl:
+            self.refresh_async()
+        if value is None:
+            return None, None
+        return value["ok"], value["message"]
+
+api_health = ApiHealth(API_HEALTH_TTL, shared_state)
 
 def setup_gemini_api():
     """
-    Cấu hình và test kết nối Google Gemini theo API key từ .env.
+    Cấu hình Google Gemini theo API key từ .env và tạo GenerativeModel
+    (hoặc RestModel nếu GEMINI_BACKEND=rest).
+    Không gọi mạng: kết nối được kiểm tra (và với backend REST, mở sẵn) ở nền.
     Trả về True nếu thành công, False nếu thất bại.
     """
-    global model_name_global, gemini_model_global
+    global model_name_global, gemini_model_global, rest_client_global
 
-    api_key = os.getenv("GEMINI_API_KEY")
+    api_key = GEMINI_API_KEY
     if not api_key:
         print("❌ GEMINI_API_KEY chưa được thiết lập trong .env")
         return False
 
     # Cấu hình genai
-    genai.configure(api_key=api_key)
+    if GEMINI_BACKEND == 'rest':
+        # Import muộn để backend SDK không phải tải requests/httpx lúc khởi động
+        import gemini_rest
+        rest_client_global = gemini_rest.GeminiRestClient(
+            api_key, endpoint=GEMINI_API_ENDPOINT or None, pool_size=GEMINI_REST_POOL,
+            async_pool_size=ASYNC_UPSTREAM_MAX_CONCURRENCY,
+        )
+        print(f"ℹ️ Backend REST ({rest_client_global.transport}) tại {rest_client_global.base_url}")
+    elif GEMINI_API_ENDPOINT:
+        # Endpoint thay thế chỉ hỗ trợ qua REST (http:// hoặc https://)
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+        print(f"ℹ️ Dùng Gemini API tại {GEMINI_API_ENDPOINT}")
+    else:
+        genai.configure(api_key=api_key)
 
     try:
-        model_to_use = "gemini-1.5-pro-latest"
-        gemini_model_global = genai.GenerativeModel(model_to_use)
-        # Test kết nối
-        test_resp = gemini_model_global.generate_content("Hello")
-        if not getattr(test_resp, "text", None):
-            raise RuntimeError("Phản hồi rỗng từ Gemini")
-
-        print(f"✅ Google Gemini API configured. Model: {model_to_use}")
+        model_to_use = GEMINI_MODEL
+        gemini_model_global = new_model(model_to_use)
         model_name_global = model_to_use
-        return True
-
+        gemini_models[model_to_use] = gemini_model_global
+        print(f"✅ Google Gemini API configured. Model: {model_to_use}")
     except Exception as e:
-        print(f"❌ Lỗi xác thực Gemini API: {e}")
+        print(f"❌ Lỗi cấu hình Gemini API: {e}")
         model_name_global = None
         gemini_model_global = None
         return False
 
+    # Model nhanh cho bài nộp nhỏ và model dự phòng cho request hedge (nếu có)
+    for extra_model in (GEMINI_FAST_MODEL, GEMINI_HEDGE_MODEL):
+        if not extra_model or extra_model in gemini_models:
+            continue
+        try:
+            gemini_models[extra_model] = new_model(extra_model)
+            print(f"✅ Model phụ: {extra_model}")
+        except Exception as e:
+            # Thiếu model phụ thì dùng model chính thay thế
+            print(f"⚠️ Không tạo được model {extra_model}: {e}")
+
+    if rest_client_global is not None and GEMINI_REST_PREWARM:
+        threading.Thread(target=rest_client_global.warm, args=(model_to_use,),
+                         name='gemini-prewarm', daemon=True).start()
+
+    if GEMINI_EAGER_PROBE:
+        return api_health.probe()
+    api_health.refresh_async()
+    return True
+
+def new_model(model_name):
+    """Tạo đối tượng model theo backend đang dùng."""
+    if rest_client_global is not None:
+        return rest_client_global.model(model_name)
+    return genai.GenerativeModel(model_name)
+
 # Gọi ngay khi module được import, để WSGI cũng khởi tạo model
 setup_gemini_api()
 
-def create_prompt(problem_description, source_code, language):
-    return textwrap.dedent(f"""
+# Prompt được dựng từ phần đầu (đề bài), mã nguồn và phần cuối (yêu cầu). Dedent áp dụng
+# lên template trước khi chèn nội dung để thụt lề của mã nguồn không ảnh hưởng tới prompt.
+PROMPT_HEAD_TEMPLATE = textwrap.dedent("""
     Bạn là một trợ lý lập trình thông minh chuyên phân tích và debug mã nguồn {language}.
     
     # Đề bài:
@@ -102,7 +948,9 @@ def create_prompt(problem_description, source_code, language):
     
     # Mã nguồn {language} (DO NGƯỜI DÙNG CUNG CẤP):
     ```{language}
-    {source_code}
+    """)
+
+PROMPT_TAIL_TEMPLATE = textwrap.dedent("""
     ```
     
     Hãy thực hiện các nhiệm vụ sau ĐỐI VỚI MÃ NGUỒN GỐC DO NGƯỜI DÙNG CUNG CẤP:
@@ -127,54 +975,2081 @@ def create_prompt(problem_description, source_code, language):
     **LƯU Ý**: Chỉ trả về duy nhất một đối tượng JSON hợp lệ, không kèm text giải thích ngoài JSON.
     """)
 
-def analyze_code_with_gemini(model_name, prompt_text):
-    if not model_name or not gemini_model_global:
-        return None, "Model hoặc Gemini client không được cấu hình."
+def create_prompt_parts(problem_description, language):
+    """Phần đầu và phần cuối của prompt; dùng chung cho mọi bài nộp cùng đề bài và ngôn ngữ."""
+    head = PROMPT_HEAD_TEMPLATE.format(language=language, problem_description=problem_description)
+    tail = PROMPT_TAIL_TEMPLATE.format(language=language)
+    return head, tail
+
+def create_prompt(problem_description, source_code, language, prompt_parts=None):
+    head, tail = prompt_parts or create_prompt_parts(problem_description, language)
+    return head + source_code + tail
+
+# Ngân sách token cho prompt gửi lên Gemini
+MAX_PROMPT_TOKENS = int(os.getenv('MAX_PROMPT_TOKENS', '900000'))
+# Ước lượng thô: số ký tự trung bình trên một token
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+class TokenCounter:
+    """
+    Đếm token của prompt, có cache LRU theo hash nội dung.
+    Prompt nhỏ hơn nhiều so với ngân sách chỉ được ước lượng theo số ký tự;
+    chỉ prompt gần ngưỡng mới được đếm chính xác bằng model.count_tokens.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate(text):
+        return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+    def count(self, text, budget):
+        """Trả về số token (ước lượng nếu rõ ràng nằm dưới budget/2, ngược lại đếm chính xác)."""
+        estimate = self.estimate(text)
+        if estimate <= budget // 2 or not gemini_model_global:
+            return estimate
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        try:
+            tokens = gemini_model_global.count_tokens(text).total_tokens
+        except Exception as e:
+            print(f"⚠️ Không đếm được token, dùng ước lượng: {e}")
+            return estimate
+        with self._lock:
+            self._cache[key] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+token_counter = TokenCounter()
+
+def _strip_python_comments(source_code):
+    """Bỏ comment Python bằng tokenize; mã lỗi cú pháp thì chỉ bỏ các dòng toàn comment."""
+    lines = source_code.splitlines()
     try:
-        cfg = {
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 20480,
-        }
-        resp = gemini_model_global.generate_content(prompt_text, generation_config=cfg)
-        raw = resp.text.strip()
+        comments = [
+            tok.start for tok in tokenize.generate_tokens(io.StringIO(source_code).readline)
+            if tok.type == tokenize.COMMENT
+        ]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return [("" if line.lstrip().startswith("#") else line) for line in lines]
+    for row, col in comments:
+        lines[row - 1] = lines[row - 1][:col]
+    return lines
+
+def _strip_c_comments(source_code):
+    """Bỏ comment // và /* */ của C, giữ nguyên chuỗi/ký tự và số dòng."""
+    out = []
+    i, n = 0, len(source_code)
+    quote = None
+    while i < n:
+        ch = source_code[i]
+        nxt = source_code[i + 1] if i + 1 < n else ""
+        if quote:
+            out.append(ch)
+            if ch == "\\" and nxt:
+                out.append(nxt)
+                i += 1
+            elif ch == quote or ch == "\n":
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+            out.append(ch)
+        elif ch == "/" and nxt == "/":
+            while i < n and source_code[i] != "\n":
+                i += 1
+            continue
+        elif ch == "/" and nxt == "*":
+            end = source_code.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            # Giữ lại các dấu xuống dòng để không lệch số dòng
+            out.append("\n" * source_code.count("\n", i, end))
+            i = end
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out).splitlines()
+
+def compact_source(source_code, language):
+    """
+    Rút gọn mã nguồn: bỏ comment, khoảng trắng cuối dòng và dòng trống.
+    Trả về (mã đã rút gọn, line_map) với line_map[i] là số dòng gốc của dòng i+1.
+    """
+    if language.lower() == "python":
+        lines = _strip_python_comments(source_code)
+    elif language.lower() == "c":
+        lines = _strip_c_comments(source_code)
+    else:
+        lines = source_code.splitlines()
+    kept, line_map = [], []
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip()
+        if line.strip():
+            kept.append(line)
+            line_map.append(number)
+    return "\n".join(kept), line_map
+
+def remap_result_lines(result, line_map):
+    """Đổi số dòng trong gợi ý sửa lỗi từ mã đã rút gọn về số dòng trong mã gốc."""
+    def original(number):
+        return line_map[number - 1] if 1 <= number <= len(line_map) else number
+
+    for suggestion in result.get("suggestions") or []:
+        if not isinstance(suggestion, dict):
+            continue
+        line = suggestion.get("line")
+        if isinstance(line, int):
+            suggestion["line"] = original(line)
+        elif isinstance(line, str):
+            suggestion["line"] = re.sub(r"\d+", lambda m: str(original(int(m.group()))), line)
+    return result
+
+# Kiểm tra cú pháp cục bộ trước khi gọi model: compile() cho Python, trình biên dịch C
+# với -fsyntax-only (mã nguồn qua stdin, không tạo file, không chạy code)
+SYNTAX_CHECK_ENABLED = os.getenv('SYNTAX_CHECK_ENABLED', '1') == '1'
+SYNTAX_CHECK_CC = os.getenv('SYNTAX_CHECK_CC', 'gcc')
+SYNTAX_CHECK_TIMEOUT = float(os.getenv('SYNTAX_CHECK_TIMEOUT', '5'))
+SYNTAX_CHECK_MAX_CHARS = int(os.getenv('SYNTAX_CHECK_MAX_CHARS', '200000'))
+SYNTAX_CHECK_WORKERS = int(os.getenv('SYNTAX_CHECK_WORKERS', '4'))
+# Bật thì lỗi biên dịch được trả về ngay (phần "analysis"), phân tích của model đến sau
+SYNTAX_FAST_PATH = os.getenv('SYNTAX_FAST_PATH', '0') == '1'
+# Chỉ giữ thông báo về chính mã nguồn (<stdin>); thông báo về file khác (#include "/etc/...")
+# có thể trích nội dung file đó nên bị bỏ
+_CC_DIAGNOSTIC_RE = re.compile(r"^<stdin>:(\d+):(?:(\d+):)? (fatal error|error|warning): (.*)$", re.MULTILINE)
+
+class SyntaxChecker:
+    """
+    Kiểm tra cú pháp bài nộp, có cache LRU theo hash (ngôn ngữ, mã nguồn).
+    check() trả về danh sách diagnostic {"line", "column", "severity", "message"},
+    hoặc None nếu không kiểm tra được (ngôn ngữ khác, thiếu trình biên dịch, mã quá dài).
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._cc_missing = False
+
+    def check(self, source_code, language):
+        if not SYNTAX_CHECK_ENABLED or len(source_code) > SYNTAX_CHECK_MAX_CHARS:
+            return None
+        key = hashlib.sha256(f"{language.lower()}\0{source_code}".encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        with STAGE_SECONDS.time(stage="syntax_check"):
+            if language.lower() == "python":
+                diagnostics = self._check_python(source_code)
+            elif language.lower() == "c":
+                diagnostics = self._check_c(source_code)
+            else:
+                diagnostics = None
+        if diagnostics is not None:
+            with self._lock:
+                self._cache[key] = diagnostics
+                if len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return diagnostics
+
+    @staticmethod
+    def _check_python(source_code):
+        try:
+            compile(source_code, "<submission>", "exec", dont_inherit=True)
+        except SyntaxError as e:
+            return [{"line": e.lineno, "column": e.offset, "severity": "error",
+                     "message": f"{type(e).__name__}: {e.msg}"}]
+        except (ValueError, RecursionError, MemoryError) as e:
+            return [{"line": None, "column": None, "severity": "error", "message": str(e)}]
+        return []
+
+    def _check_c(self, source_code):
+        if self._cc_missing:
+            return None
+        try:
+            proc = subprocess.run(
+                [SYNTAX_CHECK_CC, "-fsyntax-only", "-fdiagnostics-color=never", "-fmax-errors=20", "-x", "c", "-"],
+                input=source_code, capture_output=True, text=True, errors="replace", timeout=SYNTAX_CHECK_TIMEOUT,
+            )
+        except FileNotFoundError:
+            self._cc_missing = True
+            print(f"⚠️ Không tìm thấy {SYNTAX_CHECK_CC}, bỏ qua kiểm tra cú pháp C")
+            return None
+        except (subprocess.TimeoutExpired, OSError) as e:
+            print(f"⚠️ Kiểm tra cú pháp C thất bại: {e}")
+            return None
+        diagnostics = [
+            {"line": int(line), "column": int(column) if column else None,
+             "severity": "error" if "error" in severity else "warning", "message": message.strip()}
+            for line, column, severity, message in _CC_DIAGNOSTIC_RE.findall(proc.stderr)
+        ]
+        if proc.returncode != 0 and not has_syntax_errors(diagnostics):
+            diagnostics.append({"line": None, "column": None, "severity": "error",
+                                "message": "Trình biên dịch báo lỗi trong file được #include"})
+        return diagnostics
+
+syntax_checker = SyntaxChecker()
+syntax_executor = ThreadPoolExecutor(max_workers=SYNTAX_CHECK_WORKERS, thread_name_prefix='syntax-check')
+
+def has_syntax_errors(diagnostics):
+    return any(d["severity"] == "error" for d in diagnostics or ())
+
+def format_diagnostic(diagnostic, line_of=None):
+    line = diagnostic["line"]
+    if line is not None and line_of is not None:
+        line = line_of(line)
+    where = f"Dòng {line}" if line is not None else "Không rõ dòng"
+    if diagnostic["column"]:
+        where += f", cột {diagnostic['column']}"
+    return f"{where} ({diagnostic['severity']}): {diagnostic['message']}"
+
+def diagnostics_prompt_note(diagnostics, language, line_map=None):
+    """Đoạn ghi chú thêm vào cuối prompt với kết quả kiểm tra cú pháp; số dòng theo mã trong prompt."""
+    if diagnostics is None:
+        return ""
+    tool = "compile() của Python" if language.lower() == "python" else f"{SYNTAX_CHECK_CC} -fsyntax-only"
+    if not diagnostics:
+        return f"\n# Kiểm tra cú pháp tự động ({tool}): không phát hiện lỗi cú pháp.\n"
+    line_of = None
+    if line_map is not None:
+        # Mã trong prompt đã được rút gọn: đổi số dòng gốc sang dòng tương ứng trong prompt
+        compacted = {original: index for index, original in enumerate(line_map, 1)}
+        line_of = lambda number: compacted.get(number, number)
+    lines = "\n".join(f"- {format_diagnostic(d, line_of)}" for d in diagnostics)
+    return (
+        f"\n# Kiểm tra cú pháp tự động ({tool}) báo các lỗi sau; hãy dùng chúng khi liệt kê lỗi cú pháp "
+        f"và gợi ý sửa (số dòng theo mã nguồn ở trên):\n{lines}\n"
+    )
+
+def precheck_result(diagnostics):
+    """Phần "analysis" tạm thời dựng từ lỗi biên dịch, gửi trước khi model trả lời."""
+    errors = [d for d in diagnostics if d["severity"] == "error"]
+    return {
+        "analysis": {
+            "meets_requirements": False,
+            "syntax_errors": [format_diagnostic(d) for d in errors],
+            "logical_errors": [],
+            "runtime_errors": [],
+        },
+    }
+
+def build_prompt_within_budget(problem_description, source_code, language, prompt_parts=None, diagnostics=None):
+    """
+    Tạo prompt và kiểm tra ngân sách token trước khi gửi.
+    Prompt vượt ngân sách được tạo lại từ mã đã rút gọn; nếu vẫn vượt thì báo lỗi ngay.
+    Kết quả kiểm tra cú pháp (nếu có) được thêm vào cuối prompt.
+    Trả về (prompt, line_map, error); line_map là None nếu không rút gọn.
+    """
+    with STAGE_SECONDS.time(stage="create_prompt"):
+        prompt, line_map, error = _build_prompt_within_budget(
+            problem_description, source_code, language, prompt_parts
+        )
+        if prompt is not None:
+            prompt += diagnostics_prompt_note(diagnostics, language, line_map)
+        return prompt, line_map, error
+
+def _build_prompt_within_budget(problem_description, source_code, language, prompt_parts):
+    prompt = create_prompt(problem_description, source_code, language, prompt_parts)
+    if token_counter.estimate(prompt) <= MAX_PROMPT_TOKENS:
+        tokens = token_counter.count(prompt, MAX_PROMPT_TOKENS)
+        if tokens <= MAX_PROMPT_TOKENS:
+            return prompt, None, None
 
-        # Nếu model trả về trong markdown block, strip backticks
-        json_str = raw
-        if raw.startswith("```"):
-            parts = raw.split("```", 2)
-            if len(parts) >= 3:
-                json_str = parts[1].strip()
+    compacted, line_map = compact_source(source_code, language)
+    prompt = create_prompt(problem_description, compacted, language, prompt_parts)
+    # Vượt xa ngân sách thì từ chối ngay, không tốn lời gọi count_tokens
+    tokens = token_counter.estimate(prompt)
+    if tokens <= 2 * MAX_PROMPT_TOKENS:
+        tokens = token_counter.count(prompt, MAX_PROMPT_TOKENS)
+    if tokens > MAX_PROMPT_TOKENS:
+        return None, None, (
+            f"Mã nguồn quá lớn: prompt khoảng {tokens:,} token (sau khi bỏ comment và dòng trống), "
+            f"vượt giới hạn {MAX_PROMPT_TOKENS:,} token. Vui lòng gửi phần mã nhỏ hơn."
+        )
+    return prompt, line_map, None
 
+# Từ khóa rẽ nhánh/vòng lặp dùng để ước lượng độ phức tạp của mã nguồn
+_BRANCH_RE = re.compile(r"\b(?:if|elif|else|for|while|switch|case|try|catch|except|goto)\b")
+
+def estimate_difficulty(problem_description, source_code):
+    """
+    Điểm độ khó thô của một bài nộp: 0 là rất đơn giản, khoảng 1 là bài tập vài chục dòng
+    có lồng vòng lặp. Tính từ số dòng code, độ sâu lồng nhau, số nhánh và độ dài đề bài.
+    """
+    lines = [line for line in source_code.splitlines() if line.strip()]
+    if not lines:
+        return 0.0
+    indent_depth = max((len(line.expandtabs(4)) - len(line.expandtabs(4).lstrip())) // 4 for line in lines)
+    brace_depth = depth = 0
+    for ch in source_code:
+        if ch == '{':
+            depth += 1
+            brace_depth = max(brace_depth, depth)
+        elif ch == '}':
+            depth = max(0, depth - 1)
+    branches = len(_BRANCH_RE.findall(source_code))
+    return (len(lines) / 150 + max(indent_depth, brace_depth) / 8
+            + branches / 40 + len(problem_description) / 3000)
+
+def routing_enabled():
+    return bool(GEMINI_FAST_MODEL) and GEMINI_FAST_MODEL in gemini_models and GEMINI_FAST_MODEL != model_name_global
+
+def analysis_model_id():
+    """Định danh model cho khóa cache: đổi model hoặc ngưỡng định tuyến thì không dùng lại kết quả cũ."""
+    if routing_enabled():
+        return f"{model_name_global}|{GEMINI_FAST_MODEL}|{ROUTE_FAST_MAX_TOKENS}|{ROUTE_FAST_MAX_DIFFICULTY}"
+    return model_name_global
+
+def choose_model(prompt, problem_description, source_code):
+    """
+    Chọn tuyến cho prompt: ('fast', model nhanh) khi prompt nhỏ và bài nộp đơn giản,
+    ngược lại ('large', model chính). Số token và độ khó được ghi vào metrics theo tuyến
+    để chỉnh ngưỡng từ dữ liệu thực tế.
+    """
+    if not routing_enabled():
+        return "large", model_name_global
+    tokens = token_counter.estimate(prompt)
+    # Chỉ đếm chính xác khi ước lượng nằm gần ngưỡng
+    if tokens <= 2 * ROUTE_FAST_MAX_TOKENS:
+        tokens = token_counter.count(prompt, 2 * ROUTE_FAST_MAX_TOKENS)
+    difficulty = estimate_difficulty(problem_description, source_code)
+    if tokens <= ROUTE_FAST_MAX_TOKENS and difficulty <= ROUTE_FAST_MAX_DIFFICULTY:
+        route, model_name = "fast", GEMINI_FAST_MODEL
+    else:
+        route, model_name = "large", model_name_global
+    ROUTE_PROMPT_TOKENS.observe(tokens, route=route)
+    ROUTE_DIFFICULTY.observe(difficulty, route=route)
+    return route, model_name
+
+# Các phần của kết quả phân tích, theo thứ tự hiển thị trên result.html
+RESULT_SECTIONS = ("analysis", "suggestions", "simulation", "evaluation")
+
+def extract_json_text(raw):
+    """Bỏ khối markdown (```json ... ```) bao quanh JSON model trả về, nếu có."""
+    json_str = raw.strip()
+    if json_str.startswith("```"):
+        parts = json_str.split("```", 2)
+        if len(parts) >= 3:
+            json_str = parts[1].strip()
+            # Bỏ nhãn ngôn ngữ của khối code
+            if json_str[:4].lower() == "json":
+                json_str = json_str[4:].strip()
+    return json_str
+
+def parse_model_json(raw):
+    with STAGE_SECONDS.time(stage="json_extraction"):
+        json_str = extract_json_text(raw)
         try:
-            result = json.loads(json_str)
-            return result, None
+            return json.loads(json_str), None
         except json.JSONDecodeError as e:
             return None, f"JSON parse error: {e}\\nResponse:\\n{json_str}"
 
+class IncrementalJSONParser:
+    """
+    Đọc dần một JSON object theo từng chunk văn bản và trả về từng cặp (key, value)
+    ở mức ngoài cùng ngay khi value đó đóng lại, không cần chờ toàn bộ object.
+    Văn bản trước dấu '{' đầu tiên (ví dụ ```json) bị bỏ qua.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._started = False
+        self._finished = False
+        self._in_string = False
+        self._escape = False
+        self._member_start = 0
+
+    def feed(self, chunk):
+        self._text += chunk
+        completed = []
+        text = self._text
+        i = self._pos
+        while i < len(text) and not self._finished:
+            ch = text[i]
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                    self._member_start = i + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(text[self._member_start:i], completed)
+                    self._finished = True
+            elif ch == "," and self._depth == 1:
+                self._emit(text[self._member_start:i], completed)
+                self._member_start = i + 1
+            i += 1
+        self._pos = i
+        return completed
+
+    @staticmethod
+    def _emit(member_text, completed):
+        if not member_text.strip():
+            return
+        try:
+            completed.extend(json.loads("{" + member_text + "}").items())
+        except json.JSONDecodeError:
+            # Phần tử hỏng sẽ được báo lỗi khi parse toàn bộ phản hồi
+            pass
+
+# Số lời gọi Gemini chạy đồng thời tối đa trong process (dùng chung cho mọi đường gọi)
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '8'))
+upstream_slots = threading.BoundedSemaphore(UPSTREAM_MAX_CONCURRENCY)
+
+# Giới hạn tốc độ gọi Gemini phía client (0 = không giới hạn) và chính sách thử lại
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', '60'))
+GEMINI_TPM = float(os.getenv('GEMINI_TPM', '4000000'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '1'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '60'))
+# Mã HTTP đáng thử lại: quá tải/hết quota tạm thời và lỗi phía server
+RETRYABLE_STATUS = {429, 500, 503, 504}
+
+class RateLimiter:
+    """
+    Token bucket cho requests/phút và tokens/phút, dùng chung trong process.
+
+    reserve() đặt chỗ ngay (bucket có thể âm) và trả về thời gian phải chờ, nên các lời
+    gọi được phục vụ theo thứ tự đến và dùng được cho cả code đồng bộ lẫn async.
+    Tốc độ tự điều chỉnh kiểu AIMD: giảm một nửa khi upstream trả 429, tăng dần lại
+    sau mỗi lời gọi thành công, để throughput bám sát giới hạn thay vì dao động.
+    """
+
+    # Dung lượng bucket tính theo số giây của tốc độ tối đa (độ lớn burst cho phép)
+    BURST_SECONDS = 10.0
+    MIN_SCALE = 0.1
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.scale = 1.0
+        self._lock = threading.Lock()
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._requests = self._capacity(rpm)
+        self._tokens = self._capacity(tpm)
+
+    def _capacity(self, per_minute):
+        return max(1.0, per_minute * self.BURST_SECONDS / 60.0)
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm > 0:
+            self._requests = min(self._capacity(self.rpm), self._requests + elapsed * self.rpm * self.scale / 60.0)
+        if self.tpm > 0:
+            self._tokens = min(self._capacity(self.tpm), self._tokens + elapsed * self.tpm * self.scale / 60.0)
+
+    def reserve(self, tokens):
+        """Đặt chỗ cho một request dùng `tokens` token; trả về số giây cần chờ trước khi gửi."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._blocked_until - now)
+            if self.rpm > 0:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60.0 / (self.rpm * self.scale))
+            if self.tpm > 0:
+                # Prompt lớn hơn cả bucket vẫn được gửi khi bucket đầy, không chờ mãi
+                self._tokens -= min(tokens, self._capacity(self.tpm))
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60.0 / (self.tpm * self.scale))
+            return wait
+
+    def settle(self, extra_tokens):
+        """Điều chỉnh bucket token theo số token thực tế (usage_metadata) sau lời gọi."""
+        if self.tpm > 0 and extra_tokens:
+            with self._lock:
+                self._tokens -= extra_tokens
+
+    def on_success(self):
+        with self._lock:
+            self.scale = min(1.0, self.scale + self.RECOVERY_STEP)
+
+    def on_throttled(self, retry_after=None):
+        with self._lock:
+            self.scale = max(self.MIN_SCALE, self.scale / 2)
+            # Bỏ phần burst còn lại: sau khi bị chặn chỉ gửi thăm dò một request
+            self._requests = min(self._requests, 1.0)
+            if retry_after:
+                # Không ai được gửi tiếp trước khi hết thời gian upstream yêu cầu
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+rate_limiter = RateLimiter(GEMINI_RPM, GEMINI_TPM)
+
+def retry_after_hint(error):
+    """Lấy thời gian chờ upstream gợi ý (RetryInfo, header Retry-After hoặc thông báo lỗi)."""
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and (getattr(delay, "seconds", 0) or getattr(delay, "nanos", 0)):
+            return delay.seconds + delay.nanos / 1e9
+    response = getattr(error, "response", None)
+    header = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    match = re.search(r"retry in ([\d.]+)\s*s", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+def backoff_delay(attempt, retry_after=None):
+    """Backoff mũ với jitter; nếu upstream gợi ý thời gian chờ thì chờ ít nhất chừng đó."""
+    if retry_after:
+        return retry_after + random.uniform(0, RETRY_BASE_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def remaining_time(deadline):
+    """Số giây còn lại tới deadline (time.monotonic()); báo TimeoutError nếu đã quá hạn."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Quá thời gian chờ phản hồi từ Gemini.")
+    return remaining
+
+def gemini_request_options(timeout):
+    # Tắt retry mặc định của SDK, việc thử lại do call_gemini quản lý
+    return {"retry": None} if timeout is None else {"retry": None, "timeout": timeout}
+
+def call_gemini(request_fn, prompt_text, stats=None, can_retry=None, deadline=None, cancelled=None):
+    """
+    Gửi request_fn(timeout) qua rate limiter chung. Lỗi 429/5xx được thử lại tối đa
+    GEMINI_MAX_RETRIES lần với backoff có jitter, tôn trọng retry-after của upstream;
+    can_retry() trả về False thì không thử lại (ví dụ stream đã gửi dữ liệu đi).
+    deadline (time.monotonic()) là hạn chót cho cả lời gọi: mỗi lần thử chỉ được phần
+    thời gian còn lại, và không chờ/thử lại nếu sẽ vượt hạn.
+    cancelled (threading.Event) được đặt khi không ai còn cần kết quả (request hedge thua):
+    lời gọi dừng chờ và báo CancelledError trước lần gửi kế tiếp, request đang bay thì
+    không ngắt được.
+    stats nhận queue_wait (giây chờ rate limiter), backoff (giây chờ thử lại) và retries.
+    """
+    def pause(seconds):
+        if cancelled is None:
+            time.sleep(seconds)
+        elif cancelled.wait(seconds):
+            raise CancelledError()
+
+    tokens = token_counter.estimate(prompt_text)
+    queue_wait = backoff = 0.0
+    retries = 0
+    try:
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError()
+            wait = rate_limiter.reserve(tokens)
+            if wait > 0:
+                remaining = remaining_time(deadline)
+                if remaining is not None and wait >= remaining:
+                    raise TimeoutError("Quá thời gian chờ lượt gọi Gemini (rate limit).")
+                pause(wait)
+                queue_wait += wait
+            try:
+                with STAGE_SECONDS.time(stage="gemini_call"):
+                    response = request_fn(remaining_time(deadline))
+            except Exception as e:
+                status = getattr(e, "code", None)
+                UPSTREAM_ERRORS.inc(status=status or "", error=type(e).__name__)
+                if (status not in RETRYABLE_STATUS or attempt == GEMINI_MAX_RETRIES
+                        or (can_retry is not None and not can_retry())):
+                    raise
+                retry_after = retry_after_hint(e)
+                if status == 429:
+                    rate_limiter.on_throttled(retry_after)
+                delay = backoff_delay(attempt, retry_after)
+                remaining = remaining_time(deadline)
+                if remaining is not None and delay >= remaining:
+                    raise
+                print(f"⚠️ Gemini trả lỗi {status}, thử lại sau {delay:.1f}s ({attempt + 1}/{GEMINI_MAX_RETRIES})")
+                pause(delay)
+                backoff += delay
+                retries += 1
+                GEMINI_RETRIES.inc()
+                continue
+            rate_limiter.on_success()
+            usage = getattr(response, "usage_metadata", None)
+            if usage is not None and getattr(usage, "prompt_token_count", None):
+                rate_limiter.settle(usage.prompt_token_count - tokens)
+            return response
+    finally:
+        GEMINI_QUEUE_WAIT.observe(queue_wait)
+        if stats is not None:
+            stats.update(queue_wait=queue_wait, backoff=backoff, retries=retries)
+
+def record_usage(stats, response, started):
+    """Ghi độ trễ và số token (từ usage_metadata) của một lời gọi vào dict stats."""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    GEMINI_TOKENS.inc(prompt_tokens, kind="prompt")
+    GEMINI_TOKENS.inc(output_tokens, kind="output")
+    if stats is None:
+        return
+    stats["latency"] = time.monotonic() - started
+    if usage is not None:
+        stats["prompt_tokens"] = prompt_tokens
+        stats["output_tokens"] = output_tokens
+
+class LatencyTracker:
+    """Độ trễ gần đây của từng model (cửa sổ trượt), dùng để đặt mốc hedging."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(model_name, [])
+            samples.append(seconds)
+            if len(samples) > self.window:
+                del samples[0]
+
+    def quantile(self, model_name, q, min_samples):
+        """Phân vị q của độ trễ; None nếu chưa đủ min_samples mẫu."""
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+latency_tracker = LatencyTracker()
+# Thread chạy request chính và request hedge khi hedging được bật
+hedge_executor = ThreadPoolExecutor(max_workers=2 * UPSTREAM_MAX_CONCURRENCY, thread_name_prefix='gemini-hedge')
+
+def generate_with_retries(model_name, prompt_text, stats, deadline, cancelled=None):
+    """Một lời gọi generate_content (có rate limit/thử lại); trả về response, ghi độ trễ."""
+    model = gemini_models[model_name]
+    started = time.monotonic()
+
+    def request(timeout):
+        nonlocal started
+        started = time.monotonic()
+        return model.generate_content(
+            prompt_text, generation_config=GENERATION_CONFIG, request_options=gemini_request_options(timeout)
+        )
+
+    resp = call_gemini(request, prompt_text, stats, deadline=deadline, cancelled=cancelled)
+    latency_tracker.record(model_name, time.monotonic() - started)
+    record_usage(stats, resp, started)
+    return resp
+
+def hedged_generate(model_name, prompt_text, stats, deadline):
+    """
+    Gọi model; nếu quá mốc phân vị độ trễ mà chưa xong thì gửi thêm request hedge
+    và lấy kết quả về trước. Hedge chỉ được gửi khi còn slot upstream trống (slot của
+    người gọi tính cho request chính). Request thua được báo hủy: nó không chờ rate
+    limiter hay thử lại nữa, chỉ chạy nốt lần gửi đang bay (tối đa tới deadline). Slot
+    thêm cho hedge chỉ được trả khi cả hai request đã kết thúc, nên request thua vẫn
+    được tính vào UPSTREAM_MAX_CONCURRENCY cho tới khi thật sự trả về.
+    """
+    hedge_model = GEMINI_HEDGE_MODEL if GEMINI_HEDGE_MODEL in gemini_models else model_name
+    delay = latency_tracker.quantile(model_name, HEDGE_QUANTILE, HEDGE_MIN_SAMPLES) if GEMINI_HEDGE else None
+    if delay is None:
+        return generate_with_retries(model_name, prompt_text, stats, deadline)
+
+    delay = max(delay, HEDGE_MIN_DELAY)
+    attempt_stats = {}
+    cancelled = threading.Event()
+    primary = hedge_executor.submit(generate_with_retries, model_name, prompt_text, attempt_stats, deadline,
+                                    cancelled)
+    done, _ = wait_futures([primary], timeout=min(delay, remaining_time(deadline)))
+    if done or not upstream_slots.acquire(blocking=False):
+        if not done:
+            HEDGES.inc(outcome="skipped")
+        if stats is not None:
+            stats["hedged"] = False
+        resp = primary.result(timeout=remaining_time(deadline))
+        if stats is not None:
+            stats.update(attempt_stats)
+        return resp
+
+    hedge_stats = {}
+    hedge = hedge_executor.submit(generate_with_retries, hedge_model, prompt_text, hedge_stats, deadline, cancelled)
+    # Trả slot khi cả hai đã xong: người gọi trả slot của mình ngay khi có kết quả, slot
+    # này giữ chỗ cho request thua (callback trên future đã xong chạy ngay lập tức)
+    hedge.add_done_callback(lambda _: primary.add_done_callback(lambda _: upstream_slots.release()))
+    futures = {primary: ("primary", attempt_stats), hedge: ("hedge", hedge_stats)}
+    pending = set(futures)
+    error = None
+    try:
+        while pending:
+            done, pending = wait_futures(pending, timeout=remaining_time(deadline), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                winner, winner_stats = futures[future]
+                HEDGES.inc(outcome=winner)
+                if stats is not None:
+                    stats.update(winner_stats, hedged=True, hedge_winner=winner)
+                return future.result()
+        raise error
+    finally:
+        cancelled.set()
+
+def analyze_code_with_gemini(model_name, prompt_text, stats=None, deadline=None):
+    """
+    Gọi model (có hedging) và parse JSON kết quả. deadline (time.monotonic()) là hạn chót
+    cứng cho cả lời gọi, mặc định GEMINI_REQUEST_DEADLINE giây kể từ lúc gọi.
+    """
+    if not model_name or model_name not in gemini_models:
+        return None, "Model hoặc Gemini client không được cấu hình."
+    if deadline is None:
+        deadline = time.monotonic() + GEMINI_REQUEST_DEADLINE
+    try:
+        with upstream_slots:
+            resp = hedged_generate(model_name, prompt_text, stats, deadline)
+        return parse_model_json(resp.text)
+    except Exception as e:
+        return None, f"Lỗi khi gọi Gemini API: {e}"
+
+# Chế độ async (asgi.py): cùng rate limiter, chính sách thử lại, hedging và deadline như
+# bản đồng bộ ở trên, nhưng chờ bằng asyncio nên lời gọi đang chờ Gemini không giữ OS thread
+async_upstream_slots = asyncio.Semaphore(ASYNC_UPSTREAM_MAX_CONCURRENCY)
+
+async def generate_content_async(model, prompt_text, timeout):
+    options = gemini_request_options(timeout)
+    if rest_client_global is None and GEMINI_API_ENDPOINT:
+        # Client async của SDK chỉ đi qua gRPC; endpoint thay thế dùng REST nên chạy trong thread
+        return await asyncio.to_thread(
+            model.generate_content, prompt_text, generation_config=GENERATION_CONFIG, request_options=options
+        )
+    return await model.generate_content_async(prompt_text, generation_config=GENERATION_CONFIG, request_options=options)
+
+async def call_gemini_async(request_fn, prompt_text, stats=None, deadline=None):
+    """Bản async của call_gemini; request_fn(timeout) là coroutine function."""
+    tokens = token_counter.estimate(prompt_text)
+    queue_wait = backoff = 0.0
+    retries = 0
+    try:
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            wait = rate_limiter.reserve(tokens)
+            if wait > 0:
+                remaining = remaining_time(deadline)
+                if remaining is not None and wait >= remaining:
+                    raise TimeoutError("Quá thời gian chờ lượt gọi Gemini (rate limit).")
+                await asyncio.sleep(wait)
+                queue_wait += wait
+            try:
+                with STAGE_SECONDS.time(stage="gemini_call"):
+                    remaining = remaining_time(deadline)
+                    response = await asyncio.wait_for(request_fn(remaining), remaining)
+            except Exception as e:
+                status = getattr(e, "code", None)
+                UPSTREAM_ERRORS.inc(status=status or "", error=type(e).__name__)
+                if status not in RETRYABLE_STATUS or attempt == GEMINI_MAX_RETRIES:
+                    raise
+                retry_after = retry_after_hint(e)
+                if status == 429:
+                    rate_limiter.on_throttled(retry_after)
+                delay = backoff_delay(attempt, retry_after)
+                remaining = remaining_time(deadline)
+                if remaining is not None and delay >= remaining:
+                    raise
+                print(f"⚠️ Gemini trả lỗi {status}, thử lại sau {delay:.1f}s ({attempt + 1}/{GEMINI_MAX_RETRIES})")
+                await asyncio.sleep(delay)
+                backoff += delay
+                retries += 1
+                GEMINI_RETRIES.inc()
+                continue
+            rate_limiter.on_success()
+            usage = getattr(response, "usage_metadata", None)
+            if usage is not None and getattr(usage, "prompt_token_count", None):
+                rate_limiter.settle(usage.prompt_token_count - tokens)
+            return response
+    finally:
+        GEMINI_QUEUE_WAIT.observe(queue_wait)
+        if stats is not None:
+            stats.update(queue_wait=queue_wait, backoff=backoff, retries=retries)
+
+async def generate_with_retries_async(model_name, prompt_text, stats, deadline):
+    model = gemini_models[model_name]
+    started = time.monotonic()
+
+    async def request(timeout):
+        nonlocal started
+        started = time.monotonic()
+        return await generate_content_async(model, prompt_text, timeout)
+
+    resp = await call_gemini_async(request, prompt_text, stats, deadline=deadline)
+    latency_tracker.record(model_name, time.monotonic() - started)
+    record_usage(stats, resp, started)
+    return resp
+
+async def hedged_generate_async(model_name, prompt_text, stats, deadline):
+    """Bản async của hedged_generate; request thua bị hủy thật (đóng kết nối)."""
+    hedge_model = GEMINI_HEDGE_MODEL if GEMINI_HEDGE_MODEL in gemini_models else model_name
+    delay = latency_tracker.quantile(model_name, HEDGE_QUANTILE, HEDGE_MIN_SAMPLES) if GEMINI_HEDGE else None
+    if delay is None:
+        return await generate_with_retries_async(model_name, prompt_text, stats, deadline)
+
+    attempt_stats = {}
+    primary = asyncio.ensure_future(generate_with_retries_async(model_name, prompt_text, attempt_stats, deadline))
+    done, _ = await asyncio.wait({primary}, timeout=min(max(delay, HEDGE_MIN_DELAY), remaining_time(deadline)))
+    if done or async_upstream_slots.locked():
+        if not done:
+            HEDGES.inc(outcome="skipped")
+        if stats is not None:
+            stats["hedged"] = False
+        try:
+            resp = await asyncio.wait_for(primary, remaining_time(deadline))
+        finally:
+            if stats is not None:
+                stats.update(attempt_stats)
+        return resp
+
+    hedge_stats = {}
+
+    async def hedge_call():
+        async with async_upstream_slots:
+            return await generate_with_retries_async(hedge_model, prompt_text, hedge_stats, deadline)
+
+    hedge = asyncio.ensure_future(hedge_call())
+    attempts = {primary: ("primary", attempt_stats), hedge: ("hedge", hedge_stats)}
+    pending = set(attempts)
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=remaining_time(deadline),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError("Quá thời gian chờ phản hồi từ Gemini.")
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                winner, winner_stats = attempts[task]
+                HEDGES.inc(outcome=winner)
+                if stats is not None:
+                    stats.update(winner_stats, hedged=True, hedge_winner=winner)
+                return task.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def analyze_code_with_gemini_async(model_name, prompt_text, stats=None, deadline=None):
+    """Bản async của analyze_code_with_gemini."""
+    if not model_name or model_name not in gemini_models:
+        return None, "Model hoặc Gemini client không được cấu hình."
+    if deadline is None:
+        deadline = time.monotonic() + GEMINI_REQUEST_DEADLINE
+    try:
+        async with async_upstream_slots:
+            resp = await hedged_generate_async(model_name, prompt_text, stats, deadline)
+        return parse_model_json(resp.text)
     except Exception as e:
         return None, f"Lỗi khi gọi Gemini API: {e}"
 
+def analyze_code_with_gemini_stream(model_name, prompt_text, on_section=None, on_chunk=None, stats=None,
+                                    deadline=None):
+    """
+    Như analyze_code_with_gemini nhưng dùng streaming: mỗi chunk nhận được báo qua
+    on_chunk(số ký tự đã nhận), mỗi phần của JSON hoàn tất báo qua on_section(key, value).
+    Chỉ thử lại khi lỗi xảy ra trước chunk đầu tiên. Không hedging (các phần đã gửi
+    cho client không đổi được), nhưng vẫn dừng khi quá deadline.
+    """
+    model = gemini_models.get(model_name)
+    if not model_name or not model:
+        return None, "Model hoặc Gemini client không được cấu hình."
+    if deadline is None:
+        deadline = time.monotonic() + GEMINI_REQUEST_DEADLINE
+    pieces = []
+    started = time.monotonic()
+
+    def request(timeout):
+        nonlocal started
+        started = time.monotonic()
+        parser = IncrementalJSONParser()
+        received = 0
+        chunk = None
+        for chunk in model.generate_content(
+            prompt_text, generation_config=GENERATION_CONFIG, stream=True,
+            request_options=gemini_request_options(timeout),
+        ):
+            remaining_time(deadline)
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk không có phần text (ví dụ chunk kết thúc)
+                continue
+            pieces.append(text)
+            received += len(text)
+            if on_chunk:
+                on_chunk(received)
+            for key, value in parser.feed(text):
+                if on_section:
+                    on_section(key, value)
+        # usage_metadata đầy đủ nằm ở chunk cuối cùng
+        return chunk
+
+    try:
+        with upstream_slots:
+            last_chunk = call_gemini(request, prompt_text, stats, can_retry=lambda: not pieces, deadline=deadline)
+            latency_tracker.record(model_name, time.monotonic() - started)
+            record_usage(stats, last_chunk, started)
+        return parse_model_json("".join(pieces))
+    except Exception as e:
+        return None, f"Lỗi khi gọi Gemini API: {e}"
+
+# Escape HTML và giữ xuống dòng/khoảng trắng trong một lượt quét duy nhất
+_HTML_REPLACEMENTS = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '\n': '<br>', '  ': ' &nbsp;'}
+_HTML_SPECIAL_RE = re.compile(r"[&<>\n]|  ")
+
 def text_to_html(text_content):
     if not text_content:
         return ""
     s = str(text_content)
-    return Markup(
-        s.replace('&', '&amp;')
-         .replace('<', '&lt;')
-         .replace('>', '&gt;')
-         .replace('\n', '<br>')
-         .replace('  ', ' &nbsp;')
+    return Markup(_HTML_SPECIAL_RE.sub(lambda m: _HTML_REPLACEMENTS[m.group()], s))
+
+# Single-flight giữa các worker process (qua lease trong SharedState), mặc định tắt
+SINGLEFLIGHT_CROSS_PROCESS = os.getenv('SINGLEFLIGHT_CROSS_PROCESS', '0') == '1'
+SINGLEFLIGHT_LEASE_TTL = float(os.getenv('SINGLEFLIGHT_LEASE_TTL', '180'))
+
+class SingleFlight:
+    """
+    Gộp các lời gọi trùng khóa đang chạy đồng thời trong process: chỉ lời gọi đầu tiên
+    (leader) thực sự chạy, các lời gọi sau chờ và dùng chung kết quả. Các phần kết quả
+    leader công bố qua emit được phát lại cho mọi lời gọi đang chờ có on_section.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, on_section=None):
+        """Chạy fn(emit) cho key. Trả về (giá trị của fn, True nếu dùng chung với leader)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {
+                    "done": threading.Event(),
+                    "value": None,
+                    "sections": [],
+                    "subscribers": [],
+                }
+            else:
+                self.coalesced += 1
+            if on_section:
+                # Phát lại các phần đã có rồi đăng ký nhận phần tiếp theo
+                for name, value in call["sections"]:
+                    on_section(name, value)
+                call["subscribers"].append(on_section)
+
+        if not leader:
+            call["done"].wait()
+            return call["value"], True
+
+        def emit(name, value):
+            with self._lock:
+                call["sections"].append((name, value))
+                subscribers = list(call["subscribers"])
+            for subscriber in subscribers:
+                subscriber(name, value)
+
+        try:
+            call["value"] = fn(emit)
+        except Exception as e:
+            call["value"] = (None, f"Lỗi không mong muốn: {e}")
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["value"], False
+
+analysis_flight = SingleFlight()
+
+# Nhận diện bài nộp gần trùng (khác tên biến, khoảng trắng, comment) bằng MinHash/LSH
+NEAR_DUP_ENABLED = os.getenv('NEAR_DUP_ENABLED', '1') == '1'
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0.9'))
+NEAR_DUP_MAX_CHARS = int(os.getenv('NEAR_DUP_MAX_CHARS', '200000'))
+NEAR_DUP_PATH = os.path.join(DATA_DIR, 'near_dup.sqlite3')
+
+_C_KEYWORDS = frozenset("""
+    auto break case char const continue default do double else enum extern float for goto if inline
+    int long register return short signed sizeof static struct switch typedef union unsigned void
+    volatile while bool true false NULL include define printf scanf main
+""".split())
+_PY_KEYWORDS = frozenset("""
+    False None True and as assert async await break class continue def del elif else except finally
+    for from global if import in is lambda nonlocal not or pass raise return try while with yield
+    print input int float str list dict set tuple range len
+""".split())
+# Kiểu dựng sẵn của C: tên đứng sau chúng (qua * hoặc ,) là tên được khai báo
+_C_TYPES = frozenset("""
+    char int long short float double void bool signed unsigned size_t FILE
+    int8_t int16_t int32_t int64_t uint8_t uint16_t uint32_t uint64_t
+""".split())
+_C_DECL_SKIP = frozenset("const static extern register volatile auto inline * &".split())
+_LEX_RE = re.compile(r"""
+    (?P<STR>\"\"\"[\s\S]*?\"\"\"|'''[\s\S]*?'''|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<NUM>\b(?:0[xX][0-9a-fA-F]+|\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)[uUlLfF]*\b)
+  | (?P<ID>[A-Za-z_]\w*)
+  | (?P<OP>->|\+\+|--|<<=?|>>=?|[<>=!+\-*/%&|^]=|&&|\|\||//=?|\*\*=?|[^\s\w])
+""", re.VERBOSE)
+
+def _python_defined_names(source_code):
+    """Tên do chính bài nộp Python định nghĩa (hàm, lớp, tham số, biến được gán); None nếu lỗi cú pháp."""
+    try:
+        tree = ast.parse(source_code)
+    except (SyntaxError, ValueError):
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+    return names
+
+def _c_defined_names(tokens):
+    """
+    Tên do chính bài nộp C khai báo, theo heuristic trên token: biến/tham số/hàm đứng sau
+    một kiểu, tên typedef, tag struct/union/enum, hằng enum và macro #define. Tên không nhận
+    ra được coi là tên ngoài (an toàn: chỉ làm giảm số bài được coi là gần trùng).
+    """
+    values = [value for _, value, _ in tokens]
+    names, types = set(), set(_C_TYPES)
+    n = len(values)
+    for i, value in enumerate(values):
+        nxt = values[i + 1] if i + 1 < n else None
+        if value in ("struct", "union", "enum") and nxt is not None and tokens[i + 1][0] == "ID":
+            names.add(nxt)
+            types.add(nxt)
+        if value == "define" and nxt is not None and tokens[i + 1][0] == "ID":
+            names.add(nxt)
+        if value == "enum":
+            j = i + 1
+            while j < n and values[j] not in ("{", ";"):
+                j += 1
+            if j < n and values[j] == "{":
+                depth = 0
+                while j < n:
+                    if values[j] == "{":
+                        depth += 1
+                    elif values[j] == "}":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    elif depth == 1 and tokens[j][0] == "ID" and values[j - 1] in ("{", ","):
+                        names.add(values[j])
+                    j += 1
+        if value == "typedef":
+            j = i + 1
+            while j < n and values[j] != ";":
+                j += 1
+            if tokens[j - 1][0] == "ID":
+                names.add(values[j - 1])
+                types.add(values[j - 1])
+    # Khai báo: kiểu [const/*...] tên [= ...][, [*] tên ...] ; hoặc tên( cho hàm
+    for i, value in enumerate(values):
+        if value not in types:
+            continue
+        j = i + 1
+        while j < n and (values[j] in _C_DECL_SKIP or values[j] in types):
+            j += 1
+        while j < n and tokens[j][0] == "ID" and values[j] not in types:
+            names.add(values[j])
+            depth = 0
+            j += 1
+            while j < n:
+                if values[j] in ("(", "[", "{"):
+                    if depth == 0 and values[j] in ("(", "{"):
+                        j = n
+                        break
+                    depth += 1
+                elif values[j] in (")", "]", "}"):
+                    depth -= 1
+                    if depth < 0:
+                        j = n
+                        break
+                elif depth == 0 and values[j] == ";":
+                    j = n
+                    break
+                elif depth == 0 and values[j] == ",":
+                    j += 1
+                    while j < n and values[j] in _C_DECL_SKIP:
+                        j += 1
+                    break
+                j += 1
+    return names
+
+def lex_source(source_code, language):
+    """
+    Tách mã C/Python (đã bỏ comment) thành token (loại, văn bản, dòng).
+    Tên do bài nộp tự định nghĩa có loại ID; tên từ bên ngoài (builtin, hàm thư viện, thuộc
+    tính/phương thức sau . hoặc ->) có loại NAME; số NUM, chuỗi STR; từ khóa và toán tử giữ
+    nguyên (loại KW/OP). Mã Python lỗi cú pháp không xác định được tên tự định nghĩa nên mọi
+    tên đều là NAME.
+    """
+    python = language.lower() == "python"
+    if python:
+        text, keywords = "\n".join(_strip_python_comments(source_code)), _PY_KEYWORDS
+    else:
+        text, keywords = "\n".join(_strip_c_comments(source_code)), _C_KEYWORDS
+    tokens = []
+    line, last = 1, 0
+    for m in _LEX_RE.finditer(text):
+        line += text.count("\n", last, m.start())
+        last = m.start()
+        kind, value = m.lastgroup, m.group()
+        if kind == "ID" and value in keywords:
+            kind = "KW"
+        tokens.append((kind, value, line))
+    defined = (_python_defined_names(source_code) if python else _c_defined_names(tokens)) or set()
+    return [
+        ("NAME", value, line)
+        if kind == "ID" and (value not in defined or (i and tokens[i - 1][1] in (".", "->"))) else (kind, value, line)
+        for i, (kind, value, line) in enumerate(tokens)
+    ]
+
+def normalized_tokens(tokens):
+    """
+    Chuẩn hóa: tên biến/hàm tự đặt thành ID, số thành NUM, chuỗi thành STR. Tên từ bên
+    ngoài (NAME: max/min, sorted, sqrt, .sort...) giữ nguyên vì đổi chúng là đổi chương trình.
+    """
+    return [kind if kind in ("ID", "NUM", "STR") else value for kind, value, _ in tokens]
+
+class MinHasher:
+    """Chữ ký MinHash trên các shingle k-token, chia band cho LSH."""
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm=64, bands=16, shingle=5, seed=1):
+        rnd = random.Random(seed)
+        self.perms = [(rnd.randrange(1, self.PRIME), rnd.randrange(0, self.PRIME)) for _ in range(num_perm)]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+
+    def signature(self, norm):
+        k = self.shingle
+        grams = {" ".join(norm[i:i + k]) for i in range(max(1, len(norm) - k + 1))}
+        hashes = [int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big") for g in grams]
+        p = self.PRIME
+        return [min((a * h + b) % p for h in hashes) for a, b in self.perms]
+
+    def band_keys(self, signature):
+        return [
+            hashlib.blake2b(repr(signature[i * self.rows:(i + 1) * self.rows]).encode(), digest_size=8).hexdigest()
+            for i in range(self.bands)
+        ]
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        return sum(a == b for a, b in zip(sig_a, sig_b)) / len(sig_a)
+
+class NearDuplicateIndex:
+    """
+    Chỉ mục LSH các bài đã phân tích, tách theo phạm vi (đề bài, ngôn ngữ, model).
+    Mỗi bài lưu chữ ký MinHash, mã nguồn và kết quả (nén zlib); bảng bands cho phép tìm
+    ứng viên bằng vài lần tra index thay vì so với mọi bài cũ.
+    """
+
+    def __init__(self, path, hasher):
+        self.path = path
+        self.hasher = hasher
+        self._conn = SQLiteConnection(path)
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                scope TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                source BLOB NOT NULL,
+                result BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS bands (
+                scope TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                entry_id INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS bands_lookup ON bands (scope, band, bucket)")
+
+    def add(self, scope, signature, source_code, result):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            entry_id = conn.execute(
+                "INSERT INTO entries (scope, signature, source, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                (scope, json.dumps(signature), zlib.compress(source_code.encode('utf-8')),
+                 zlib.compress(json.dumps(result, ensure_ascii=False).encode('utf-8')), time.time()),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO bands (scope, band, bucket, entry_id) VALUES (?, ?, ?, ?)",
+                [(scope, band, bucket, entry_id) for band, bucket in enumerate(self.hasher.band_keys(signature))],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def candidates(self, scope, signature, threshold):
+        """Các bài cũ cùng phạm vi có độ tương đồng ước lượng >= threshold, giống nhất trước."""
+        conn = self._conn()
+        clauses = " OR ".join("(band = ? AND bucket = ?)" for _ in range(self.hasher.bands))
+        params = [scope]
+        for band, bucket in enumerate(self.hasher.band_keys(signature)):
+            params += [band, bucket]
+        ids = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT entry_id FROM bands WHERE scope = ? AND ({clauses}) LIMIT 50", params
+        )]
+        found = []
+        for entry_id in ids:
+            row = conn.execute("SELECT signature, source, result FROM entries WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                continue
+            similarity = self.hasher.similarity(signature, json.loads(row[0]))
+            if similarity >= threshold:
+                found.append((similarity, zlib.decompress(row[1]).decode('utf-8'), row[2]))
+        found.sort(key=lambda item: -item[0])
+        return [(sim, source, json.loads(zlib.decompress(blob))) for sim, source, blob in found]
+
+near_dup_index = NearDuplicateIndex(NEAR_DUP_PATH, MinHasher())
+
+def near_dup_scope(problem_description, language):
+    return hashlib.sha256(json.dumps(
+        [" ".join(problem_description.split()), language, analysis_model_id(), GENERATION_CONFIG], sort_keys=True
+    ).encode('utf-8')).hexdigest()
+
+# Các trường chứa code trong kết quả: tên biến một ký tự chỉ được đổi ở đây
+_CODE_FIELDS = ("code_line", "fixed_code")
+
+def adapt_result(result, old_tokens, new_tokens):
+    """
+    Chuyển kết quả của bài cũ sang bài mới: căn hai dãy token đã chuẩn hóa, suy ra ánh xạ
+    tên biến và số dòng, rồi đổi tên biến trong nội dung và số dòng trong gợi ý sửa lỗi.
+    Trả về None nếu không suy ra được ánh xạ tên nhất quán.
+    """
+    matcher = difflib.SequenceMatcher(None, normalized_tokens(old_tokens), normalized_tokens(new_tokens),
+                                      autojunk=False)
+    names, lines = {}, {}
+    for i, j, size in matcher.get_matching_blocks():
+        for (kind, old, old_line), (_, new, new_line) in zip(old_tokens[i:i + size], new_tokens[j:j + size]):
+            lines.setdefault(old_line, new_line)
+            if kind == "ID":
+                if names.setdefault(old, new) != new:
+                    return None
+    renamed = {old: new for old, new in names.items() if old != new}
+    if len(set(renamed.values())) != len(renamed):
+        return None
+
+    def pattern(min_len):
+        keys = sorted((k for k in renamed if len(k) >= min_len), key=len, reverse=True)
+        return re.compile(r"\b(" + "|".join(map(re.escape, keys)) + r")\b") if keys else None
+
+    prose_re, code_re = pattern(2), pattern(1)
+
+    def rename(value, regex):
+        return regex.sub(lambda m: renamed[m.group()], value) if regex else value
+
+    def walk(node, in_code=False):
+        if isinstance(node, dict):
+            return {
+                (rename(key, code_re) if in_code else key):
+                    walk(value, in_code or key in _CODE_FIELDS or key == "variables")
+                for key, value in node.items()
+            }
+        if isinstance(node, list):
+            return [walk(item, in_code) for item in node]
+        if isinstance(node, str):
+            return rename(node, code_re if in_code else prose_re)
+        return node
+
+    adapted = walk(result)
+    if lines:
+        remap_result_lines(adapted, [lines.get(n, n) for n in range(1, max(lines) + 1)])
+    return adapted
+
+def find_near_duplicate(problem_description, source_code, language):
+    """
+    Tra chỉ mục bài gần trùng. Trả về (result đã chuyển đổi, độ tương đồng, fingerprint) nếu có
+    bài cũ đủ giống và cùng các hằng số (số, chuỗi) và tên ngoài (builtin, thư viện, phương
+    thức); ngược lại (None, 0, fingerprint).
+    fingerprint là (scope, signature) dùng để thêm bài này vào chỉ mục sau khi phân tích.
+    """
+    if not NEAR_DUP_ENABLED or len(source_code) > NEAR_DUP_MAX_CHARS:
+        return None, 0.0, None
+    with STAGE_SECONDS.time(stage="fingerprint"):
+        tokens = lex_source(source_code, language)
+        if len(tokens) < near_dup_index.hasher.shingle:
+            return None, 0.0, None
+        scope = near_dup_scope(problem_description, language)
+        signature = near_dup_index.hasher.signature(normalized_tokens(tokens))
+        # Hằng số khác nhau (ví dụ % 4 và % 100) hay hàm khác nhau (max và min) có thể đổi hẳn
+        # kết luận, nên phải trùng khớp
+        literals = sorted(value for kind, value, _ in tokens if kind in ("NUM", "STR", "NAME"))
+        for similarity, old_source, old_result in near_dup_index.candidates(scope, signature, NEAR_DUP_THRESHOLD):
+            old_tokens = lex_source(old_source, language)
+            if sorted(value for kind, value, _ in old_tokens if kind in ("NUM", "STR", "NAME")) != literals:
+                continue
+            adapted = adapt_result(old_result, old_tokens, tokens)
+            if adapted is not None:
+                return adapted, similarity, (scope, signature)
+    return None, 0.0, (scope, signature)
+
+def run_analysis(problem_description, source_code, language, on_section=None, on_chunk=None,
+                 stats=None, prompt_parts=None, syntax_future=None):
+    """
+    Toàn bộ pipeline phân tích một bài nộp: tra cache, tạo prompt, gọi Gemini, lưu cache.
+    Nếu có on_section, model được gọi ở chế độ streaming và từng phần kết quả được báo
+    qua on_section(key, value), tiến độ qua on_chunk(số ký tự đã nhận).
+    Các bài nộp giống hệt nhau đang chạy đồng thời chỉ tạo một lời gọi Gemini;
+    quota của từng key đã được trừ riêng trước khi vào đây.
+    Bài nộp nhỏ và đơn giản được gửi tới model nhanh, thất bại thì chạy lại bằng model chính.
+    Bài gần trùng một bài đã phân tích (chỉ khác tên biến, định dạng, comment) dùng lại kết quả
+    cũ sau khi đổi tên biến và số dòng cho khớp, không gọi model.
+    stats (nếu có) nhận cache_hit, coalesced, route, model, latency và số token của lời gọi model,
+    near_duplicate (độ tương đồng) khi dùng lại kết quả bài gần trùng, syntax_errors (số lỗi
+    trình biên dịch báo). Lỗi cú pháp tìm được cục bộ được đưa vào prompt; với SYNTAX_FAST_PATH
+    chúng được báo ngay qua on_section trước khi model trả lời;
+    prompt_parts cho phép dùng lại phần đầu/cuối prompt của cùng một đề bài; syntax_future
+    (Future của syntax_executor) cho phép dùng lại lần kiểm tra cú pháp người gọi đã bắt đầu.
+    Trả về (result, error) giống analyze_code_with_gemini.
+    """
+    if stats is not None:
+        stats.update(cache_hit=False, coalesced=False, route=None, model=None, prompt_tokens=0, output_tokens=0)
+    # Bài nộp trùng hoàn toàn (đề bài, mã nguồn, ngôn ngữ, model) được trả từ cache
+    cache_key = make_cache_key(problem_description, source_code, language, analysis_model_id(), GENERATION_CONFIG)
+    result = response_cache.get(cache_key)
+    ANALYSIS_CACHE.inc(cache="response", result="hit" if result is not None else "miss")
+    if result is not None:
+        if stats is not None:
+            stats["cache_hit"] = True
+        if on_section:
+            for key, value in result.items():
+                on_section(key, value)
+        return result, None
+
+    # Kiểm tra cú pháp chạy song song với việc tra bài gần trùng và chờ lease
+    if syntax_future is None:
+        syntax_future = syntax_executor.submit(syntax_checker.check, source_code, language)
+
+    # Bài gần trùng với bài đã phân tích (chỉ khác tên biến, định dạng, comment) dùng lại kết quả
+    result, similarity, fingerprint = find_near_duplicate(problem_description, source_code, language)
+    if fingerprint is not None:
+        ANALYSIS_CACHE.inc(cache="near_duplicate", result="hit" if result is not None else "miss")
+    if result is not None:
+        response_cache.put(cache_key, result)
+        if stats is not None:
+            stats.update(cache_hit=True, near_duplicate=similarity)
+        if on_section:
+            for key, value in result.items():
+                on_section(key, value)
+        return result, None
+
+    if SYNTAX_FAST_PATH and on_section:
+        # Lỗi biên dịch được báo ngay; phần "analysis" của model sẽ thay thế khi có
+        diagnostics = syntax_future.result()
+        if has_syntax_errors(diagnostics):
+            for key, value in precheck_result(diagnostics).items():
+                on_section(key, value)
+
+    def call_model(emit):
+        lease_owner = None
+        if SINGLEFLIGHT_CROSS_PROCESS:
+            lease_owner = uuid.uuid4().hex
+            # Chờ process đang giữ lease phân tích xong rồi lấy kết quả từ cache
+            while not shared_state.claim(f"singleflight.{cache_key}", lease_owner, SINGLEFLIGHT_LEASE_TTL):
+                time.sleep(0.5)
+                cached = response_cache.get(cache_key, record_stats=False)
+                if cached is not None:
+                    for key, value in cached.items():
+                        emit(key, value)
+                    return cached, None
+        try:
+            diagnostics = syntax_future.result()
+            if stats is not None and diagnostics is not None:
+                stats["syntax_errors"] = sum(d["severity"] == "error" for d in diagnostics)
+            prompt, line_map, error = build_prompt_within_budget(
+                problem_description, source_code, language, prompt_parts, diagnostics
+            )
+            if error:
+                return None, error
+            if line_map is not None:
+                # Sửa số dòng trong từng phần streaming về mã gốc
+                emit_section = lambda key, value: emit(key, remap_result_lines({key: value}, line_map)[key])
+            else:
+                emit_section = emit
+
+            def invoke(route, model_name):
+                if stats is not None:
+                    stats.update(route=route, model=model_name)
+                started = time.monotonic()
+                if on_section:
+                    result, error = analyze_code_with_gemini_stream(
+                        model_name, prompt, emit_section, on_chunk, stats
+                    )
+                else:
+                    result, error = analyze_code_with_gemini(model_name, prompt, stats)
+                ROUTE_SECONDS.observe(time.monotonic() - started, route=route, model=model_name)
+                ROUTE_REQUESTS.inc(route=route, model=model_name, outcome="error" if error else "ok")
+                return result, error
+
+            route, model_name = choose_model(prompt, problem_description, source_code)
+            result, error = invoke(route, model_name)
+            if error and route == "fast":
+                # Model nhanh lỗi (thường là JSON không hợp lệ) thì phân tích lại bằng model chính
+                result, error = invoke("fallback", model_name_global)
+            if not error:
+                if line_map is not None:
+                    remap_result_lines(result, line_map)
+                response_cache.put(cache_key, result)
+                if fingerprint is not None:
+                    near_dup_index.add(*fingerprint, source_code, result)
+            return result, error
+        finally:
+            if lease_owner:
+                shared_state.release(f"singleflight.{cache_key}", lease_owner)
+
+    # Nếu leader không streaming, job vẫn lấy đủ các phần từ kết quả cuối cùng
+    (result, error), shared = analysis_flight.do(cache_key, call_model, on_section)
+    if shared and stats is not None:
+        stats["coalesced"] = True
+    if error:
+        return None, error
+    return result, None
+
+def run_analysis_and_store(problem_description, source_code, language, owner, result_id, cache_key,
+                           on_section=None, on_chunk=None, syntax_future=None):
+    """Chạy run_analysis rồi lưu kết quả vào result_store dưới result_id (permalink của job)."""
+    result, error = run_analysis(problem_description, source_code, language,
+                                 on_section=on_section, on_chunk=on_chunk, syntax_future=syntax_future)
+    if not error:
+        result_store.save(owner, problem_description, source_code, language, result,
+                          cache_key=cache_key, result_id=result_id)
+    return result, error
+
+# Lời gọi model đang chạy ở chế độ async, theo khóa cache: bài nộp giống hệt nhau đồng
+# thời chỉ tạo một lời gọi (tương đương analysis_flight, trong một event loop)
+_async_flights = {}
+
+async def run_analysis_async(problem_description, source_code, language, stats=None, on_section=None,
+                             on_chunk=None, syntax_task=None):
+    """
+    Bản async của run_analysis cho asgi.py. Lời gọi Gemini chạy trên event loop (không
+    streaming); tra cache, kiểm tra cú pháp, tạo prompt và các thao tác SQLite chạy bằng
+    asyncio.to_thread nên không chặn loop. Với on_section (job), lỗi biên dịch được báo
+    trước khi gọi model nếu bật SYNTAX_FAST_PATH, các phần kết quả được báo khi có kết quả;
+    on_chunk không được gọi. syntax_task (awaitable) là lần kiểm tra cú pháp người gọi đã
+    bắt đầu, được dùng lại thay vì kiểm tra lần nữa. Trả về (result, error).
+    """
+    def emit_all(result):
+        if on_section:
+            for key, value in result.items():
+                on_section(key, value)
+        return result, None
+
+    if stats is not None:
+        stats.update(cache_hit=False, coalesced=False, route=None, model=None, prompt_tokens=0, output_tokens=0)
+    cache_key = make_cache_key(problem_description, source_code, language, analysis_model_id(), GENERATION_CONFIG)
+    result = await asyncio.to_thread(response_cache.get, cache_key)
+    ANALYSIS_CACHE.inc(cache="response", result="hit" if result is not None else "miss")
+    if result is not None:
+        if stats is not None:
+            stats["cache_hit"] = True
+        return emit_all(result)
+
+    if syntax_task is None:
+        syntax_task = asyncio.wrap_future(syntax_executor.submit(syntax_checker.check, source_code, language))
+    result, similarity, fingerprint = await asyncio.to_thread(
+        find_near_duplicate, problem_description, source_code, language
     )
+    if fingerprint is not None:
+        ANALYSIS_CACHE.inc(cache="near_duplicate", result="hit" if result is not None else "miss")
+    if result is not None:
+        await asyncio.to_thread(response_cache.put, cache_key, result)
+        if stats is not None:
+            stats.update(cache_hit=True, near_duplicate=similarity)
+        return emit_all(result)
 
-@app.route('/', methods=['GET'])
-def index():
-    if not model_name_global:
+    if SYNTAX_FAST_PATH and on_section:
+        diagnostics = await asyncio.shield(syntax_task)
+        if has_syntax_errors(diagnostics):
+            for key, value in precheck_result(diagnostics).items():
+                on_section(key, value)
+
+    async def call_model():
+        lease_owner = None
+        if SINGLEFLIGHT_CROSS_PROCESS:
+            lease_owner = uuid.uuid4().hex
+            while not await asyncio.to_thread(shared_state.claim, f"singleflight.{cache_key}", lease_owner, SINGLEFLIGHT_LEASE_TTL):
+                await asyncio.sleep(0.5)
+                cached = await asyncio.to_thread(response_cache.get, cache_key, record_stats=False)
+                if cached is not None:
+                    return cached, None
+        try:
+            diagnostics = await syntax_task
+            if stats is not None and diagnostics is not None:
+                stats["syntax_errors"] = sum(d["severity"] == "error" for d in diagnostics)
+            prompt, line_map, error = await asyncio.to_thread(
+                build_prompt_within_budget, problem_description, source_code, language, None, diagnostics
+            )
+            if error:
+                return None, error
+
+            async def invoke(route, model_name):
+                if stats is not None:
+                    stats.update(route=route, model=model_name)
+                started = time.monotonic()
+                result, error = await analyze_code_with_gemini_async(model_name, prompt, stats)
+                ROUTE_SECONDS.observe(time.monotonic() - started, route=route, model=model_name)
+                ROUTE_REQUESTS.inc(route=route, model=model_name, outcome="error" if error else "ok")
+                return result, error
+
+            # choose_model có thể gọi count_tokens (mạng) nên cũng chạy trong thread
+            route, model_name = await asyncio.to_thread(choose_model, prompt, problem_description, source_code)
+            result, error = await invoke(route, model_name)
+            if error and route == "fast":
+                result, error = await invoke("fallback", model_name_global)
+            if not error:
+                if line_map is not None:
+                    remap_result_lines(result, line_map)
+                await asyncio.to_thread(response_cache.put, cache_key, result)
+                if fingerprint is not None:
+                    await asyncio.to_thread(near_dup_index.add, *fingerprint, source_code, result)
+            return result, error
+        finally:
+            if lease_owner:
+                await asyncio.to_thread(shared_state.release, f"singleflight.{cache_key}", lease_owner)
+
+    task = _async_flights.get(cache_key)
+    if task is None:
+        task = _async_flights[cache_key] = asyncio.ensure_future(call_model())
+        task.add_done_callback(lambda _: _async_flights.pop(cache_key, None))
+    elif stats is not None:
+        stats["coalesced"] = True
+    # shield: client ngắt kết nối không hủy lời gọi mà các request khác đang chờ
+    result, error = await asyncio.shield(task)
+    if error:
+        return None, error
+    return emit_all(result)
+
+async def run_analysis_and_store_async(problem_description, source_code, language, owner, result_id, cache_key,
+                                       on_section=None, on_chunk=None, syntax_task=None):
+    """Bản async của run_analysis_and_store (job chạy trên event loop của asgi.py)."""
+    result, error = await run_analysis_async(problem_description, source_code, language,
+                                             on_section=on_section, on_chunk=on_chunk, syntax_task=syntax_task)
+    if not error:
+        await asyncio.to_thread(result_store.save, owner, problem_description, source_code, language, result,
+                                cache_key=cache_key, result_id=result_id)
+    return result, error
+
+# Cấu hình chế độ phân tích bất đồng bộ (job)
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '4'))
+ANALYSIS_QUEUE_MAX = int(os.getenv('ANALYSIS_QUEUE_MAX', '100'))
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+# Chu kỳ (giây) kiểm tra job chạy ở worker process khác khi chờ trạng thái mới
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.25'))
+JOB_STORE_PATH = os.path.join(DATA_DIR, 'jobs.sqlite3')
+# Stream SSE /jobs/<id>/events giữ một thread xử lý request suốt thời gian job chạy, nên
+# với worker WSGI đồng bộ (gunicorn sync/gthread) mặc định tắt: trang chờ polling /jobs/<id>.
+# asgi.py bật lại vì ở đó mỗi stream chỉ là một coroutine. Bật thủ công khi chạy WSGI với
+# worker không giới hạn kết nối (gevent/eventlet).
+JOB_EVENTS_STREAM = os.getenv('JOB_EVENTS_STREAM', '0') == '1'
+
+class JobManager:
+    """
+    Hàng đợi phân tích chạy nền: mỗi job chạy trên một pool thread có giới hạn,
+    thread xử lý request chỉ nhận job và trả job ID ngay lập tức.
+    Hàm của job nhận thêm on_section/on_chunk để công bố kết quả từng phần.
+    Job chạy trong process đã nhận nó, nhưng trạng thái và các phần kết quả được ghi vào
+    SQLite dùng chung (path), nên mọi worker process đều trả lời được /jobs/<id> và SSE của
+    job: process đang chạy job chờ bằng Condition, process khác hỏi lại DB mỗi
+    poll_interval giây. Job bị xóa sau ttl giây kể từ lần cập nhật cuối.
+    Ở chế độ ASGI (asgi.py), submit_async chạy job là coroutine trên event loop và
+    wait_async cho phép chờ job mà không giữ thread.
+    """
+
+    # Tiến độ streaming (received_chars) được ghi xuống DB tối đa mỗi chừng này giây
+    PROGRESS_PERSIST_INTERVAL = 0.5
+
+    def __init__(self, workers, max_pending, ttl, path, poll_interval):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.path = path
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis')
+        self._jobs = {}
+        self._persisted = {}         # job_id -> thời điểm ghi DB gần nhất
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._async_waiters = set()  # (loop, asyncio.Event) của các wait_async đang chờ
+        self._tasks = set()          # giữ tham chiếu tới các job async đang chạy
+        self._conn = SQLiteConnection(path)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    def _persist(self, job):
+        # Chỉ ghi nếu mới hơn bản trong DB: các thread báo cùng một job có thể ghi lệch thứ tự
+        self._conn().execute(
+            "INSERT INTO jobs (id, data, version, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, version = excluded.version, "
+            "expires_at = excluded.expires_at WHERE excluded.version > jobs.version",
+            (job["id"], json.dumps(job, ensure_ascii=False), job["version"], time.time() + self.ttl),
+        )
+
+    def submit(self, fn, *args, **info):
+        """Đưa job vào hàng đợi. Trả về job ID, hoặc None nếu hàng đợi đã đầy."""
+        job_id = self._register(info)
+        if job_id is not None:
+            self._executor.submit(self._run, job_id, fn, args)
+        return job_id
+
+    def submit_async(self, fn, *args, **info):
+        """
+        Như submit nhưng fn là hàm async, chạy trên event loop hiện tại (phải gọi từ trong loop).
+        """
+        job_id = self._register(info)
+        if job_id is not None:
+            task = asyncio.ensure_future(self._run_async(job_id, fn, args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    def _register(self, info):
+        with self._cond:
+            self._purge()
+            if self._pending >= self.max_pending:
+                return None
+            job_id = uuid.uuid4().hex
+            job = self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+                "sections": {},
+                "received_chars": 0,
+                "version": 0,
+                "kind": "analysis",
+                **info,
+            }
+            self._pending += 1
+            snapshot = self._snapshot(job)
+        self._persist(snapshot)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            result, error = fn(
+                *args,
+                on_section=lambda key, value: self._add_section(job_id, key, value),
+                on_chunk=lambda received: self._progress(job_id, received),
+            )
+        except Exception as e:
+            result, error = None, f"Lỗi không mong muốn: {e}"
+        self._finish(job_id, result, error)
+
+    async def _run_async(self, job_id, fn, args):
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            result, error = await fn(
+                *args,
+                on_section=lambda key, value: self._add_section(job_id, key, value),
+                on_chunk=lambda received: self._progress(job_id, received),
+            )
+        except Exception as e:
+            result, error = None, f"Lỗi không mong muốn: {e}"
+        self._finish(job_id, result, error)
+
+    def _finish(self, job_id, result, error):
+        with self._cond:
+            self._pending -= 1
+        self._update(
+            job_id,
+            status="error" if error else "done",
+            result=result,
+            error=error,
+            finished_at=time.time(),
+        )
+
+    def _notify(self):
+        # Gọi khi đang giữ self._cond
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop đã đóng
+                pass
+
+    def _update(self, job_id, persist=True, **changes):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(changes)
+            job["version"] += 1
+            self._notify()
+            snapshot = self._snapshot(job) if persist else None
+        if snapshot is not None:
+            self._persisted[job_id] = time.monotonic()
+            self._persist(snapshot)
+
+    def _progress(self, job_id, received):
+        # Process đang chạy job thấy mọi chunk; process khác chỉ cần tiến độ thưa hơn
+        due = time.monotonic() - self._persisted.get(job_id, 0.0) >= self.PROGRESS_PERSIST_INTERVAL
+        self._update(job_id, persist=due, received_chars=received)
+
+    def _add_section(self, job_id, key, value):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["sections"][key] = value
+            job["version"] += 1
+            self._notify()
+            snapshot = self._snapshot(job)
+        self._persist(snapshot)
+
+    @staticmethod
+    def _snapshot(job):
+        return dict(job, sections=dict(job["sections"])) if job is not None else None
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._persisted.pop(job_id, None)
+        self._conn().execute("DELETE FROM jobs WHERE expires_at < ?", (time.time(),))
+
+    def _load(self, job_id):
+        row = self._conn().execute(
+            "SELECT data FROM jobs WHERE id = ? AND expires_at >= ?", (job_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._snapshot(job)
+        return self._load(job_id)
+
+    def wait(self, job_id, version, timeout):
+        """Chờ tới khi job có version mới hơn `version` (hoặc hết timeout)."""
+        with self._cond:
+            if job_id in self._jobs:
+                self._cond.wait_for(
+                    lambda: job_id not in self._jobs or self._jobs[job_id]["version"] > version,
+                    timeout=timeout,
+                )
+                return self._snapshot(self._jobs.get(job_id))
+        # Job của process khác: hỏi lại DB theo chu kỳ
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._load(job_id)
+            if job is None or job["version"] > version or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    async def wait_async(self, job_id, version, timeout):
+        """Bản async của wait: chờ trên event loop, không giữ thread."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        with self._cond:
+            local = job_id in self._jobs
+        if not local:
+            while True:
+                job = await asyncio.to_thread(self._load, job_id)
+                if job is None or job["version"] > version or loop.time() >= deadline:
+                    return job
+                await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - loop.time())))
+
+        waiter = (loop, asyncio.Event())
+        with self._cond:
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                with self._cond:
+                    job = self._jobs.get(job_id)
+                    if job is None or job["version"] > version:
+                        return self._snapshot(job)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return self.get(job_id)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+
+job_manager = JobManager(ANALYSIS_WORKERS, ANALYSIS_QUEUE_MAX, JOB_TTL, JOB_STORE_PATH, JOB_POLL_INTERVAL)
+
+def job_status(job, url=None):
+    """
+    Phần trạng thái job trả cho client (không kèm kết quả phân tích).
+    url dựng đường dẫn theo endpoint của app Flask (mặc định url_for; asgi.py truyền hàm
+    của nó vì không có request context của Flask).
+    """
+    url = url or url_for
+    status = {k: job[k] for k in ("id", "kind", "status", "created_at", "started_at", "finished_at", "error")}
+    status["status_url"] = url('job_status_view', job_id=job["id"])
+    status["result_url"] = url('job_result', job_id=job["id"])
+    if JOB_EVENTS_STREAM:
+        status["events_url"] = url('job_events', job_id=job["id"])
+    if job.get("result_id") and job["status"] == "done":
+        status["permalink_url"] = url('result_view', result_id=job["result_id"])
+    if job.get("owner"):
+        status["history_url"] = url('history', owner=job["owner"])
+    return status
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class JobEventStream:
+    """
+    Nội dung stream SSE /jobs/<id>/events, dùng chung cho main.py và asgi.py: nhận lần lượt
+    các snapshot job (từ JobManager.wait hoặc wait_async) và trả các event cần gửi.
+    Các phần kết quả render thẳng bằng jinja_env của app nên không cần request context.
+    """
+
+    def __init__(self, url=None):
+        self.url = url          # như tham số url của job_status
+        self.version = -1
+        self.received = 0
+        self.sent = {}
+        self.finished = False
+
+    def _render_sections(self, sections, language):
+        for name in RESULT_SECTIONS:
+            # Phần đã gửi được gửi lại nếu nội dung đổi (phần tạm từ kiểm tra cú pháp)
+            if name in sections and self.sent.get(name) != sections[name]:
+                self.sent[name] = sections[name]
+                with STAGE_SECONDS.time(stage="render"):
+                    html = app.jinja_env.get_template(f'sections/{name}.html').render(
+                        result={name: sections[name]}, language=language, text_to_html=text_to_html)
+                yield sse("section", {"name": name, "html": html})
+
+    def events(self, job):
+        if job["version"] == self.version:
+            # Giữ kết nối sống qua proxy
+            yield ": keep-alive\n\n"
+            return
+        self.version = job["version"]
+        if job["received_chars"] != self.received:
+            self.received = job["received_chars"]
+            yield sse("progress", {"received_chars": self.received})
+        yield from self._render_sections(job["sections"], job["language"])
+        if job["status"] == "done" and job["kind"] == "analysis":
+            # Phần nào parser chưa kịp tách thì lấy từ kết quả cuối cùng
+            yield from self._render_sections(job["result"], job["language"])
+        yield sse("status", job_status(job, url=self.url))
+        self.finished = job["status"] in ("done", "error")
+
+# Cấu hình phân tích theo lô (chấm cả lớp)
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '200'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+
+def summarize_analysis(result):
+    analysis = (result or {}).get("analysis") or {}
+    return {
+        "meets_requirements": bool(analysis.get("meets_requirements")),
+        "syntax_errors": len(analysis.get("syntax_errors") or []),
+        "logical_errors": len(analysis.get("logical_errors") or []),
+        "runtime_errors": len(analysis.get("runtime_errors") or []),
+    }
+
+def run_batch(problem_description, items, on_section=None, on_chunk=None):
+    """
+    Phân tích nhiều bài nộp cho cùng một đề bài với số luồng giới hạn (BATCH_CONCURRENCY);
+    lời gọi Gemini còn bị giới hạn chung bởi upstream_slots. Phần đầu/cuối prompt được
+    dựng một lần cho mỗi ngôn ngữ và dùng lại cho mọi bài nộp.
+    Trả về (report, None) với độ trễ, token và lỗi của từng bài.
+    """
+    started = time.monotonic()
+    prompt_parts = {}
+    for item in items:
+        if item["language"] not in prompt_parts:
+            prompt_parts[item["language"]] = create_prompt_parts(problem_description, item["language"])
+
+    def analyze_item(item):
+        report = {k: item[k] for k in ("index", "student", "language")}
+        if item.get("error"):
+            report.update(status="error", error=item["error"], result=None)
+            return report
+        stats = {}
+        item_started = time.monotonic()
+        result, error = run_analysis(
+            problem_description, item["source_code"], item["language"],
+            stats=stats, prompt_parts=prompt_parts[item["language"]],
+        )
+        report.update(
+            status="error" if error else "ok",
+            error=error,
+            latency_ms=round((time.monotonic() - item_started) * 1000),
+            queue_wait_ms=round(stats.get("queue_wait", 0.0) * 1000),
+            cache_hit=stats.get("cache_hit", False),
+            coalesced=stats.get("coalesced", False),
+            prompt_tokens=stats.get("prompt_tokens", 0),
+            output_tokens=stats.get("output_tokens", 0),
+            result=result,
+        )
+        if result:
+            report.update(summarize_analysis(result))
+        return report
+
+    with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch') as pool:
+        reports = list(pool.map(analyze_item, items))
+
+    succeeded = [r for r in reports if r["status"] == "ok"]
+    summary = {
+        "total": len(reports),
+        "succeeded": len(succeeded),
+        "failed": len(reports) - len(succeeded),
+        "meets_requirements": sum(1 for r in succeeded if r.get("meets_requirements")),
+        "cache_hits": sum(1 for r in succeeded if r["cache_hit"]),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in succeeded),
+        "output_tokens": sum(r["output_tokens"] for r in succeeded),
+        "wall_time_ms": round((time.monotonic() - started) * 1000),
+    }
+    return {"problem_description": problem_description, "summary": summary, "items": reports}, None
+
+# Phiên bản template trang kết quả: sửa template thì trang đã render trong cache bị bỏ qua
+RESULT_TEMPLATES = ('result.html',) + tuple(f'sections/{name}.html' for name in RESULT_SECTIONS)
+
+def result_template_version():
+    digest = hashlib.sha256()
+    for name in RESULT_TEMPLATES:
+        with open(os.path.join(app.root_path, app.template_folder, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+RESULT_TEMPLATE_VERSION = result_template_version()
+
+def compress_html(html):
+    """Nén trang HTML một lần: trả về (etag, gzip, brotli hoặc None)."""
+    data = html.encode('utf-8')
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    # mtime=0 để cùng nội dung luôn ra cùng byte gzip
+    html_gzip = gzip.compress(data, compresslevel=6, mtime=0)
+    html_br = brotli.compress(data, quality=5) if brotli else None
+    return etag, html_gzip, html_br
+
+def render_result_page(result, language, cache_key=None):
+    """
+    Render trang kết quả, dùng lại bản đã render và nén trong cache phản hồi nếu có.
+    Bản render được gắn với phiên bản template và hash của chính kết quả: sau khi cùng
+    cache_key được phân tích lại, permalink của kết quả cũ không nhận trang của kết quả mới.
+    Trả về (etag, gzip, br) để gửi bằng send_html.
+    """
+    if cache_key:
+        digest = hashlib.sha256(json.dumps(result, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        version = f"{RESULT_TEMPLATE_VERSION}-{digest.hexdigest()[:16]}"
+        rendered = response_cache.get_rendered(cache_key, version)
+        ANALYSIS_CACHE.inc(cache="rendered", result="hit" if rendered is not None else "miss")
+        if rendered is not None:
+            return rendered
+    with STAGE_SECONDS.time(stage="render"):
+        html = render_template('result.html', result=result, language=language, text_to_html=text_to_html)
+    rendered = compress_html(html)
+    if cache_key:
+        response_cache.put_rendered(cache_key, version, *rendered)
+    return rendered
+
+def send_html(rendered):
+    """
+    Gửi trang đã nén theo Accept-Encoding của client, kèm ETag mạnh cho từng kiểu nén;
+    GET lại với If-None-Match khớp chỉ nhận 304.
+    """
+    etag, html_gzip, html_br = rendered
+    if html_br is not None and request.accept_encodings['br']:
+        body, encoding = html_br, 'br'
+    elif request.accept_encodings['gzip']:
+        body, encoding = html_gzip, 'gzip'
+    else:
+        body, encoding = None, None
+    etag = f"{etag}-{encoding}" if encoding else etag
+
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body if body is not None else gzip.decompress(html_gzip), mimetype='text/html')
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # Trình duyệt luôn hỏi lại server, nhưng chỉ tải lại khi nội dung đổi
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def read_analysis_form(form=None):
+    form = request.form if form is None else form
+    problem = form.get('problem_description','').strip()
+    code    = form.get('source_code','').strip()
+    lang    = form.get('language','Python')
+    return problem, code, lang
+
+def index_status():
+    """Dòng trạng thái API trên trang chủ: (api_status, api_status_class)."""
+    api_ok, _ = api_health.get()
+    api_status_class = None
+    if not model_name_global or api_ok is False:
         api_status = "API Key không hợp lệ hoặc model không khả dụng. Vui lòng kiểm tra console."
+    elif api_ok is None:
+        api_status = f"Đang kiểm tra kết nối Gemini... Model: {model_name_global}"
+        api_status_class = "pending"
     else:
         api_status = f"API Key hợp lệ. Model: {model_name_global}"
-    return render_template('index.html', api_status=api_status)
+        if routing_enabled():
+            api_status += f" (bài nộp nhỏ: {GEMINI_FAST_MODEL})"
+    return api_status, api_status_class
+
+@app.route('/', methods=['GET'])
+def index():
+    api_status, api_status_class = index_status()
+    return render_template('index.html', api_status=api_status, api_status_class=api_status_class)
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
@@ -186,19 +3061,190 @@ def analyze():
     if not model_name_global:
         return render_template('result.html', error_message="Lỗi: Gemini API chưa được cấu hình đúng.", text_to_html=text_to_html)
 
-    problem = request.form.get('problem_description','').strip()
-    code    = request.form.get('source_code','').strip()
-    lang    = request.form.get('language','Python')
+    problem, code, lang = read_analysis_form()
 
     if not problem or not code:
         return render_template('index.html', error_message="Vui lòng nhập đề bài và mã nguồn.", api_status=f"Model: {model_name_global}")
 
-    prompt = create_prompt(problem, code, lang)
-    result, error = analyze_code_with_gemini(model_name_global, prompt)
+    cache_key = make_cache_key(problem, code, lang, analysis_model_id(), GENERATION_CONFIG)
+    syntax_future = None
+    if SYNTAX_FAST_PATH and response_cache.get(cache_key, record_stats=False) is None:
+        # Kiểm tra cú pháp trên syntax_executor; run_analysis dùng lại kết quả nên trình
+        # biên dịch chỉ chạy một lần, và bài đã có trong cache không phải chờ nó
+        syntax_future = syntax_executor.submit(syntax_checker.check, code, lang)
+        if has_syntax_errors(syntax_future.result()):
+            # Mã không biên dịch được: chuyển sang trang job để thấy lỗi biên dịch ngay,
+            # phân tích của model chạy nền và hiện dần trên cùng trang
+            owner, result_id = owner_id(user_key), uuid.uuid4().hex
+            job_id = job_manager.submit(functools.partial(run_analysis_and_store, syntax_future=syntax_future),
+                                        problem, code, lang, owner, result_id, cache_key,
+                                        language=lang, cache_key=cache_key, owner=owner, result_id=result_id)
+            if job_id is not None:
+                return redirect(url_for('job_result', job_id=job_id), code=303)
+
+    result, error = run_analysis(problem, code, lang, syntax_future=syntax_future)
     if error:
         return render_template('result.html', error_message=f"Lỗi phân tích: {error}", text_to_html=text_to_html)
 
-    return render_template('result.html', result=result, language=lang, text_to_html=text_to_html)
+    # Lưu kết quả rồi chuyển sang permalink: tải lại trang không phân tích lại, không tốn quota
+    result_id = result_store.save(owner_id(user_key), problem, code, lang, result, cache_key)
+    return redirect(url_for('result_view', result_id=result_id), code=303)
+
+@app.route('/analyze/submit', methods=['POST'])
+def analyze_submit():
+    user_key = request.form.get('api_key', '').strip()
+    problem, code, lang = read_analysis_form()
+    if not problem or not code:
+        return jsonify(error="Vui lòng nhập đề bài và mã nguồn."), 400
+    if not model_name_global:
+        return jsonify(error="Lỗi: Gemini API chưa được cấu hình đúng."), 503
+
+    valid, err = validate_and_consume_key(user_key)
+    if not valid:
+        return jsonify(error=err), 403
+
+    cache_key = make_cache_key(problem, code, lang, analysis_model_id(), GENERATION_CONFIG)
+    owner, result_id = owner_id(user_key), uuid.uuid4().hex
+    job_id = job_manager.submit(run_analysis_and_store, problem, code, lang, owner, result_id, cache_key,
+                                language=lang, cache_key=cache_key, owner=owner, result_id=result_id)
+    if job_id is None:
+        quota_ledger.refund(user_key)
+        resp = jsonify(error="Hệ thống đang quá tải, vui lòng thử lại sau.")
+        resp.headers['Retry-After'] = '10'
+        return resp, 503
+
+    return jsonify(job_status(job_manager.get(job_id))), 202
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    payload = request.get_json(silent=True) or {}
+    user_key = str(payload.get('api_key', '')).strip()
+    problem = str(payload.get('problem_description', '')).strip()
+    entries = payload.get('items')
+    if not problem or not isinstance(entries, list) or not entries:
+        return jsonify(error="Cần problem_description và danh sách items (student, source_code, language)."), 400
+    if len(entries) > BATCH_MAX_ITEMS:
+        return jsonify(error=f"Tối đa {BATCH_MAX_ITEMS} bài nộp mỗi lô."), 400
+    if not model_name_global:
+        return jsonify(error="Lỗi: Gemini API chưa được cấu hình đúng."), 503
+    if not quota_ledger.knows(user_key):
+        return jsonify(error="API Key không hợp lệ."), 403
+
+    # Mỗi bài nộp tốn một lượt của key; bài vượt quota được báo lỗi riêng
+    items, charged = [], 0
+    for index, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        item = {
+            "index": index,
+            "student": str(entry.get('student') or f"#{index + 1}"),
+            "language": str(entry.get('language') or 'Python'),
+            "source_code": str(entry.get('source_code', '')).strip(),
+        }
+        if not item["source_code"]:
+            item["error"] = "Thiếu mã nguồn."
+        else:
+            valid, err = validate_and_consume_key(user_key)
+            if valid:
+                charged += 1
+            else:
+                item["error"] = err
+        items.append(item)
+
+    job_id = job_manager.submit(run_batch, problem, items, language=None, kind="batch")
+    if job_id is None:
+        for _ in range(charged):
+            quota_ledger.refund(user_key)
+        resp = jsonify(error="Hệ thống đang quá tải, vui lòng thử lại sau.")
+        resp.headers['Retry-After'] = '10'
+        return resp, 503
+
+    return jsonify(job_status(job_manager.get(job_id))), 202
+
+@app.route('/result/<result_id>', methods=['GET'])
+def result_view(result_id):
+    record = result_store.get(result_id)
+    if record is None:
+        abort(404)
+    if request.args.get('format') == 'json':
+        # Permalink ai có link cũng mở được: không kèm mã nguồn của bài nộp
+        record.pop("source_code", None)
+        return jsonify(record)
+    return send_html(render_result_page(record["result"], record["language"], record["cache_key"]))
+
+@app.route('/history/<owner>', methods=['GET'])
+def history(owner):
+    try:
+        before = float(request.args['before']) if 'before' in request.args else None
+    except ValueError:
+        abort(400)
+    items, next_before = result_store.history(owner, before)
+    next_url = url_for('history', owner=owner, before=repr(next_before)) if next_before is not None else None
+    if request.args.get('format') == 'json':
+        for item in items:
+            item["url"] = url_for('result_view', result_id=item["id"])
+        return jsonify(items=items, next_url=next_url)
+    return render_template('history.html', items=items, next_url=next_url, first_page=before is None)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_view(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    if job["status"] == "error":
+        return render_template('result.html', error_message=f"Lỗi phân tích: {job['error']}", text_to_html=text_to_html)
+    wants_json = request.args.get('format') == 'json'
+    if job["status"] != "done":
+        if wants_json:
+            return jsonify(job_status(job)), 202
+        # Trang chờ: result.js nhận từng phần kết quả qua SSE và hiển thị dần
+        sections = RESULT_SECTIONS if job["kind"] == "analysis" else ()
+        return render_template('result.html', pending_job=job_status(job), result_sections=sections,
+                               text_to_html=text_to_html), 202
+    if job["kind"] == "batch":
+        if wants_json:
+            return jsonify(job["result"])
+        with STAGE_SECONDS.time(stage="render"):
+            html = render_template('batch_result.html', report=job["result"], text_to_html=text_to_html)
+        return send_html(compress_html(html))
+    if wants_json:
+        return jsonify(job["result"])
+    return send_html(render_result_page(job["result"], job["language"], job.get("cache_key")))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # Tắt stream thì client dùng status_url (xem JOB_EVENTS_STREAM)
+    if not JOB_EVENTS_STREAM or job_manager.get(job_id) is None:
+        abort(404)
+
+    def generate():
+        stream = JobEventStream()
+        while not stream.finished:
+            job = job_manager.wait(job_id, stream.version, timeout=15)
+            if job is None:
+                return
+            yield from stream.events(job)
+
+    # url_for trong job_status cần request context khi generator chạy
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     # Khi chạy trực tiếp, Flask sẽ serve ở port trong .env hoặc 5001 mặc định
@@ -0,0 +1,191 @@
+"""
+So sánh bộ nhớ mỗi request đang chờ Gemini giữa server Flask đa luồng (main:app, mỗi
+request một OS thread) và chế độ ASGI (asgi:app trên uvicorn, mỗi request một coroutine).
+
+Script tự chạy others/fake_gemini_server.py với độ trễ cố định đủ dài để mọi request cùng
+lúc đang chờ upstream, rồi cho N client chạy đồng thời theo đúng luồng của trình duyệt
+(static/js/index.js): POST /analyze/submit (mã nguồn khác nhau để không trúng cache) rồi giữ
+kết nối SSE /jobs/<id>/events tới khi job xong. RSS và số thread của process server được đo
+trong lúc các client đang chờ.
+Bộ nhớ mỗi request = (RSS đỉnh - RSS lúc nghỉ) / N. Đọc RSS từ /proc nên chỉ chạy trên Linux.
+Mỗi request tốn một lượt của --api-key như request thật; server đo dùng bản sao key.json
+trong thư mục tạm (KEY_FILE) với KEY_USAGE_LIMIT được nâng, nên key.json của repo không đổi.
+
+Cách chạy (từ thư mục gốc của repo, cần `pip install quart uvicorn asgiref`):
+  python others/bench_asgi_memory.py --api-key <key> --concurrency 50 200 500
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "flask-threaded": lambda port: [sys.executable, "-m", "flask", "--app", "main", "run",
+                                    "--port", str(port), "--with-threads", "--no-reload"],
+    "asgi-uvicorn": lambda port: [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port),
+                                  "--log-level", "warning", "--no-access-log"],
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_port(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"Process {proc.args[:3]} đã dừng (mã {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit(f"Không khởi động được {proc.args[:3]}")
+
+def proc_status(pid):
+    """(RSS tính bằng MB, số thread) của process từ /proc/<pid>/status."""
+    rss = threads = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return rss, threads
+
+def submit_and_follow(base, form, timeout, results, index):
+    """Luồng của trình duyệt: gửi job rồi theo dõi SSE tới sự kiện status cuối cùng."""
+    try:
+        resp = requests.post(base + "/analyze/submit", data=form, timeout=timeout)
+        if resp.status_code != 202:
+            results[index] = False
+            return
+        event = None
+        with requests.get(base + resp.json()["events_url"], stream=True, timeout=timeout) as events:
+            for line in events.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: ") and event == "status":
+                    status = json.loads(line[len("data: "):])["status"]
+                    if status in ("done", "error"):
+                        results[index] = status == "done"
+                        return
+        results[index] = False
+    except requests.RequestException:
+        results[index] = False
+
+def run_server(label, args, concurrency, env):
+    port = free_port()
+    proc = subprocess.Popen(SERVERS[label](port), cwd=REPO_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port, proc)
+        base = f"http://127.0.0.1:{port}"
+        form = {"api_key": args.api_key, "problem_description": "Tính tổng hai số", "language": "Python"}
+        # Làm nóng: import lười, kết nối upstream, template
+        requests.get(base + "/", timeout=30)
+        submit_and_follow(base, dict(form, source_code="print(1 + 2)"), args.latency + 30, [None], 0)
+        time.sleep(0.5)
+        idle_rss, idle_threads = proc_status(proc.pid)
+
+        results = [None] * concurrency
+        senders = [
+            threading.Thread(target=submit_and_follow, daemon=True, args=(
+                base,
+                dict(form, source_code=f"x = {i}\nprint(x + {i})"),
+                args.latency + 60, results, i,
+            ))
+            for i in range(concurrency)
+        ]
+        started = time.monotonic()
+        for sender in senders:
+            sender.start()
+        peak_rss, peak_threads = idle_rss, idle_threads
+        while any(sender.is_alive() for sender in senders):
+            rss, threads = proc_status(proc.pid)
+            peak_rss, peak_threads = max(peak_rss, rss), max(peak_threads, threads)
+            time.sleep(0.1)
+        elapsed = time.monotonic() - started
+        return {
+            "label": label,
+            "concurrency": concurrency,
+            "ok": sum(1 for r in results if r),
+            "elapsed": elapsed,
+            "idle_rss": idle_rss,
+            "peak_rss": peak_rss,
+            "per_request_kb": 1024 * (peak_rss - idle_rss) / concurrency,
+            "peak_threads": peak_threads,
+        }
+    finally:
+        proc.kill()
+        proc.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Bộ nhớ mỗi request đang chờ: Flask đa luồng và ASGI")
+    parser.add_argument("--api-key", required=True, help="API key người dùng (trong key.json)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200],
+                        help="Số request đồng thời (có thể nhiều giá trị)")
+    parser.add_argument("--latency", type=float, default=5.0, help="Độ trễ cố định của server giả (giây)")
+    parser.add_argument("--servers", nargs="+", choices=sorted(SERVERS), default=sorted(SERVERS))
+    args = parser.parse_args()
+    if not os.path.exists("/proc/self/status"):
+        sys.exit("Cần /proc (Linux) để đo RSS")
+
+    fake_port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "others", "fake_gemini_server.py"),
+         "--port", str(fake_port), "--latency", f"fixed:{args.latency}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    wait_port(fake_port, fake)
+    rows = []
+    try:
+        for concurrency in args.concurrency:
+            for label in args.servers:
+                data_dir = tempfile.mkdtemp(prefix="bench-asgi-")
+                key_file = os.path.join(data_dir, "key.json")
+                shutil.copy(os.environ.get("KEY_FILE", os.path.join(REPO_DIR, "key.json")), key_file)
+                env = dict(
+                    os.environ,
+                    DATA_DIR=data_dir,
+                    KEY_FILE=key_file,
+                    GEMINI_API_ENDPOINT=f"http://127.0.0.1:{fake_port}",
+                    GEMINI_BACKEND="rest",
+                    KEY_USAGE_LIMIT="1000000",
+                    GEMINI_RPM="0",
+                    GEMINI_HEDGE="0",
+                    NEAR_DUP_ENABLED="0",
+                    # Cả hai chế độ đều được phép giữ đủ N lời gọi upstream cùng lúc
+                    UPSTREAM_MAX_CONCURRENCY=str(concurrency),
+                    GEMINI_REST_POOL=str(concurrency),
+                    ASYNC_UPSTREAM_MAX_CONCURRENCY=str(concurrency),
+                    # Chế độ WSGI chạy job trên pool thread: đủ N worker để không xếp hàng
+                    ANALYSIS_WORKERS=str(concurrency),
+                    ANALYSIS_QUEUE_MAX=str(concurrency + 1),
+                )
+                print(f"Đo {label} với {concurrency} request đồng thời...")
+                rows.append(run_server(label, args, concurrency, env))
+    finally:
+        fake.kill()
+
+    print(f"\n{'Server':<16}{'N':>6}{'ok':>6}{'thời gian (s)':>15}{'RSS nghỉ (MB)':>15}"
+          f"{'RSS đỉnh (MB)':>15}{'KB/request':>12}{'threads':>9}")
+    for r in rows:
+        print(f"{r['label']:<16}{r['concurrency']:>6}{r['ok']:>6}{r['elapsed']:>15.2f}{r['idle_rss']:>15.1f}"
+              f"{r['peak_rss']:>15.1f}{r['per_request_kb']:>12.1f}{r['peak_threads']:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Đo thời gian khởi động (cold start) của main.py, tương đương thời gian boot một
+WSGI worker: mỗi lần đo chạy `import main` trong một process Python mới.
+
+So sánh hai chế độ:
+  - eager: GEMINI_EAGER_PROBE=1, kiểm tra kết nối Gemini đồng bộ lúc import (hành vi cũ)
+  - lazy : mặc định, chỉ tạo GenerativeModel, kiểm tra kết nối ở thread nền
+
+Cách chạy (từ thư mục gốc của repo, cần GEMINI_API_KEY trong .env):
+  python others/bench_cold_start.py --runs 10
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure(mode, runs):
+    env = dict(os.environ, GEMINI_EAGER_PROBE="1" if mode == "eager" else "0")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import main"],
+            cwd=REPO_DIR, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thời gian khởi động main.py")
+    parser.add_argument("--runs", type=int, default=10, help="Số lần đo cho mỗi chế độ")
+    args = parser.parse_args()
+
+    print(f"Đo cold start của main.py ({args.runs} lần mỗi chế độ)...")
+    results = {mode: measure(mode, args.runs) for mode in ("eager", "lazy")}
+
+    print(f"\n{'Chế độ':<8}{'median (s)':>12}{'mean (s)':>12}{'max (s)':>12}")
+    for mode, timings in results.items():
+        print(f"{mode:<8}{statistics.median(timings):>12.3f}{statistics.mean(timings):>12.3f}{max(timings):>12.3f}")
+
+    saved = statistics.median(results["eager"]) - statistics.median(results["lazy"])
+    print(f"\nLazy init tiết kiệm ~{saved:.3f}s mỗi lần boot worker (median).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+So sánh chi phí mỗi lời gọi generateContent giữa backend SDK (google-generativeai) và
+backend REST của gemini_rest.py (connection pool keep-alive, orjson, HTTP/2 nếu có).
+
+Mặc định script tự chạy others/fake_gemini_server.py với độ trễ 0 để chỉ đo phần chi phí
+phía client (serialize, kết nối, parse). Dùng --endpoint để đo với server khác, hoặc
+--real để đo với Gemini API thật (cần GEMINI_API_KEY, tốn quota).
+Lưu ý: với endpoint http:// (server giả), httpx chạy HTTP/1.1 (HTTP/2 cần TLS), nên ở
+chế độ này chỉ đo được khác biệt về pool kết nối và xử lý JSON.
+
+Cách chạy (từ thư mục gốc của repo):
+  python others/bench_rest_backend.py --calls 200
+  python others/bench_rest_backend.py --calls 20 --real
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import google.generativeai as genai
+import gemini_rest
+
+PROMPT = "Phân tích đoạn mã sau:\n" + "int main() { return 0; }\n" * 200
+GENERATION_CONFIG = {"temperature": 0.2, "max_output_tokens": 2048}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fake_server():
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "others", "fake_gemini_server.py"),
+         "--port", str(port), "--latency", "fixed:0", "--output-chars", "4000"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    sys.exit("Không khởi động được server giả")
+
+def measure(call, calls):
+    call()  # lần đầu không tính (mở kết nối, khởi tạo)
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh backend SDK và REST cho Gemini")
+    parser.add_argument("--calls", type=int, default=100, help="Số lời gọi đo cho mỗi backend")
+    parser.add_argument("--model", default="gemini-1.5-flash-latest")
+    parser.add_argument("--endpoint", help="Endpoint REST cần đo (mặc định: tự chạy server giả)")
+    parser.add_argument("--real", action="store_true", help="Đo với Gemini API thật")
+    args = parser.parse_args()
+
+    server = None
+    api_key = os.getenv("GEMINI_API_KEY", "local")
+    endpoint = args.endpoint
+    if args.real:
+        endpoint = None
+    elif not endpoint:
+        server, endpoint = start_fake_server()
+
+    try:
+        if endpoint:
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+        else:
+            genai.configure(api_key=api_key)
+        sdk_model = genai.GenerativeModel(args.model)
+        backends = {"sdk": lambda: sdk_model.generate_content(PROMPT, generation_config=GENERATION_CONFIG).text}
+
+        for label, http2 in (("rest-requests", False), ("rest-httpx", True)):
+            client = gemini_rest.GeminiRestClient(api_key, endpoint=endpoint, pool_size=4, http2=http2)
+            if http2 and not client.http2:
+                print("Bỏ qua rest-httpx: chưa cài httpx[http2]")
+                continue
+            client.warm(args.model)
+            model = client.model(args.model)
+            backends[label] = (lambda m: lambda: m.generate_content(PROMPT, generation_config=GENERATION_CONFIG).text)(model)
+
+        print(f"Đo {args.calls} lời gọi mỗi backend tới {endpoint or 'Gemini API'} "
+              f"(JSON: {'orjson' if gemini_rest.orjson else 'json'})...")
+        results = {label: measure(call, args.calls) for label, call in backends.items()}
+    finally:
+        if server:
+            server.kill()
+
+    print(f"\n{'Backend':<14}{'mean (ms)':>11}{'p50 (ms)':>11}{'p95 (ms)':>11}")
+    for label, timings in results.items():
+        ordered = sorted(timings)
+        print(f"{label:<14}{1000 * statistics.mean(timings):>11.2f}{1000 * statistics.median(timings):>11.2f}"
+              f"{1000 * ordered[int(0.95 * (len(ordered) - 1))]:>11.2f}")
+    base = statistics.median(results["sdk"])
+    for label, timings in results.items():
+        if label != "sdk":
+            print(f"{label}: tiết kiệm ~{1000 * (base - statistics.median(timings)):.2f} ms mỗi lời gọi so với SDK (median)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Đo chi phí trạng thái dùng chung (SQLite trong DATA_DIR) khi chạy nhiều worker process
+như gunicorn prefork: tra/ghi cache phản hồi, trừ quota và đọc health của Gemini API.
+
+Mỗi worker là một process import main.py (cùng DATA_DIR và key file tạm), chạy trong
+--duration giây một luồng thao tác hỗn hợp:
+  - 70% tra cache phản hồi với khóa theo phân phối Zipf (bài nộp phổ biến lặp lại nhiều),
+    trượt thì ghi kết quả giả (~4 KB) như sau một lời gọi model;
+  - 20% trừ quota một key;
+  - 10% đọc health (trang chủ).
+Báo cáo số thao tác/giây của cả nhóm, p50/p99 từng loại thao tác và tỉ lệ hit của cache
+dùng chung so với cache riêng từng process (cùng luồng khóa, mỗi worker một dict).
+
+Cách chạy (từ thư mục gốc của repo; không gọi Gemini, không sửa key.json của repo):
+  python others/bench_shared_state.py --workers 1 4 16 --duration 10
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_RESULT = {
+    "analysis": {"meets_requirements": False, "syntax_errors": [], "logical_errors": ["x" * 200], "runtime_errors": []},
+    "suggestions": [{"line": i, "error": "e" * 100, "fix": "f" * 100, "fixed_code": "c" * 100} for i in range(10)],
+    "evaluation": "Nhận xét. " * 50,
+}
+
+def zipf_weights(n, s=1.1):
+    weights = [1.0 / (rank + 1) ** s for rank in range(n)]
+    total, acc, cumulative = sum(weights), 0.0, []
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    return cumulative
+
+def worker(index, env, args, start_at, queue):
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    import main  # noqa: E402 (import sau khi đặt DATA_DIR/KEY_FILE)
+
+    rnd = random.Random(index)
+    cumulative = zipf_weights(args.keys)
+    local_cache = {}
+    latencies = {"cache": [], "quota": [], "health": []}
+    shared_hits = local_hits = lookups = 0
+
+    while time.time() < start_at:
+        time.sleep(0.001)
+    deadline = time.time() + args.duration
+    while time.time() < deadline:
+        op = rnd.random()
+        started = time.perf_counter()
+        if op < 0.7:
+            key = f"k{rnd.choices(range(args.keys), cum_weights=cumulative)[0]}"
+            lookups += 1
+            if key in local_cache:
+                local_hits += 1
+            else:
+                local_cache[key] = True
+            if main.response_cache.get(key) is not None:
+                shared_hits += 1
+            else:
+                main.response_cache.put(key, FAKE_RESULT)
+            kind = "cache"
+        elif op < 0.9:
+            main.validate_and_consume_key("bench")
+            kind = "quota"
+        else:
+            main.api_health.get()
+            kind = "health"
+        latencies[kind].append(time.perf_counter() - started)
+    main.response_cache.flush_counters()
+    main.quota_ledger.flush_pending()
+    queue.put({"latencies": latencies, "shared_hits": shared_hits, "local_hits": local_hits, "lookups": lookups})
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+
+def run(workers, args):
+    data_dir = tempfile.mkdtemp(prefix="bench-shared-")
+    key_file = os.path.join(data_dir, "key.json")
+    with open(key_file, "w") as f:
+        json.dump({"bench": 0}, f)
+    env = {
+        "DATA_DIR": data_dir,
+        "KEY_FILE": key_file,
+        "KEY_USAGE_LIMIT": str(10 ** 9),
+        # Không cần Gemini thật: health được kiểm tra tới một cổng đóng và báo lỗi ngay
+        "GEMINI_API_ENDPOINT": "http://127.0.0.1:9",
+        "GEMINI_BACKEND": "rest",
+        "GEMINI_REST_PREWARM": "0",
+    }
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    # Chờ mọi worker import xong rồi mới bắt đầu đo cùng lúc
+    start_at = time.time() + 5 + 0.3 * workers
+    procs = [ctx.Process(target=worker, args=(i, env, args, start_at, queue)) for i in range(workers)]
+    for proc in procs:
+        proc.start()
+    reports = [queue.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    merged = {kind: [v for r in reports for v in r["latencies"][kind]] for kind in ("cache", "quota", "health")}
+    lookups = sum(r["lookups"] for r in reports)
+    return {
+        "workers": workers,
+        "ops_per_sec": sum(len(v) for v in merged.values()) / args.duration,
+        "latency": {kind: (percentile(v, 0.5), percentile(v, 0.99)) for kind, v in merged.items()},
+        "shared_hit_rate": sum(r["shared_hits"] for r in reports) / max(1, lookups),
+        "local_hit_rate": sum(r["local_hits"] for r in reports) / max(1, lookups),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo trạng thái dùng chung với nhiều worker process")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=10, help="Thời gian đo mỗi cấu hình (giây)")
+    parser.add_argument("--keys", type=int, default=5000, help="Số bài nộp khác nhau (khóa cache)")
+    args = parser.parse_args()
+
+    rows = []
+    for workers in args.workers:
+        print(f"Đo với {workers} worker...")
+        rows.append(run(workers, args))
+
+    print(f"\n{'workers':>8}{'ops/s':>10}{'cache p50/p99 (µs)':>22}{'quota p50/p99 (µs)':>22}"
+          f"{'health p50/p99 (µs)':>23}{'hit chung':>11}{'hit riêng':>11}")
+    for r in rows:
+        cells = ""
+        for kind, width in (("cache", 22), ("quota", 22), ("health", 23)):
+            p50, p99 = r["latency"][kind]
+            cells += f"{1e6 * p50:.0f} / {1e6 * p99:.0f}".rjust(width)
+        print(f"{r['workers']:>8}{r['ops_per_sec']:>10.0f}{cells}"
+              f"{100 * r['shared_hit_rate']:>10.1f}%{100 * r['local_hit_rate']:>10.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Đo chi phí đếm token lịch sử hội thoại của GeminiClient (others/local_assistant.py) trong
+một phiên dài: cách cũ nối toàn bộ history rồi mã hóa lại (và dựng lại encoder tiktoken)
+mỗi lượt, so với TokenLedger chỉ mã hóa tin nhắn mới thêm.
+
+Phiên giả lập --turns lượt; mỗi lượt gửi một prompt kèm mã nguồn (~--prompt-chars ký tự)
+và nhận một phản hồi (~--response-chars ký tự) từ model giả, không gọi Gemini. Mỗi lượt
+optimize_context đếm bằng sổ (gồm mã hóa hai tin nhắn của lượt trước); cách cũ chỉ được
+đo ở mỗi --legacy-every lượt (mỗi lần mất cỡ giây khi history gần MAX_CONTEXT_LENGTH) rồi
+ngoại suy tổng theo độ dài history từng lượt. Cần tiktoken đã tải được encoding cl100k_base.
+
+Cách chạy (từ thư mục gốc của repo):
+  python others/bench_token_ledger.py --turns 500
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import tiktoken
+from local_assistant import Config, GeminiClient, Utils
+
+CODE_LINE = "    for (int i = 0; i < n; i++) {{ total += a[i] * {k}; }}  // vòng lặp {k}\n"
+WORDS = "biến vòng lặp con trỏ mảng hàm đệ quy độ phức tạp bộ nhớ kiểm thử lỗi biên".split()
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class StubChat:
+    """Hội thoại giả: send_message thêm lượt user/model vào history như ChatSession/RestChat"""
+
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content):
+        text = self.model.reply()
+        self.history.append({"role": "user", "parts": [content]})
+        self.history.append({"role": "model", "parts": [text]})
+        return StubResponse(text)
+
+class StubModel:
+    def __init__(self, response_chars, rnd):
+        self.response_chars = response_chars
+        self.rnd = rnd
+
+    def reply(self):
+        words = []
+        while sum(len(w) + 1 for w in words) < self.response_chars:
+            words.append(self.rnd.choice(WORDS))
+        return " ".join(words)
+
+    def generate_content(self, prompt, generation_config=None):
+        # Tóm tắt giả của ContextManager khi vượt ngân sách
+        return StubResponse(" ".join(self.rnd.choice(WORDS) for _ in range(200)))
+
+    def start_chat(self, history=None):
+        return StubChat(self, history)
+
+def make_prompt(turn, chars):
+    lines, k = [f"# Lượt {turn}: phân tích đoạn mã sau\n"], 0
+    while sum(map(len, lines)) < chars:
+        lines.append(CODE_LINE.format(k=turn * 1000 + k))
+        k += 1
+    return "".join(lines)
+
+def legacy_token_count(history):
+    """Cách đếm trước đây: nối mọi tin nhắn rồi mã hóa lại, encoder dựng mới mỗi lần."""
+    full_text = ""
+    for message in history:
+        for part in message["parts"]:
+            full_text += part
+    encoder = tiktoken.encoding_for_model("gpt-4")
+    return len(encoder.encode(full_text))
+
+def main():
+    parser = argparse.ArgumentParser(description="Đếm token lịch sử hội thoại: mã hóa lại toàn bộ so với sổ đếm")
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--prompt-chars", type=int, default=2500, help="Độ dài prompt mỗi lượt")
+    parser.add_argument("--response-chars", type=int, default=4000, help="Độ dài phản hồi mỗi lượt")
+    parser.add_argument("--budget", type=int, default=Config.MAX_CONTEXT_LENGTH,
+                        help="Ngân sách token của ContextManager")
+    parser.add_argument("--legacy-every", type=int, default=50, help="Đo cách cũ mỗi N lượt")
+    args = parser.parse_args()
+
+    client = GeminiClient("bench", backend="rest")
+    client.model = StubModel(args.response_chars, random.Random(0))
+    client.clear_history()
+    client.context_manager.budget = args.budget
+    client.pin("system", [("user", "# TRỢ LÝ LẬP TRÌNH THÔNG MINH\n" + "Hướng dẫn hệ thống. " * 50),
+                          ("model", "Tôi sẽ làm việc như một trợ lý lập trình thông minh.")])
+
+    ledger_times, legacy_samples, history_chars = [], [], []
+    for turn in range(1, args.turns + 1):
+        started = time.perf_counter()
+        client.optimize_context()
+        ledger_times.append(time.perf_counter() - started)
+        client.query(make_prompt(turn, args.prompt_chars))
+
+        history = client.conversation.history
+        history_chars.append(sum(len(Utils.message_text(m)) for m in history))
+        if turn % args.legacy_every == 0 or turn == args.turns:
+            started = time.perf_counter()
+            legacy = legacy_token_count(history)
+            legacy_samples.append((turn, time.perf_counter() - started, legacy, client.get_token_count()))
+
+    # Ngoại suy tổng thời gian của cách cũ: thời gian mã hóa tỉ lệ với độ dài history
+    seconds_per_char = statistics.mean(t / history_chars[turn - 1] for turn, t, _, _ in legacy_samples)
+    legacy_total = seconds_per_char * sum(history_chars)
+
+    print(f"{'lượt':>6}{'token (cũ)':>13}{'token (sổ)':>13}{'lệch':>8}{'cũ (ms)':>10}")
+    for turn, t, legacy, ledger in legacy_samples:
+        print(f"{turn:>6}{legacy:>13}{ledger:>13}{ledger - legacy:>8}{1000 * t:>10.1f}")
+    print(f"\n{args.turns} lượt, ngân sách {args.budget} token, "
+          f"{client.context_manager.summarized} tin nhắn đã được tóm tắt")
+    print(f"Sổ đếm: tổng {1000 * sum(ledger_times):.1f} ms, tối đa {1000 * max(ledger_times):.3f} ms/lượt "
+          f"(gồm mã hóa hai tin nhắn của lượt trước)")
+    print(f"Cách cũ: ~{legacy_total:.1f} s cho cả phiên (ngoại suy), "
+          f"{1000 * legacy_samples[-1][1]:.1f} ms ở lượt cuối")
+
+if __name__ == "__main__":
+    main()
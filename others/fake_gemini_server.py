@@ -0,0 +1,338 @@
+"""
+Server giả lập Gemini API (REST v1beta) để chạy thử và đo tải main.py mà không gọi API thật.
+
+Hỗ trợ:
+  - POST /v1beta/models/<model>:generateContent
+  - POST /v1beta/models/<model>:streamGenerateContent   (mảng JSON stream, hoặc SSE nếu ?alt=sse)
+  - POST /v1beta/models/<model>:countTokens
+  - GET  /v1beta/models/<model>                          (dùng cho kiểm tra kết nối)
+  - POST /v1beta/cachedContents, GET/PATCH/DELETE /v1beta/cachedContents/<id>
+    (context caching: generateContent nhận trường "cachedContent", nội dung cache được tính
+    vào promptTokenCount và báo trong cachedContentTokenCount; cache hết hạn theo TTL, cache
+    nhỏ hơn --cache-min-tokens bị từ chối với 400 như API thật)
+
+Phản hồi là một kết quả phân tích JSON hợp lệ theo đúng schema prompt yêu cầu, bọc trong
+khối ```json như model thật. Có thể cấu hình phân phối độ trễ, số token, tỉ lệ lỗi 429
+và tỉ lệ JSON bị cắt cụt (finishReason MAX_TOKENS).
+
+Cách chạy (từ thư mục gốc của repo):
+  python others/fake_gemini_server.py --port 8089 --latency lognormal:1.5,0.6 --rate-429 0.05
+  GEMINI_API_ENDPOINT=http://127.0.0.1:8089 flask --app main run
+
+Phân phối độ trễ (--latency, giây):
+  fixed:<s> | uniform:<min>,<max> | lognormal:<median>,<sigma> | pareto:<min>,<alpha>
+"""
+
+import re
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+def parse_latency(spec):
+    """Đổi chuỗi mô tả phân phối độ trễ thành hàm sinh số giây."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    if kind == "pareto":
+        minimum, alpha = values
+        return lambda: minimum * random.paretovariate(alpha)
+    raise argparse.ArgumentTypeError(f"Phân phối độ trễ không hợp lệ: {spec}")
+
+class FakeGemini:
+    """Trạng thái và cấu hình dùng chung của server giả."""
+
+    def __init__(self, args):
+        self.latency = parse_latency(args.latency)
+        self.chars_per_token = args.chars_per_token
+        self.output_chars = args.output_chars
+        self.rate_429 = args.rate_429
+        self.retry_after = args.retry_after
+        self.truncate_rate = args.truncate_rate
+        self.chunk_chars = args.chunk_chars
+        self._lock = threading.Lock()
+        self.cache_min_tokens = args.cache_min_tokens
+        self.caches = {}  # "cachedContents/<id>" -> {"model", "tokens", "text", "expires"}
+        self.counters = {"requests": 0, "throttled": 0, "truncated": 0,
+                         "cache_creates": 0, "cache_updates": 0, "cached_requests": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def tokens(self, text):
+        return max(1, int(len(text) / self.chars_per_token))
+
+    def cache_payload(self, name):
+        cache = self.caches[name]
+        return {
+            "name": name,
+            "model": cache["model"],
+            "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(cache["expires"])),
+            "usageMetadata": {"totalTokenCount": cache["tokens"]},
+        }
+
+    def get_cache(self, name):
+        """Cache còn hạn theo tên, hoặc None (cache hết hạn bị xóa như trên server thật)."""
+        with self._lock:
+            cache = self.caches.get(name)
+            if cache is not None and cache["expires"] <= time.time():
+                del self.caches[name]
+                cache = None
+            return cache
+
+    def analysis_text(self, prompt):
+        """Kết quả phân tích giả; phần evaluation được kéo dài tới output_chars ký tự."""
+        lines = prompt.count("\n")
+        result = {
+            "analysis": {
+                "meets_requirements": random.random() < 0.5,
+                "syntax_errors": [],
+                "logical_errors": ["Điều kiện biên chưa được xử lý."],
+                "runtime_errors": [],
+            },
+            "suggestions": [
+                {"line": random.randint(1, max(1, lines // 4)), "error": "Sai điều kiện",
+                 "fix": "Sửa lại điều kiện", "fixed_code": "if (x % 4 == 0 && x % 100 != 0) {"},
+            ],
+            "simulation": {
+                "error_case": {
+                    "input": "1900",
+                    "steps": [{"step": 1, "code_line": "if (x % 4 == 0)", "explanation": "Kiểm tra chia hết cho 4",
+                               "variables": {"x": 1900}, "is_error_step": True,
+                               "error_explanation": "1900 không phải năm nhuận"}],
+                    "result": "Sai",
+                },
+            },
+            "evaluation": "",
+        }
+        base = "```json\n" + json.dumps(result, ensure_ascii=False) + "\n```"
+        padding = max(0, self.output_chars - len(base))
+        result["evaluation"] = ("Nhận xét giả lập. " * (padding // 18 + 1))[:padding]
+        return "```json\n" + json.dumps(result, ensure_ascii=False) + "\n```"
+
+def parse_ttl(value):
+    return float(str(value or "3600s").rstrip("s"))
+
+def error_payload(code, message, status):
+    return {"error": {"code": code, "message": message, "status": status}}
+
+def prompt_text(body):
+    # countTokens của SDK gửi nội dung lồng trong generateContentRequest
+    body = body.get("generateContentRequest", body)
+    texts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            texts.append(part.get("text", ""))
+    return "".join(texts)
+
+def response_chunk(text, prompt_tokens, output_tokens, finish_reason=None, cached_tokens=0):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    usage = {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": output_tokens,
+        "totalTokenCount": prompt_tokens + output_tokens,
+    }
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return {"candidates": [candidate], "usageMetadata": usage}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeGemini/1.0"
+    # Header và body được ghi riêng; tắt Nagle để không cộng thêm ~40ms delayed-ACK mỗi request
+    disable_nagle_algorithm = True
+    fake = None  # FakeGemini, gán trong main()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith("/v1beta/cachedContents/"):
+            name = path[len("/v1beta/"):]
+            if self.fake.get_cache(name) is None:
+                return self.send_json(403, error_payload(403, "CachedContent not found (or permission denied)",
+                                                         "PERMISSION_DENIED"))
+            return self.send_json(200, self.fake.cache_payload(name))
+        match = re.fullmatch(r"/v1beta/(models/[^/:]+)", path)
+        if not match:
+            return self.send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+        self.send_json(200, {
+            "name": match.group(1),
+            "displayName": match.group(1),
+            "inputTokenLimit": 1048576,
+            "outputTokenLimit": 8192,
+            "supportedGenerationMethods": ["generateContent", "countTokens"],
+        })
+
+    def do_PATCH(self):
+        path = urlparse(self.path).path
+        name = path[len("/v1beta/"):]
+        body = self.read_body()
+        if not path.startswith("/v1beta/cachedContents/") or self.fake.get_cache(name) is None:
+            return self.send_json(403, error_payload(403, "CachedContent not found (or permission denied)",
+                                                     "PERMISSION_DENIED"))
+        with self.fake._lock:
+            self.fake.caches[name]["expires"] = time.time() + parse_ttl(body.get("ttl"))
+        self.fake.count("cache_updates")
+        self.send_json(200, self.fake.cache_payload(name))
+
+    def do_DELETE(self):
+        name = urlparse(self.path).path[len("/v1beta/"):]
+        with self.fake._lock:
+            found = self.fake.caches.pop(name, None) is not None
+        if not found:
+            return self.send_json(403, error_payload(403, "CachedContent not found (or permission denied)",
+                                                     "PERMISSION_DENIED"))
+        self.send_json(200, {})
+
+    def create_cache(self, body):
+        fake = self.fake
+        text = prompt_text(body) + "".join(part.get("text", "")
+                                           for part in (body.get("systemInstruction") or {}).get("parts", []))
+        tokens = fake.tokens(text)
+        if tokens < fake.cache_min_tokens:
+            return self.send_json(400, error_payload(
+                400, f"Cached content is too small. total_token_count={tokens}, min_total_token_count="
+                     f"{fake.cache_min_tokens}", "INVALID_ARGUMENT"))
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        with fake._lock:
+            fake.caches[name] = {"model": body.get("model"), "tokens": tokens, "text": text,
+                                 "expires": time.time() + parse_ttl(body.get("ttl"))}
+        fake.count("cache_creates")
+        self.send_json(200, fake.cache_payload(name))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/v1beta/cachedContents":
+            return self.create_cache(self.read_body())
+        match = re.fullmatch(r"/v1beta/models/([^/:]+):(\w+)", url.path)
+        if not match:
+            return self.send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+        method = match.group(2)
+        body = self.read_body()
+        fake = self.fake
+
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            cache = fake.get_cache(body["cachedContent"])
+            if cache is None:
+                return self.send_json(403, error_payload(403, "CachedContent not found (or permission denied)",
+                                                         "PERMISSION_DENIED"))
+            fake.count("cached_requests")
+            cached_tokens = cache["tokens"]
+
+        if method == "countTokens":
+            return self.send_json(200, {"totalTokens": fake.tokens(prompt_text(body))})
+        if method not in ("generateContent", "streamGenerateContent"):
+            return self.send_json(404, {"error": {"code": 404, "message": "Unknown method", "status": "NOT_FOUND"}})
+
+        fake.count("requests")
+        if random.random() < fake.rate_429:
+            fake.count("throttled")
+            return self.send_json(429, {"error": {
+                "code": 429,
+                "message": f"Resource has been exhausted (fake). Please retry in {fake.retry_after}s.",
+                "status": "RESOURCE_EXHAUSTED",
+            }}, headers={"Retry-After": str(fake.retry_after)})
+
+        prompt = prompt_text(body)
+        text = fake.analysis_text(prompt)
+        finish_reason = "STOP"
+        if random.random() < fake.truncate_rate:
+            fake.count("truncated")
+            text = text[:random.randint(1, len(text) - 1)]
+            finish_reason = "MAX_TOKENS"
+        prompt_tokens, output_tokens = fake.tokens(prompt) + cached_tokens, fake.tokens(text)
+        latency = fake.latency()
+
+        if method == "generateContent":
+            time.sleep(latency)
+            return self.send_json(200, response_chunk(text, prompt_tokens, output_tokens, finish_reason,
+                                                      cached_tokens))
+
+        # Streaming: chia văn bản thành các chunk, độ trễ trải đều giữa các chunk
+        pieces = [text[i:i + fake.chunk_chars] for i in range(0, len(text), fake.chunk_chars)]
+        sse = parse_qs(url.query).get("alt") == ["sse"]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json; charset=UTF-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if not sse:
+            self.send_chunk(b"[")
+        for i, piece in enumerate(pieces):
+            time.sleep(latency / len(pieces))
+            last = i == len(pieces) - 1
+            payload = json.dumps(response_chunk(piece, prompt_tokens, output_tokens if last else 0,
+                                                finish_reason if last else None,
+                                                cached_tokens if last else 0), ensure_ascii=False)
+            if sse:
+                data = f"data: {payload}\r\n\r\n"
+            else:
+                data = ("," if i else "") + payload
+            self.send_chunk(data.encode("utf-8"))
+        if not sse:
+            self.send_chunk(b"]")
+        self.send_chunk(b"")
+
+def main():
+    parser = argparse.ArgumentParser(description="Server giả lập Gemini API cho test offline và đo tải")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="lognormal:1.0,0.5",
+                        help="Phân phối độ trễ mỗi request (giây), xem docstring")
+    parser.add_argument("--chars-per-token", type=float, default=4.0, help="Số ký tự mỗi token khi đếm token")
+    parser.add_argument("--output-chars", type=int, default=4000, help="Độ dài xấp xỉ của văn bản trả về")
+    parser.add_argument("--chunk-chars", type=int, default=200, help="Số ký tự mỗi chunk khi streaming")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Tỉ lệ request bị trả 429 (0..1)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Thời gian retry gợi ý kèm 429 (giây)")
+    parser.add_argument("--cache-min-tokens", type=int, default=0,
+                        help="Số token tối thiểu của cached content (API thật: 32768 với gemini-1.5)")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Tỉ lệ phản hồi JSON bị cắt cụt (0..1)")
+    args = parser.parse_args()
+
+    Handler.fake = FakeGemini(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake Gemini đang chạy tại http://{args.host}:{args.port} (latency {args.latency})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"\nThống kê: {Handler.fake.counters}")
+
+if __name__ == "__main__":
+    main()
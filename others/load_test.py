@@ -0,0 +1,173 @@
+"""
+Đo tải web app: gửi lại các request /analyze với tốc độ mục tiêu (RPS) cố định và báo cáo
+throughput, độ trễ p50/p95/p99 và tỉ lệ lỗi cho từng cấu hình server.
+
+Tải dạng open-loop: request thứ i được lên lịch ở thời điểm i / RPS bất kể các request trước
+đã xong hay chưa, và độ trễ tính từ thời điểm lên lịch, nên server chậm không làm giảm tải
+một cách giả tạo.
+
+Ví dụ chạy offline với server giả (từ thư mục gốc của repo):
+  python others/fake_gemini_server.py --port 8089 --latency lognormal:1.5,0.6 &
+  GEMINI_API_ENDPOINT=http://127.0.0.1:8089 KEY_USAGE_LIMIT=100000 \\
+      gunicorn -w 4 --threads 8 -b 127.0.0.1:5001 main:app &
+  GEMINI_API_ENDPOINT=http://127.0.0.1:8089 KEY_USAGE_LIMIT=100000 \\
+      gunicorn -w 1 --threads 32 -b 127.0.0.1:5002 main:app &
+  python others/load_test.py --api-key <key> --rps 20 --duration 60 --unique \\
+      --target w4=http://127.0.0.1:5001 --target w1=http://127.0.0.1:5002
+
+Bài nộp lấy từ test_data/*.txt: phần trước dòng '-----' là đề bài, phần sau là mã nguồn.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_samples(directory):
+    """Đọc các bài nộp mẫu: (đề bài, mã nguồn, ngôn ngữ)."""
+    samples = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".txt"):
+            continue
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            text = f.read()
+        parts = re.split(r"\n-{5,}\n", text, maxsplit=1)
+        problem, code = (parts[0], parts[1]) if len(parts) == 2 else ("Kiểm tra chương trình", text)
+        problem = "\n".join(line.lstrip("/").strip() for line in problem.splitlines() if line.strip())
+        language = "C" if "#include" in code else "Python"
+        samples.append((problem, code.strip(), language))
+    if not samples:
+        sys.exit(f"Không có bài nộp mẫu (*.txt) trong {directory}")
+    return samples
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = {}
+
+    def ok(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+_sessions = threading.local()
+
+def session():
+    # Mỗi thread một Session để giữ kết nối keep-alive
+    s = getattr(_sessions, "session", None)
+    if s is None:
+        s = _sessions.session = requests.Session()
+    return s
+
+def send_one(base_url, args, sample, seq, scheduled, recorder):
+    problem, code, language = sample
+    if args.unique:
+        # Thêm comment khác nhau để không trúng cache phản hồi
+        marker = "#" if language == "Python" else "//"
+        code = f"{code}\n{marker} load-test {seq} {random.random()}"
+    form = {"api_key": args.api_key, "problem_description": problem, "source_code": code, "language": language}
+    try:
+        if args.mode == "submit":
+            resp = session().post(f"{base_url}/analyze/submit", data=form, timeout=args.timeout)
+            if resp.status_code != 202:
+                return recorder.error(f"HTTP {resp.status_code}")
+            status_url = base_url + resp.json()["status_url"]
+            while True:
+                job = session().get(status_url, timeout=args.timeout).json()
+                if job["status"] in ("done", "error"):
+                    break
+                if time.monotonic() - scheduled > args.timeout:
+                    return recorder.error("timeout")
+                time.sleep(0.2)
+            if job["status"] == "error":
+                return recorder.error("job error")
+        else:
+            resp = session().post(f"{base_url}/analyze", data=form, timeout=args.timeout, allow_redirects=False)
+            # Thành công là redirect 303 tới permalink; trang 200 ở đây là trang báo lỗi
+            if resp.status_code != 303:
+                return recorder.error(f"HTTP {resp.status_code}")
+    except requests.Timeout:
+        return recorder.error("timeout")
+    except requests.RequestException as e:
+        return recorder.error(type(e).__name__)
+    recorder.ok(time.monotonic() - scheduled)
+
+def run_target(label, base_url, args, samples):
+    recorder = Recorder()
+    total = int(args.rps * args.duration)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for seq in range(total):
+            scheduled = start + seq / args.rps
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send_one, base_url, args, samples[seq % len(samples)], seq, scheduled, recorder)
+    elapsed = time.monotonic() - start
+    return {
+        "label": label,
+        "sent": total,
+        "ok": len(recorder.latencies),
+        "errors": recorder.errors,
+        "elapsed": elapsed,
+        "latencies": recorder.latencies,
+    }
+
+def report(results):
+    print(f"\n{'Cấu hình':<12}{'gửi':>6}{'ok':>6}{'lỗi %':>8}{'req/s':>8}"
+          f"{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'mean (s)':>10}")
+    for r in results:
+        errors = sum(r["errors"].values())
+        lat = r["latencies"]
+        print(f"{r['label']:<12}{r['sent']:>6}{r['ok']:>6}{100 * errors / max(1, r['sent']):>8.1f}"
+              f"{r['ok'] / r['elapsed']:>8.2f}{percentile(lat, 0.50):>10.3f}{percentile(lat, 0.95):>10.3f}"
+              f"{percentile(lat, 0.99):>10.3f}{(statistics.mean(lat) if lat else float('nan')):>10.3f}")
+        if r["errors"]:
+            print(f"{'':<12}lỗi: {r['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tải /analyze với tốc độ mục tiêu")
+    parser.add_argument("--target", action="append", required=True,
+                        help="Server cần đo, dạng nhãn=URL hoặc URL (lặp lại để so sánh nhiều cấu hình)")
+    parser.add_argument("--api-key", required=True, help="API key người dùng (trong key.json, đủ quota)")
+    parser.add_argument("--rps", type=float, default=5, help="Số request mỗi giây")
+    parser.add_argument("--duration", type=float, default=30, help="Thời gian đo mỗi cấu hình (giây)")
+    parser.add_argument("--concurrency", type=int, default=64, help="Số request đang chạy tối đa")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout mỗi request (giây)")
+    parser.add_argument("--mode", choices=("analyze", "submit"), default="analyze",
+                        help="analyze: POST /analyze đồng bộ; submit: /analyze/submit rồi chờ job")
+    parser.add_argument("--unique", action="store_true", help="Làm mỗi bài nộp khác nhau để tránh cache")
+    parser.add_argument("--samples", default=os.path.join(REPO_DIR, "test_data"),
+                        help="Thư mục chứa bài nộp mẫu")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples)
+    results = []
+    for target in args.target:
+        label, _, url = target.rpartition("=")
+        label = label or url
+        print(f"Đo {label} ({url}): {args.rps} req/s trong {args.duration}s, chế độ {args.mode}...")
+        results.append(run_target(label, url.rstrip("/"), args, samples))
+    report(results)
+
+if __name__ == "__main__":
+    main()
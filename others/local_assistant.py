@@ -20,6 +20,12 @@ import json
 import time
 import subprocess
 import unittest
+import functools
+import hashlib
+import datetime
+import sqlite3
+import zlib
+from collections import OrderedDict
 from pathlib import Path
 from typing import List, Dict, Any, Tuple, Optional, Union
 import tkinter as tk
@@ -42,11 +48,32 @@ class Config:
     MAX_OUTPUT_TOKENS = 8192
     TOP_P = 0.95
     TOP_K = 64
+    # Backend gọi API: "sdk" (google-generativeai) hoặc "rest" (gemini_rest.py, kết nối keep-alive)
+    BACKEND = os.getenv("GEMINI_BACKEND", "sdk")
+    # Endpoint khác cho Gemini API, vd. others/fake_gemini_server.py khi chạy thử offline
+    API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+    # Context caching: các khối ghim (system prompt, yêu cầu, mã nguồn) được tải lên một lần
+    # thành cached content sống CONTEXT_CACHE_TTL giây; chỉ dùng khi phần này đủ lớn
+    # (API yêu cầu tối thiểu 32768 token với gemini-1.5)
+    CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") != "0"
+    CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "900"))
+    CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "32768"))
     
     # Cấu hình hiển thị
     DEFAULT_DETAIL_LEVEL = "medium"  # low, medium, high
     MAX_CONTEXT_LENGTH = 900000  # Giới hạn ngữ cảnh để tối ưu token
+    # Ngân sách token của hội thoại (không vượt MAX_CONTEXT_LENGTH): vượt quá thì các lượt cũ
+    # được thay bằng bản tóm tắt do model viết, giữ nguyên văn CONTEXT_RECENT_MESSAGES tin nhắn cuối
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "200000"))
+    CONTEXT_RECENT_MESSAGES = int(os.getenv("CONTEXT_RECENT_MESSAGES", "6"))
+    CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "1024"))
     
+    # Lịch sử phiên bản mã nguồn: snapshot đầy đủ sau mỗi CODE_HISTORY_SNAPSHOT_INTERVAL phiên
+    # bản của cùng một file (giữa các snapshot chỉ lưu delta theo dòng); vượt
+    # CODE_HISTORY_MEMORY_BYTES thì các phiên bản ít dùng được chuyển xuống đĩa (TEMP_DIR)
+    CODE_HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("CODE_HISTORY_SNAPSHOT_INTERVAL", "16"))
+    CODE_HISTORY_MEMORY_BYTES = int(os.getenv("CODE_HISTORY_MEMORY_BYTES", str(32 * 1024 * 1024)))
+
     # Đường dẫn mặc định
     TEMP_DIR = tempfile.mkdtemp()
 
@@ -55,11 +82,39 @@ class Config:
 class Utils:
     """Các hàm tiện ích"""
     
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_encoder(model: str = "gpt-4"):
+        """Encoder tiktoken dựng một lần cho mỗi model (dựng lại mỗi lần gọi tốn hàng chục ms)"""
+        return tiktoken.encoding_for_model(model)
+
     @staticmethod
     def count_tokens(text: str) -> int:
         """Đếm số lượng token trong text"""
-        encoder = tiktoken.encoding_for_model("gpt-4")  # Sử dụng encoder của GPT-4 để ước lượng
+        encoder = Utils.get_encoder("gpt-4")  # Sử dụng encoder của GPT-4 để ước lượng
         return len(encoder.encode(text))
+
+    @staticmethod
+    def message_text(message) -> str:
+        """Nội dung văn bản của một tin nhắn trong lịch sử (dict {"role", "parts"} hoặc Content của SDK)"""
+        parts = message.get("parts") if isinstance(message, dict) else getattr(message, "parts", None)
+        if isinstance(parts, str):
+            return parts
+        texts = []
+        for part in parts or []:
+            if isinstance(part, str):
+                texts.append(part)
+            elif isinstance(part, dict):
+                texts.append(part.get("text") or "")
+            elif hasattr(part, "text"):
+                texts.append(part.text)
+        return "".join(texts)
+
+    @staticmethod
+    def message_role(message) -> str:
+        """Vai trò ("user"/"model") của một tin nhắn trong lịch sử"""
+        role = message.get("role") if isinstance(message, dict) else getattr(message, "role", None)
+        return role or "user"
     
     @staticmethod
     def read_file(filepath: str) -> str:
@@ -155,72 +210,495 @@ class Utils:
 
 # ===== PHẦN CỐT LÕI =====
 
+class TokenLedger:
+    """Sổ đếm token của lịch sử hội thoại.
+
+    Mỗi tin nhắn được mã hóa đúng một lần khi được thêm vào; sổ giữ số token của từng tin
+    nhắn (cùng thứ tự với history) và tổng theo vai trò, nên đọc tổng là O(1) và bỏ bớt
+    tin nhắn chỉ cần trừ số đã lưu, không mã hóa lại. Tổng là tổng của từng tin nhắn nên có
+    thể lệch vài token so với mã hóa cả lịch sử nối liền (BPE không ghép qua ranh giới).
+    """
+
+    def __init__(self):
+        self.entries = []  # [(role, tokens)] song song với history
+        self.totals = {}   # role -> tổng token
+        self.total = 0
+        self._last = None  # tin nhắn cuối đã đếm, để phát hiện history bị thay từ bên ngoài
+
+    def _count(self, message) -> Tuple[str, int]:
+        role, tokens = Utils.message_role(message), Utils.count_tokens(Utils.message_text(message))
+        self.totals[role] = self.totals.get(role, 0) + tokens
+        self.total += tokens
+        return role, tokens
+
+    def append(self, message):
+        self.entries.append(self._count(message))
+        self._last = message
+
+    def sync(self, history: list):
+        """Đếm các tin nhắn mới ở cuối history (vd. send_message tự thêm lượt user/model).
+
+        Nếu history không còn khớp với những gì đã đếm (bị cắt hoặc thay bằng list khác ngoài
+        các hàm của GeminiClient) thì đếm lại từ đầu.
+        """
+        counted = len(self.entries)
+        if counted > len(history) or (counted and history[counted - 1] is not self._last):
+            self.clear()
+            counted = 0
+        for message in history[counted:]:
+            self.append(message)
+
+    def drop(self, start: int, stop: int):
+        """Bỏ các tin nhắn [start, stop) khỏi sổ bằng số token đã lưu"""
+        for role, tokens in self.entries[start:stop]:
+            self.totals[role] -= tokens
+            self.total -= tokens
+        del self.entries[start:stop]
+
+    def splice(self, start: int, stop: int, messages: list):
+        """Thay các tin nhắn [start, stop) bằng messages; chỉ mã hóa các tin nhắn mới"""
+        self.drop(start, stop)
+        self.entries[start:start] = [self._count(message) for message in messages]
+
+    def tokens(self, start: int, stop: int) -> int:
+        """Tổng token của các tin nhắn [start, stop)"""
+        return sum(tokens for _, tokens in self.entries[start:stop])
+
+    def rebind(self, history: list):
+        """Gắn lại với history sau khi gán list mới cùng nội dung (SDK chuyển dict thành Content)"""
+        self._last = history[-1] if history else None
+
+    def clear(self):
+        self.entries = []
+        self.totals = {}
+        self.total = 0
+        self._last = None
+
+class CodeRegistry:
+    """Sổ đăng ký mã nguồn theo nội dung cho một hội thoại.
+
+    Mỗi phiên bản mã có ID là 12 ký tự đầu của SHA-256 nội dung. Prompt chỉ chứa toàn văn
+    một phiên bản khi nó chưa có trong ngữ cảnh; các prompt sau tham chiếu theo ID. Sổ đếm
+    số tin nhắn user trong history đang chứa toàn văn mỗi ID (GeminiClient gọi track khi
+    tin nhắn được thêm/bỏ), nên phiên bản bị tóm tắt hoặc bị thay khỏi khối ghim sẽ được gửi
+    lại toàn văn ở lần dùng tiếp theo.
+    """
+
+    BLOCK_RE = re.compile(r"^### Mã nguồn #([0-9a-f]{12}) \(", re.MULTILINE)
+
+    def __init__(self):
+        self.versions = {}    # id -> {"filename", "lines", "full_tokens", "ref_tokens"}
+        self.in_context = {}  # id -> số tin nhắn user trong history chứa toàn văn
+        self.stats = {"full_sends": 0, "references": 0, "tokens_sent": 0, "tokens_saved": 0}
+
+    @staticmethod
+    def code_id(code: str) -> str:
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()[:12]
+
+    def block(self, language: str, code: str, filename: Optional[str] = None, full: bool = False) -> str:
+        """Khối mã để đặt vào prompt: tham chiếu theo ID nếu toàn văn đang có trong ngữ cảnh
+        (và full=False), ngược lại là toàn văn kèm tiêu đề mang ID"""
+        cid = self.code_id(code)
+        info = self.versions.get(cid)
+        if info is None:
+            info = self.versions[cid] = {"filename": filename or f"code.{language.lower()}",
+                                         "lines": code.count("\n") + 1}
+        text = (f"### Mã nguồn #{cid} ({info['filename']}, {info['lines']} dòng)\n"
+                f"```{language}\n{code}\n```")
+        if "full_tokens" not in info:
+            info["full_tokens"] = Utils.count_tokens(text)
+        if full or not self.in_context.get(cid):
+            self.stats["full_sends"] += 1
+            self.stats["tokens_sent"] += info["full_tokens"]
+            return text
+        reference = f"(Mã nguồn #{cid} – {info['filename']}: toàn văn đã gửi ở phần trước của hội thoại.)"
+        if "ref_tokens" not in info:
+            info["ref_tokens"] = Utils.count_tokens(reference)
+        self.stats["references"] += 1
+        self.stats["tokens_sent"] += info["ref_tokens"]
+        self.stats["tokens_saved"] += info["full_tokens"] - info["ref_tokens"]
+        return reference
+
+    def track(self, message, delta: int):
+        """Ghi nhận một tin nhắn được thêm (delta=1) hoặc bỏ (delta=-1) khỏi history"""
+        if Utils.message_role(message) != "user":
+            return
+        for cid in self.BLOCK_RE.findall(Utils.message_text(message)):
+            count = self.in_context.get(cid, 0) + delta
+            if count > 0:
+                self.in_context[cid] = count
+            else:
+                self.in_context.pop(cid, None)
+
+    def reset_context(self):
+        """History được tạo lại: không phiên bản nào còn trong ngữ cảnh"""
+        self.in_context = {}
+
+    def report(self) -> Dict[str, Any]:
+        """Thống kê token của phiên: số lần gửi toàn văn/tham chiếu, token đã gửi và tiết kiệm"""
+        report = dict(self.stats, versions=len(self.versions))
+        without = report["tokens_sent"] + report["tokens_saved"]
+        report["saved_percent"] = round(100 * report["tokens_saved"] / without, 1) if without else 0.0
+        return report
+
+class ContextManager:
+    """Giữ ngữ cảnh hội thoại của GeminiClient trong ngân sách token.
+
+    History luôn có dạng: các khối ghim (system prompt, yêu cầu, mã nguồn hiện tại...) theo
+    thứ tự ghim, rồi một cặp tin nhắn tóm tắt (nếu đã tóm tắt), rồi các lượt trao đổi. Trước
+    mỗi lượt, nếu tổng token cộng phần dự trữ cho lượt đó vượt ngân sách thì các lượt cũ (kể
+    cả bản tóm tắt trước) được model tóm tắt lại thành một cặp tin nhắn, chỉ giữ nguyên văn
+    vài tin nhắn gần nhất. Khối ghim không bao giờ bị tóm tắt; ghim lại cùng khóa sẽ thay khối
+    cũ (vd. mã nguồn phiên bản mới).
+    """
+
+    SUMMARY_HEADER = "# TÓM TẮT CÁC LƯỢT TRAO ĐỔI TRƯỚC"
+    SUMMARY_ACK = "Đã ghi nhận tóm tắt các lượt trao đổi trước."
+    SUMMARY_PROMPT = """Tóm tắt cuộc trao đổi dưới đây giữa người dùng và trợ lý lập trình để dùng làm ngữ cảnh cho các lượt sau, tối đa khoảng {max_tokens} token.
+Giữ lại: yêu cầu và quyết định đã chốt, các lỗi đã phát hiện và cách sửa, các phiên bản mã nguồn đã thảo luận (tên file, thay đổi chính), các câu hỏi còn bỏ ngỏ.
+Không chép lại toàn bộ mã nguồn, chỉ trích những dòng thật cần thiết.
+
+{transcript}"""
+
+    def __init__(self, client: "GeminiClient", budget: Optional[int] = None,
+                 recent_messages: Optional[int] = None, summary_max_tokens: Optional[int] = None):
+        self.client = client
+        self.budget = min(budget or Config.CONTEXT_TOKEN_BUDGET, Config.MAX_CONTEXT_LENGTH)
+        self.recent_messages = Config.CONTEXT_RECENT_MESSAGES if recent_messages is None else recent_messages
+        self.summary_max_tokens = summary_max_tokens or Config.CONTEXT_SUMMARY_MAX_TOKENS
+        self.pinned = {}       # khóa -> [tin nhắn], theo thứ tự ghim
+        self.summary = ""      # bản tóm tắt hiện tại, nằm ngay sau các khối ghim
+        self.summarized = 0    # số tin nhắn đã được tóm tắt trong phiên
+
+    @property
+    def pinned_count(self) -> int:
+        return sum(len(messages) for messages in self.pinned.values())
+
+    @property
+    def head_count(self) -> int:
+        """Số tin nhắn đầu history không bị tóm tắt lần này (khối ghim + cặp tóm tắt)"""
+        return self.pinned_count + (2 if self.summary else 0)
+
+    def pinned_messages(self) -> list:
+        return [message for messages in self.pinned.values() for message in messages]
+
+    def pin(self, key: str, messages: List[Tuple[str, str]]):
+        """Ghim (hoặc thay) khối tin nhắn [(role, content)] có khóa key ở đầu ngữ cảnh"""
+        keys = list(self.pinned)
+        position = keys.index(key) if key in self.pinned else len(keys)
+        start = sum(len(self.pinned[k]) for k in keys[:position])
+        stop = start + len(self.pinned.get(key, []))
+        block = [{"role": role, "parts": [content]} for role, content in messages]
+        self.pinned[key] = block
+        self.client.replace_history(start, stop, block)
+
+    def unpin(self, key: str):
+        """Bỏ ghim khối có khóa key (khối bị xóa khỏi ngữ cảnh)"""
+        if key not in self.pinned:
+            return
+        keys = list(self.pinned)
+        start = sum(len(self.pinned[k]) for k in keys[:keys.index(key)])
+        stop = start + len(self.pinned.pop(key))
+        self.client.replace_history(start, stop, [])
+
+    def reset(self):
+        """Bỏ bản tóm tắt (gọi khi xóa lịch sử hội thoại; khối ghim được giữ)"""
+        self.summary = ""
+
+    def fit(self, reserve: int = 0) -> bool:
+        """Tóm tắt các lượt cũ nếu ngữ cảnh + reserve token vượt ngân sách; True nếu đã tóm tắt"""
+        ledger = self.client.token_ledger
+        total = self.client.get_token_count()
+        if total + reserve <= self.budget:
+            return False
+
+        history = self.client.conversation.history
+        start, head = self.pinned_count, self.head_count
+        stop = None
+        # Giữ nguyên văn càng nhiều tin nhắn gần nhất càng tốt mà vẫn vừa ngân sách
+        for keep in range(min(self.recent_messages, len(history)), -1, -1):
+            candidate = len(history) - keep
+            # Không cắt giữa một lượt: phần giữ lại bắt đầu bằng tin nhắn của user
+            while candidate < len(history) and Utils.message_role(history[candidate]) != "user":
+                candidate += 1
+            if candidate <= head:
+                continue
+            stop = candidate
+            remaining = total - ledger.tokens(start, stop) + self.summary_max_tokens
+            if remaining + reserve <= self.budget:
+                break
+        if stop is None:
+            print(f"Context over budget ({total} tokens) but nothing left to summarize.")
+            return False
+
+        evicted = history[start:stop]
+        summary = self._summarize(evicted)
+        self.client.replace_history(start, stop, [
+            {"role": "user", "parts": [f"{self.SUMMARY_HEADER}\n\n{summary}"]},
+            {"role": "model", "parts": [self.SUMMARY_ACK]},
+        ])
+        self.summary = summary
+        self.summarized += stop - start
+        print(f"Context optimized. Summarized {stop - start} messages, "
+              f"{self.client.get_token_count()} tokens in context.")
+        return True
+
+    def _summarize(self, messages: list) -> str:
+        """Nhờ model tóm tắt các tin nhắn; lỗi thì giữ bản tóm tắt cũ và ghi chú phần bị bỏ"""
+        transcript = "\n\n".join(
+            f"[{Utils.message_role(message)}]\n{Utils.message_text(message)}" for message in messages
+        )
+        prompt = self.SUMMARY_PROMPT.format(max_tokens=self.summary_max_tokens, transcript=transcript)
+        try:
+            response = self.client.model.generate_content(
+                prompt, generation_config={"temperature": 0.2, "max_output_tokens": self.summary_max_tokens}
+            )
+            return response.text.strip()
+        except Exception as e:
+            print(f"Error summarizing context: {str(e)}")
+            note = f"({len(messages)} tin nhắn cũ đã bị lược bỏ do vượt ngân sách ngữ cảnh.)"
+            return f"{self.summary}\n\n{note}".strip()
+
+class PrefixCache:
+    """Context caching của Gemini cho phần đầu cố định của hội thoại (các khối ghim).
+
+    System prompt, yêu cầu và mã nguồn hiện tại giống hệt nhau ở mọi lượt, nên được tải lên
+    một lần thành cached content; các lượt sau chỉ gửi tên cache cùng phần history còn lại.
+    Cache được nhận diện bằng hash nội dung các khối ghim: khối ghim đổi (mã nguồn mới, yêu
+    cầu mới) thì cache cũ bị xóa và tạo cache mới; còn lại chỉ gia hạn TTL khi đã qua nửa
+    thời gian sống. Không dùng cache khi phần ghim nhỏ hơn min_tokens hoặc API từ chối tạo.
+    """
+
+    EXPIRY_MARGIN = 30  # giây; coi cache là hết hạn sớm hơn một chút để tránh dùng cache vừa hết hạn
+
+    def __init__(self, client: "GeminiClient", ttl: Optional[int] = None, min_tokens: Optional[int] = None,
+                 enabled: Optional[bool] = None):
+        self.client = client
+        self.ttl = ttl or Config.CONTEXT_CACHE_TTL
+        self.min_tokens = Config.CONTEXT_CACHE_MIN_TOKENS if min_tokens is None else min_tokens
+        self.enabled = Config.CONTEXT_CACHE_ENABLED if enabled is None else enabled
+        self.cache = None        # cached content hiện tại
+        self.model = None        # model trả lời dựa trên cache
+        self.fingerprint = None  # hash các khối ghim nằm trong cache
+        self.expires = 0.0       # time.monotonic() lúc cache hết hạn (ước tính phía client)
+        self.rejected = set()    # fingerprint bị API từ chối (vd. nhỏ hơn mức tối thiểu)
+        self.stats = {"creates": 0, "refreshes": 0, "cached_requests": 0, "cached_tokens": 0}
+
+    @staticmethod
+    def _fingerprint(messages: list) -> str:
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(Utils.message_role(message).encode("utf-8") + b"\0")
+            digest.update(Utils.message_text(message).encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def acquire(self):
+        """Model dùng cache cho các khối ghim hiện tại (tạo hoặc gia hạn khi cần); None nếu không dùng cache"""
+        if not self.enabled:
+            return None
+        pinned = self.client.context_manager.pinned_messages()
+        self.client.get_token_count()  # đồng bộ sổ đếm token
+        if not pinned or self.client.token_ledger.tokens(0, len(pinned)) < self.min_tokens:
+            self.release()
+            return None
+        fingerprint = self._fingerprint(pinned)
+        if fingerprint in self.rejected:
+            self.release()
+            return None
+
+        now = time.monotonic()
+        margin = min(self.EXPIRY_MARGIN, self.ttl / 4)
+        if self.cache is not None and fingerprint == self.fingerprint and now < self.expires - margin:
+            if self.expires - now >= self.ttl / 2:
+                return self.model
+            try:
+                self.cache.update(ttl=datetime.timedelta(seconds=self.ttl))
+                self.expires = now + self.ttl
+                self.stats["refreshes"] += 1
+                return self.model
+            except Exception as e:
+                print(f"Error refreshing context cache: {str(e)}")
+                self.invalidate()
+
+        self.release()
+        try:
+            self.cache, self.model = self._create(pinned)
+        except Exception as e:
+            print(f"Error creating context cache: {str(e)}")
+            if getattr(e, "code", None) == 400:
+                self.rejected.add(fingerprint)
+            return None
+        self.fingerprint = fingerprint
+        self.expires = time.monotonic() + self.ttl
+        self.stats["creates"] += 1
+        return self.model
+
+    def _create(self, messages: list):
+        client = self.client
+        if client.backend == "rest":
+            cache = client.rest_client.create_cached_content(
+                Config.MODEL_NAME, messages, ttl=self.ttl, display_name="smart-programming-assistant"
+            )
+            return cache, client.rest_client.model_from_cached_content(cache, client.generation_config)
+        cache = genai.caching.CachedContent.create(
+            model=Config.MODEL_NAME,
+            contents=messages,
+            ttl=datetime.timedelta(seconds=self.ttl),
+            display_name="smart-programming-assistant",
+        )
+        return cache, genai.GenerativeModel.from_cached_content(cached_content=cache,
+                                                                generation_config=client.generation_config)
+
+    def record(self, response):
+        """Ghi nhận một lượt trả lời dựa trên cache (số token được tính theo giá cache)"""
+        usage = getattr(response, "usage_metadata", None)
+        self.stats["cached_requests"] += 1
+        self.stats["cached_tokens"] += getattr(usage, "cached_content_token_count", 0) or 0
+
+    def invalidate(self):
+        """Quên cache hiện tại mà không gọi API (cache đã hết hạn hoặc bị xóa phía server)"""
+        self.cache = self.model = self.fingerprint = None
+        self.expires = 0.0
+
+    def release(self):
+        """Xóa cache hiện tại trên server (nếu có) để không tốn phí lưu trữ tới hết TTL"""
+        if self.cache is not None:
+            try:
+                self.cache.delete()
+            except Exception as e:
+                print(f"Error deleting context cache: {str(e)}")
+        self.invalidate()
+
 class GeminiClient:
     """Xử lý tương tác với Gemini API"""
     
-    def __init__(self, api_key: str):
-        """Khởi tạo client với API key"""
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(
-            model_name=Config.MODEL_NAME,
-            generation_config={
-                "temperature": Config.TEMPERATURE,
-                "max_output_tokens": Config.MAX_OUTPUT_TOKENS,
-                "top_p": Config.TOP_P,
-                "top_k": Config.TOP_K
-            }
-        )
+    def __init__(self, api_key: str, backend: Optional[str] = None):
+        """Khởi tạo client với API key; backend là "sdk" hoặc "rest" (mặc định Config.BACKEND)"""
+        generation_config = {
+            "temperature": Config.TEMPERATURE,
+            "max_output_tokens": Config.MAX_OUTPUT_TOKENS,
+            "top_p": Config.TOP_P,
+            "top_k": Config.TOP_K
+        }
+        self.generation_config = generation_config
+        self.backend = (backend or Config.BACKEND).lower()
+        if self.backend == "rest":
+            # gemini_rest.py nằm ở thư mục gốc của repo
+            sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+            import gemini_rest
+            self.rest_client = gemini_rest.GeminiRestClient(api_key, endpoint=Config.API_ENDPOINT or None)
+            self.model = self.rest_client.model(Config.MODEL_NAME, generation_config=generation_config)
+        else:
+            if Config.API_ENDPOINT:
+                genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": Config.API_ENDPOINT})
+            else:
+                genai.configure(api_key=api_key)
+            self.model = genai.GenerativeModel(
+                model_name=Config.MODEL_NAME,
+                generation_config=generation_config
+            )
         self.conversation = self.model.start_chat(history=[])
+        self.token_ledger = TokenLedger()
+        self.context_manager = ContextManager(self)
+        self.code_registry = CodeRegistry()
+        self.prefix_cache = PrefixCache(self)
     
     def query(self, prompt: str) -> str:
         """Gửi prompt và nhận phản hồi từ model"""
         try:
-            response = self.conversation.send_message(prompt)
+            # Dự trữ chỗ cho prompt và phản hồi của lượt này trong ngân sách ngữ cảnh
+            self.context_manager.fit(reserve=Utils.count_tokens(prompt) + Config.MAX_OUTPUT_TOKENS)
+            cached_model = self.prefix_cache.acquire()
+            if cached_model is not None:
+                response = self._send_cached(cached_model, prompt)
+            else:
+                response = self.conversation.send_message(prompt)
+            self.code_registry.track({"role": "user", "parts": [prompt]}, 1)
             return response.text
         except Exception as e:
             error_msg = f"Error querying Gemini API: {str(e)}"
             print(error_msg)
             return error_msg
     
+    def _send_cached(self, model, prompt: str):
+        """Một lượt hội thoại dựa trên cached content: chỉ gửi phần history sau các khối ghim"""
+        history = self.conversation.history
+        message = {"role": "user", "parts": [prompt]}
+        contents = [*history[self.context_manager.pinned_count:], message]
+        try:
+            response = model.generate_content(contents)
+        except Exception as e:
+            if getattr(e, "code", None) not in (403, 404):
+                raise
+            # Cache đã hết hạn hoặc bị xóa phía server: tạo lại một lần, không được thì gửi đầy đủ
+            self.prefix_cache.invalidate()
+            model = self.prefix_cache.acquire()
+            if model is None:
+                return self.conversation.send_message(prompt)
+            response = model.generate_content(contents)
+        history.append(message)
+        history.append({"role": "model", "parts": [response.text]})
+        self.prefix_cache.record(response)
+        return response
+
+    def close(self):
+        """Dọn tài nguyên phía server của phiên (cached content)"""
+        self.prefix_cache.release()
+
     def add_to_history(self, role: str, content: str):
         """Thêm tin nhắn vào lịch sử hội thoại"""
         # Thêm tin nhắn vào lịch sử
-        if role.lower() == "user":
-            self.conversation.history.append({"role": "user", "parts": [content]})
-        elif role.lower() == "model":
-            self.conversation.history.append({"role": "model", "parts": [content]})
+        if role.lower() not in ("user", "model"):
+            return
+        history = self.conversation.history
+        self.token_ledger.sync(history)
+        message = {"role": role.lower(), "parts": [content]}
+        history.append(message)
+        self.token_ledger.append(message)
+        self.code_registry.track(message, 1)
+    
+    def pin(self, key: str, messages: List[Tuple[str, str]]):
+        """Ghim khối tin nhắn [(role, content)] ở đầu ngữ cảnh, không bị tóm tắt"""
+        self.context_manager.pin(key, messages)
+
+    def code_block(self, language: str, code: str, filename: Optional[str] = None, full: bool = False) -> str:
+        """Mã nguồn cho prompt: toàn văn lần đầu, các lần sau chỉ tham chiếu theo ID (xem CodeRegistry)"""
+        return self.code_registry.block(language, code, filename, full)
+
+    def replace_history(self, start: int, stop: int, messages: list):
+        """Thay các tin nhắn [start, stop) của lịch sử bằng messages, cập nhật sổ đếm token"""
+        history = self.conversation.history
+        self.token_ledger.sync(history)
+        for message in history[start:stop]:
+            self.code_registry.track(message, -1)
+        for message in messages:
+            self.code_registry.track(message, 1)
+        self.conversation.history = [*history[:start], *messages, *history[stop:]]
+        self.token_ledger.splice(start, stop, messages)
+        self.token_ledger.rebind(self.conversation.history)
     
     def clear_history(self):
-        """Xóa lịch sử hội thoại"""
-        self.conversation = self.model.start_chat(history=[])
+        """Xóa lịch sử hội thoại (các khối đã ghim được giữ lại)"""
+        self.conversation = self.model.start_chat(history=self.context_manager.pinned_messages())
+        self.token_ledger.clear()
+        self.context_manager.reset()
+        self.code_registry.reset_context()
+        for message in self.conversation.history:
+            self.code_registry.track(message, 1)
     
     def get_token_count(self) -> int:
-        """Ước tính số lượng token trong lịch sử hội thoại"""
-        full_text = ""
-        for message in self.conversation.history:
-            if isinstance(message["parts"], list):
-                for part in message["parts"]:
-                    if isinstance(part, str):
-                        full_text += part
-                    elif hasattr(part, "text"):
-                        full_text += part.text
-            elif isinstance(message["parts"], str):
-                full_text += message["parts"]
-        
-        return Utils.count_tokens(full_text)
+        """Ước tính số lượng token trong lịch sử hội thoại (chỉ đếm các tin nhắn mới thêm)"""
+        self.token_ledger.sync(self.conversation.history)
+        return self.token_ledger.total
+
+    def get_token_breakdown(self) -> Dict[str, int]:
+        """Số token trong lịch sử theo vai trò (user/model)"""
+        self.token_ledger.sync(self.conversation.history)
+        return dict(self.token_ledger.totals)
     
-    def optimize_context(self):
-        """Tối ưu ngữ cảnh khi quá dài"""
-        token_count = self.get_token_count()
-        
-        if token_count > Config.MAX_CONTEXT_LENGTH:
-            # Giữ lại tin nhắn đầu tiên (system prompt) và nửa sau của lịch sử
-            retain_count = len(self.conversation.history) // 2
-            self.conversation.history = [
-                self.conversation.history[0],
-                *self.conversation.history[-retain_count:]
-            ]
-            print(f"Context optimized. Retained {retain_count+1} messages.")
+    def optimize_context(self) -> bool:
+        """Tối ưu ngữ cảnh khi quá dài (query đã tự gọi trước mỗi lượt)"""
+        return self.context_manager.fit()
 
 class CodeExecutor:
     """Thực thi và phân tích mã nguồn"""
@@ -438,9 +916,7 @@ class CodeAnalyzer:
 {requirement}
 
 ## Mã nguồn cần phân tích:
-```{language}
-{code}
-```
+{self.gemini_client.code_block(language, code)}
 
 ## Thông tin thêm:
 - Kết quả kiểm tra cú pháp: {syntax_result["status"]}
@@ -549,9 +1025,7 @@ Trả về KẾT QUẢ dưới định dạng JSON HỢP LỆ.
 ## Ngôn ngữ: {language}
 
 ## Mã nguồn cần mô phỏng:
-```{language}
-{code}
-```
+{self.gemini_client.code_block(language, code)}
 
 ## Mức độ chi tiết: {detail_level} (low/medium/high)
 
@@ -587,9 +1061,7 @@ Sử dụng markdown để định dạng.
 {requirement}
 
 ## Mã nguồn:
-```{language}
-{code}
-```
+{self.gemini_client.code_block(language, code)}
 
 ## YÊU CẦU TEST CASE:
 1. Tạo các test case bao phủ các trường hợp:
@@ -612,6 +1084,155 @@ Sử dụng markdown để định dạng.
         test_case_response = self.gemini_client.query(test_case_prompt)
         return test_case_response
 
+class CodeVersionStore:
+    """Lịch sử phiên bản mã nguồn theo ngôn ngữ, bộ nhớ có giới hạn.
+
+    Mỗi nội dung được lưu một lần theo SHA-256 (file không đổi giữa các phiên bản, hoặc được
+    tải lên lại trong ZIP, không tốn thêm bộ nhớ). Nội dung mới của một file được lưu thành
+    delta theo dòng so với phiên bản trước của cùng file (đoạn dòng chép lại từ bản cũ, hoặc
+    văn bản chèn mới); cứ snapshot_interval phiên bản, hoặc khi delta không nhỏ hơn nhiều so
+    với toàn văn, thì lưu snapshot đầy đủ, nên dựng lại một phiên bản chỉ cần áp tối đa
+    snapshot_interval - 1 delta. Khi các object trong bộ nhớ vượt memory_bytes, object ít
+    dùng nhất được nén và chuyển xuống một file SQLite trong TEMP_DIR. Object trong file chỉ
+    khóa theo hash, nên mỗi store dùng một file riêng (tạo bằng mkstemp khi spill lần đầu);
+    spill_path truyền vào không được dùng chung giữa các store.
+    """
+
+    DECODED_CACHE_SIZE = 8  # số phiên bản đã dựng lại được giữ sẵn (so sánh các bản liền nhau)
+
+    def __init__(self, snapshot_interval: Optional[int] = None, memory_bytes: Optional[int] = None,
+                 spill_path: Optional[str] = None):
+        self.snapshot_interval = max(1, snapshot_interval or Config.CODE_HISTORY_SNAPSHOT_INTERVAL)
+        self.memory_bytes = Config.CODE_HISTORY_MEMORY_BYTES if memory_bytes is None else memory_bytes
+        self.spill_path = spill_path  # None: tạo file riêng trong TEMP_DIR khi cần
+        self.versions = {}           # ngôn ngữ -> [(filename, hash)] theo thứ tự thêm
+        self._latest = {}            # (ngôn ngữ, filename) -> hash phiên bản mới nhất của file
+        self._objects = OrderedDict()  # hash -> object trong bộ nhớ, theo thứ tự dùng gần nhất
+        self._meta = {}              # hash -> (kind, depth, size) của mọi object, kể cả đã xuống đĩa
+        self._memory = 0
+        self._decoded = OrderedDict()  # hash -> toàn văn đã dựng lại
+        self._db = None
+        self.raw_bytes = 0           # tổng kích thước nếu lưu toàn văn mọi phiên bản
+
+    def add(self, language: str, code: str, filename: str):
+        """Thêm một phiên bản mã nguồn vào cuối lịch sử của ngôn ngữ"""
+        language = language.lower()
+        digest = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        if digest not in self._meta:
+            base = self._latest.get((language, filename))
+            self._store(digest, code, base)
+        self.versions.setdefault(language, []).append((filename, digest))
+        self._latest[(language, filename)] = digest
+        self.raw_bytes += len(code)
+
+    def count(self, language: str) -> int:
+        return len(self.versions.get(language.lower(), []))
+
+    def get(self, language: str, index: int) -> Dict[str, str]:
+        """Phiên bản thứ index (như chỉ số list, cho phép số âm) dạng {"code", "filename"}"""
+        filename, digest = self.versions[language.lower()][index]
+        return {"code": self._text(digest), "filename": filename}
+
+    def _store(self, digest: str, code: str, base: Optional[str]):
+        obj = None
+        if base is not None and self._meta[base][1] + 1 < self.snapshot_interval:
+            ops = self._delta(self._text(base), code)
+            size = sum(len(op) if isinstance(op, str) else 16 for op in ops)
+            # Delta gần bằng toàn văn (file viết lại gần hết) thì lưu snapshot cho nhanh
+            if size < len(code) // 2:
+                obj = ("delta", base, ops)
+                self._meta[digest] = ("delta", self._meta[base][1] + 1, size)
+        if obj is None:
+            obj = ("snapshot", code)
+            self._meta[digest] = ("snapshot", 0, len(code))
+        self._objects[digest] = obj
+        self._memory += self._meta[digest][2]
+        self._remember(digest, code)
+        self._spill()
+
+    @staticmethod
+    def _delta(old: str, new: str) -> list:
+        """Delta theo dòng: [i1, i2] là chép dòng i1..i2-1 của bản cũ, chuỗi là văn bản chèn mới"""
+        old_lines, new_lines = old.splitlines(keepends=True), new.splitlines(keepends=True)
+        ops = []
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines).get_opcodes():
+            if tag == "equal":
+                ops.append([i1, i2])
+            elif tag in ("replace", "insert"):
+                ops.append("".join(new_lines[j1:j2]))
+        return ops
+
+    def _text(self, digest: str) -> str:
+        """Dựng lại toàn văn: đi ngược chuỗi delta tới snapshot (hoặc bản đã dựng sẵn) rồi áp xuôi"""
+        target, chain = digest, []
+        while digest not in self._decoded:
+            obj = self._load(digest)
+            if obj[0] == "snapshot":
+                text = obj[1]
+                break
+            chain.append(obj[2])
+            digest = obj[1]
+        else:
+            self._decoded.move_to_end(digest)
+            text = self._decoded[digest]
+        for ops in reversed(chain):
+            lines = text.splitlines(keepends=True)
+            text = "".join("".join(lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+        self._remember(target, text)
+        return text
+
+    def _remember(self, digest: str, text: str):
+        self._decoded[digest] = text
+        self._decoded.move_to_end(digest)
+        while len(self._decoded) > self.DECODED_CACHE_SIZE:
+            self._decoded.popitem(last=False)
+
+    def _load(self, digest: str):
+        obj = self._objects.get(digest)
+        if obj is not None:
+            self._objects.move_to_end(digest)
+            return obj
+        # Object đã xuống đĩa: đọc trực tiếp, không đưa lại vào bộ nhớ
+        row = self._connect().execute("SELECT data FROM objects WHERE hash = ?", (digest,)).fetchone()
+        if row is None:
+            raise RuntimeError(f"Không tìm thấy phiên bản {digest[:12]} trong file lưu tạm {self.spill_path} "
+                               "(file đã bị xóa hoặc bị store khác ghi đè).")
+        return tuple(json.loads(zlib.decompress(row[0])))
+
+    def _connect(self):
+        if self._db is None:
+            if self.spill_path is None:
+                fd, self.spill_path = tempfile.mkstemp(prefix="code_history_", suffix=".sqlite",
+                                                       dir=Config.TEMP_DIR)
+                os.close(fd)
+            self._db = sqlite3.connect(self.spill_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, data BLOB)")
+        return self._db
+
+    def _spill(self):
+        """Chuyển các object ít dùng nhất xuống đĩa cho tới khi bộ nhớ dưới giới hạn"""
+        if self._memory <= self.memory_bytes:
+            return
+        db = self._connect()
+        with db:
+            while self._memory > self.memory_bytes and len(self._objects) > 1:
+                digest, obj = self._objects.popitem(last=False)
+                data = zlib.compress(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+                db.execute("INSERT OR REPLACE INTO objects (hash, data) VALUES (?, ?)", (digest, data))
+                self._memory -= self._meta[digest][2]
+
+    def stats(self) -> Dict[str, int]:
+        kinds = [meta[0] for meta in self._meta.values()]
+        return {
+            "versions": sum(len(v) for v in self.versions.values()),
+            "objects": len(self._meta),
+            "snapshots": kinds.count("snapshot"),
+            "deltas": kinds.count("delta"),
+            "memory_bytes": self._memory,
+            "spilled_objects": len(self._meta) - len(self._objects),
+            "raw_bytes": self.raw_bytes,
+        }
+
 class SmartProgrammingAssistant:
     """Trợ lý lập trình thông minh - lớp chính của ứng dụng"""
     
@@ -621,7 +1242,7 @@ class SmartProgrammingAssistant:
         self.gemini_client = GeminiClient(api_key)
         self.code_analyzer = CodeAnalyzer(self.gemini_client)
         self.current_code = {}  # Lưu trữ mã nguồn hiện tại theo ngôn ngữ
-        self.code_history = {}  # Lưu trữ lịch sử các phiên bản mã nguồn
+        self.code_history = CodeVersionStore()  # Lưu trữ lịch sử các phiên bản mã nguồn (delta, giới hạn bộ nhớ)
         self.current_requirements = ""  # Lưu trữ yêu cầu hiện tại
         
         # Khởi tạo system prompt
@@ -654,9 +1275,11 @@ Bạn là một trợ lý lập trình thông minh, chuyên hỗ trợ phân tí
 - Sử dụng bảng và biểu đồ khi cần thiết
 """
         
-        # Thêm system prompt vào lịch sử
-        self.gemini_client.add_to_history("user", system_prompt)
-        self.gemini_client.add_to_history("model", "Tôi sẽ làm việc như một trợ lý lập trình thông minh, tuân theo các nguyên tắc và hướng dẫn đã nêu.")
+        # Ghim system prompt ở đầu ngữ cảnh
+        self.gemini_client.pin("system", [
+            ("user", system_prompt),
+            ("model", "Tôi sẽ làm việc như một trợ lý lập trình thông minh, tuân theo các nguyên tắc và hướng dẫn đã nêu."),
+        ])
     
     def set_requirements(self, requirements: str):
         """Cập nhật yêu cầu đề bài"""
@@ -671,7 +1294,7 @@ Bạn là một trợ lý lập trình thông minh, chuyên hỗ trợ phân tí
 Hãy phân tích yêu cầu này và cho tôi biết các điểm chính cần lưu ý.
 """
         
-        self.gemini_client.add_to_history("user", requirements_prompt)
+        self.gemini_client.pin("requirements", [("user", requirements_prompt), ("model", "Đã ghi nhận yêu cầu đề bài.")])
         analysis_response = self.gemini_client.query(requirements_prompt)
         
         return analysis_response
@@ -683,9 +1306,8 @@ Hãy phân tích yêu cầu này và cho tôi biết các điểm chính cần l
         
         # Lưu lịch sử nếu đã có mã nguồn trước đó
         if language in self.current_code:
-            if language not in self.code_history:
-                self.code_history[language] = []
-            self.code_history[language].append(self.current_code[language])
+            previous = self.current_code[language]
+            self.code_history.add(language, previous["code"], previous["filename"])
         
         # Cập nhật mã nguồn hiện tại
         self.current_code[language] = {
@@ -693,22 +1315,25 @@ Hãy phân tích yêu cầu này và cho tôi biết các điểm chính cần l
             "filename": filename or f"code.{language.lower()}"
         }
         
-        # Thêm code vào lịch sử
+        # Ghim toàn văn phiên bản mã hiện tại (thay phiên bản trước cùng ngôn ngữ)
+        filename = filename or f"code.{language.lower()}"
         code_prompt = f"""
 # MÃ NGUỒN MỚI
 
 ## Ngôn ngữ: {language}
-## Tên file: {filename or f"code.{language.lower()}"}
+## Tên file: {filename}
 
-```{language}
-{code}
-```
-
-Hãy phân tích mã nguồn này và cho tôi biết nó làm gì.
+{self.gemini_client.code_block(language, code, filename, full=True)}
 """
-        
-        self.gemini_client.add_to_history("user", code_prompt)
-        analysis_response = self.gemini_client.query(code_prompt)
+        self.gemini_client.pin(f"code:{language.lower()}", [
+            ("user", code_prompt),
+            ("model", f"Đã ghi nhận mã nguồn {filename}."),
+        ])
+        # Mã vừa được ghim nên prompt phân tích chỉ cần tham chiếu theo ID
+        analysis_response = self.gemini_client.query(
+            f"Hãy phân tích mã nguồn {self.gemini_client.code_block(language, code, filename)} "
+            f"và cho tôi biết nó làm gì."
+        )
         
         return analysis_response
     
@@ -856,25 +1481,23 @@ Hãy phân tích mã nguồn này và cho tôi biết nó làm gì.
     
     def compare_versions(self, language: str, version1: int = -2, version2: int = -1):
         """So sánh hai phiên bản mã nguồn"""
-        if language.lower() not in self.code_history or len(self.code_history[language]) < 2:
+        count = self.code_history.count(language)
+        if count < 2:
             return f"Không đủ phiên bản mã nguồn {language} để so sánh. Cần ít nhất 2 phiên bản."
         
-        # Lấy phiên bản code
-        history = self.code_history[language]
-        
         # Xử lý chỉ số âm
         if version1 < 0:
-            version1 = len(history) + version1
+            version1 = count + version1
         if version2 < 0:
-            version2 = len(history) + version2
+            version2 = count + version2
         
         # Kiểm tra phạm vi
-        if version1 < 0 or version1 >= len(history) or version2 < 0 or version2 >= len(history):
-            return f"Chỉ số phiên bản không hợp lệ. Phạm vi hợp lệ: 0-{len(history)-1}."
+        if version1 < 0 or version1 >= count or version2 < 0 or version2 >= count:
+            return f"Chỉ số phiên bản không hợp lệ. Phạm vi hợp lệ: 0-{count-1}."
         
-        # So sánh
-        old_code = history[version1]["code"]
-        new_code = history[version2]["code"]
+        # So sánh (dựng lại hai phiên bản từ snapshot + delta)
+        old_code = self.code_history.get(language, version1)["code"]
+        new_code = self.code_history.get(language, version2)["code"]
         diff = Utils.compare_code_versions(old_code, new_code)
         
         # Tạo diff đẹp để hiển thị
@@ -962,9 +1585,7 @@ Hãy phân tích mã nguồn này và cho tôi biết nó làm gì.
 ## Ngôn ngữ: {language}
 
 ## Mã nguồn:
-```{language}
-{code_data['code']}
-```
+{self.gemini_client.code_block(language, code_data['code'], code_data['filename'])}
 
 ## YÊU CẦU:
 1. Giải thích tổng quan về mục đích và chức năng của mã nguồn
@@ -983,6 +1604,23 @@ Hãy phân tích mã nguồn này và cho tôi biết nó làm gì.
         explanation = self.gemini_client.query(explain_prompt)
         return explanation
 
+    def token_report(self) -> str:
+        """Thống kê token của phiên (mã nguồn gửi theo ID, ngữ cảnh hiện tại) dạng markdown"""
+        report = self.gemini_client.code_registry.report()
+        context = self.gemini_client.context_manager
+        cache = self.gemini_client.prefix_cache.stats
+        return "\n".join([
+            "# Thống Kê Token Của Phiên\n",
+            f"- Số phiên bản mã nguồn: {report['versions']}",
+            f"- Gửi toàn văn: {report['full_sends']} lần; tham chiếu theo ID: {report['references']} lần",
+            f"- Token mã nguồn đã gửi: {report['tokens_sent']}",
+            f"- Token tiết kiệm nhờ tham chiếu: {report['tokens_saved']} ({report['saved_percent']}%)",
+            f"- Token trong ngữ cảnh hiện tại: {self.gemini_client.get_token_count()} / {context.budget}",
+            f"- Số tin nhắn cũ đã được tóm tắt: {context.summarized}",
+            f"- Context cache: tạo {cache['creates']} lần, gia hạn {cache['refreshes']} lần, "
+            f"{cache['cached_requests']} lượt dùng cache ({cache['cached_tokens']} token tính giá cache)",
+        ])
+
 # ===== PHẦN GIAO DIỆN =====
 
 class UI:
@@ -1096,6 +1734,7 @@ class UI:
         ttk.Button(actions_inner_frame, text="Sinh Test Case", command=self.handle_generate_test_cases).pack(side=tk.LEFT, padx=5)
         ttk.Button(actions_inner_frame, text="Giải Thích Mã", command=self.handle_explain_code).pack(side=tk.LEFT, padx=5)
         ttk.Button(actions_inner_frame, text="So Sánh Phiên Bản (cuối & trước đó)", command=self.handle_compare_versions).pack(side=tk.LEFT, padx=5)
+        ttk.Button(actions_inner_frame, text="Thống Kê Token", command=self.handle_token_report).pack(side=tk.LEFT, padx=5)
 
 
         # --- Output Frame ---
@@ -1201,6 +1840,12 @@ class UI:
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi khi giải thích mã: {str(e)}")
 
+    def handle_token_report(self):
+        if not self.assistant:
+            messagebox.showerror("Lỗi", "Trợ lý chưa được khởi tạo.")
+            return
+        self.display_output("Thống Kê Token", self.assistant.token_report())
+
     def handle_compare_versions(self):
         if not self.assistant:
             messagebox.showerror("Lỗi", "Trợ lý chưa được khởi tạo.")
@@ -1302,6 +1947,9 @@ def run_application_local():
     app_ui = UI(root)
     root.mainloop()
 
+    if app_ui.assistant:
+        app_ui.assistant.gemini_client.close()
+
     # Dọn dẹp thư mục tạm khi đóng ứng dụng
     import shutil
     try:
@@ -0,0 +1,9 @@
+// ============================
+// history.js
+// ============================
+// Hiển thị thời gian của từng kết quả theo múi giờ của trình duyệt
+document.addEventListener('DOMContentLoaded', () => {
+  document.querySelectorAll('.history-time').forEach((cell) => {
+    cell.textContent = new Date(cell.dataset.timestamp * 1000).toLocaleString('vi-VN');
+  });
+});
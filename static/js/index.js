@@ -6,7 +6,26 @@ document.addEventListener('DOMContentLoaded', () => {
     const loader = document.getElementById('loader');
     const submitButton = form.querySelector('button[type="submit"]');
   
-    form.addEventListener('submit', () => {
+    function resetForm() {
+      loader && (loader.style.display = 'none');
+      if (submitButton) {
+        submitButton.disabled = false;
+        submitButton.textContent = 'Phân tích Mã nguồn';
+      }
+    }
+
+    function showError(message) {
+      let box = document.getElementById('submit-error');
+      if (!box) {
+        box = document.createElement('div');
+        box.id = 'submit-error';
+        box.className = 'api-status error';
+        form.parentNode.insertBefore(box, form);
+      }
+      box.textContent = message;
+    }
+
+    form.addEventListener('submit', (event) => {
       const pd = document.getElementById('problem_description').value.trim();
       const sc = document.getElementById('source_code').value.trim();
       if (!pd || !sc) return;
@@ -15,16 +34,39 @@ document.addEventListener('DOMContentLoaded', () => {
         submitButton.disabled = true;
         submitButton.textContent = 'Đang xử lý...';
       }
+      if (!window.fetch) return;
+
+      // Gửi job bất đồng bộ rồi chuyển sang trang kết quả của job. Chỉ khi fetch không gửi
+      // được request (lỗi mạng) mới quay về POST /analyze thông thường; server đã trả lời
+      // (kể cả trang lỗi HTML như 413/502) thì có thể đã trừ quota, nên chỉ báo lỗi
+      event.preventDefault();
+      fetch('/analyze/submit', { method: 'POST', body: new FormData(form) })
+        .then(
+          (resp) => resp.json()
+            .catch(() => ({ error: `Máy chủ trả lỗi ${resp.status}, vui lòng thử lại sau.` }))
+            .then((data) => {
+              if (resp.ok && data.result_url) {
+                data.history_url && localStorage.setItem('historyUrl', data.history_url);
+                window.location.href = data.result_url;
+              } else {
+                resetForm();
+                showError(data.error || 'Không thể gửi yêu cầu phân tích.');
+              }
+            }),
+          () => form.submit()
+        );
     });
   
-    window.addEventListener('pageshow', () => {
-      if (loader && loader.style.display === 'flex') {
-        loader.style.display = 'none';
-      }
-      if (submitButton) {
-        submitButton.disabled = false;
-        submitButton.textContent = 'Phân tích Mã nguồn';
-      }
-    });
+    // Liên kết tới lịch sử phân tích của key đã dùng lần trước
+    const historyUrl = localStorage.getItem('historyUrl');
+    if (historyUrl) {
+      const link = document.createElement('a');
+      link.href = historyUrl;
+      link.className = 'history-link';
+      link.textContent = 'Xem lịch sử phân tích »';
+      form.parentNode.insertBefore(link, form.nextSibling);
+    }
+
+    window.addEventListener('pageshow', resetForm);
   });
   
\ No newline at end of file
@@ -3,14 +3,89 @@
 // ============================
 // static/js/result.js
 
+// Trang chờ job: nhận từng phần kết quả qua SSE và điền vào chỗ trống tương ứng.
+// Nếu không có EventSource thì polling trạng thái và tải lại trang khi job xong.
+function watchPendingJob(container) {
+  const statusUrl = container.dataset.jobStatusUrl;
+  const eventsUrl = container.dataset.jobEventsUrl;
+  const finished = (job) => job.status === 'done' || job.status === 'error';
+
+  if (!(window.EventSource && eventsUrl)) {
+    pollJob(statusUrl, finished);
+    return;
+  }
+
+  const source = new EventSource(eventsUrl);
+  const progress = container.querySelector('.stream-progress');
+
+  source.addEventListener('progress', (e) => {
+    const data = JSON.parse(e.data);
+    if (progress) progress.textContent = `Đã nhận ${data.received_chars} ký tự từ model...`;
+  });
+
+  source.addEventListener('section', (e) => {
+    const data = JSON.parse(e.data);
+    const slot = document.getElementById(`section-${data.name}`);
+    if (slot) slot.innerHTML = data.html;
+  });
+
+  source.addEventListener('status', (e) => {
+    const job = JSON.parse(e.data);
+    if (!finished(job)) return;
+    source.close();
+
+    const slots = container.querySelectorAll('.stream-section');
+    const complete = slots.length > 0 && Array.from(slots).every((slot) => slot.children.length > 0);
+    // Đổi địa chỉ trang sang permalink để tải lại/chia sẻ không phải phân tích lại
+    if (job.permalink_url && window.history.replaceState) {
+      window.history.replaceState(null, '', job.permalink_url);
+    }
+    if (job.status === 'done' && complete) {
+      const pending = container.querySelector('.pending-job');
+      pending && pending.remove();
+      celebrateIfPerfect();
+    } else {
+      window.location.reload();
+    }
+  });
+
+  source.onerror = () => {
+    if (source.readyState === EventSource.CLOSED) return;
+    source.close();
+    pollJob(statusUrl, finished);
+  };
+}
+
+function pollJob(statusUrl, finished) {
+  fetch(statusUrl, { headers: { 'Accept': 'application/json' } })
+    .then((resp) => resp.json())
+    .then((job) => {
+      if (finished(job)) {
+        window.location.replace(job.permalink_url || window.location.href);
+      } else {
+        setTimeout(() => pollJob(statusUrl, finished), 2000);
+      }
+    })
+    .catch(() => setTimeout(() => pollJob(statusUrl, finished), 5000));
+}
+
 document.addEventListener('DOMContentLoaded', () => {
   const container = document.querySelector('.container');
-  if (!container || container.dataset.analysisPresent !== 'true') return;
+  if (container && container.dataset.jobStatusUrl) {
+    watchPendingJob(container);
+    return;
+  }
+  celebrateIfPerfect();
+});
 
-  const meets = JSON.parse(container.dataset.meetsRequirements);
-  const seCnt = +container.dataset.syntaxErrorsCount;
-  const leCnt = +container.dataset.logicalErrorsCount;
-  const reCnt = +container.dataset.runtimeErrorsCount;
+function celebrateIfPerfect() {
+  const analysis = document.querySelector('[data-analysis-present="true"]');
+  if (!analysis) return;
+
+  const meets = JSON.parse(analysis.dataset.meetsRequirements);
+  const seCnt = +analysis.dataset.syntaxErrorsCount;
+  const leCnt = +analysis.dataset.logicalErrorsCount;
+  const reCnt = +analysis.dataset.runtimeErrorsCount;
 
   // Chỉ bắn confetti khi code hoàn toàn đúng
   if (!(meets && seCnt === 0 && leCnt === 0 && reCnt === 0 && typeof confetti === 'function')) {
@@ -59,4 +134,4 @@ document.addEventListener('DOMContentLoaded', () => {
     document.removeEventListener('click', stopConfetti);
   }
   document.addEventListener('click', stopConfetti);
-});
+}
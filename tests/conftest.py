@@ -0,0 +1,74 @@
+"""
+Cấu hình chung cho test: main.py được import với DATA_DIR/KEY_FILE tạm và gọi Gemini qua
+others/fake_gemini_server.py (không gọi API thật, không sửa key.json của repo).
+
+Chạy (từ thư mục gốc của repo): python -m pytest -q
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+TEST_KEYS = {"test-key": 0, "other-key": 0}
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_port(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server giả đã dừng (mã {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Không khởi động được server giả")
+
+_fake_server = None
+
+def pytest_configure(config):
+    # Biến môi trường phải có trước khi test nào import main
+    global _fake_server
+    data_dir = tempfile.mkdtemp(prefix="test-data-")
+    key_file = os.path.join(data_dir, "key.json")
+    with open(key_file, "w") as f:
+        json.dump(TEST_KEYS, f)
+    port = _free_port()
+    _fake_server = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "others", "fake_gemini_server.py"),
+         "--port", str(port), "--latency", "fixed:0.05", "--output-chars", "400"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    _wait_port(port, _fake_server)
+    os.environ.update(
+        DATA_DIR=data_dir,
+        KEY_FILE=key_file,
+        GEMINI_API_ENDPOINT=f"http://127.0.0.1:{port}",
+        GEMINI_API_KEY="test",
+        GEMINI_BACKEND="rest",
+        GEMINI_RPM="0",
+        GEMINI_HEDGE="0",
+    )
+
+def pytest_unconfigure(config):
+    if _fake_server is not None:
+        _fake_server.kill()
+        _fake_server.wait()
+
+@pytest.fixture(scope="session")
+def main():
+    import main as app_module
+    return app_module
@@ -0,0 +1,76 @@
+"""Pipeline phân tích chạy với server Gemini giả: cache, single-flight và dùng lại bài gần trùng."""
+
+import uuid
+import threading
+
+SOURCE = """\
+def total(items):
+    result = 0
+    for item in items:
+        result += item
+    return result
+
+print(total([int(x) for x in input().split()]))
+"""
+
+def new_problem():
+    # Mỗi test một đề bài riêng để không trúng cache của test khác
+    return f"Tính tổng dãy số {uuid.uuid4().hex}"
+
+def analyze(main, problem, source_code=SOURCE):
+    stats = {}
+    result, error = main.run_analysis(problem, source_code, "Python", stats=stats)
+    assert error is None
+    return result, stats
+
+def test_second_identical_submission_hits_cache(main):
+    problem = new_problem()
+    result, stats = analyze(main, problem)
+    assert result and not stats["cache_hit"] and stats["model"]
+    cached, stats = analyze(main, problem)
+    assert stats["cache_hit"] and cached == result
+
+def test_concurrent_identical_submissions_call_model_once(main):
+    problem = new_problem()
+    barrier = threading.Barrier(4)
+    outcomes = []
+
+    def worker():
+        barrier.wait()
+        outcomes.append(analyze(main, problem))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Lời gọi đến muộn có thể trúng cache thay vì chờ leader, nhưng chỉ một lời gọi tới model
+    leaders = [stats for _, stats in outcomes if not stats["cache_hit"] and not stats["coalesced"]]
+    assert len(leaders) == 1
+    assert all(result == outcomes[0][0] for result, _ in outcomes)
+
+def test_cross_process_lease_waits_for_holder(main, monkeypatch):
+    monkeypatch.setattr(main, "SINGLEFLIGHT_CROSS_PROCESS", True)
+    problem = new_problem()
+    cache_key = main.make_cache_key(problem, SOURCE, "Python", main.analysis_model_id(), main.GENERATION_CONFIG)
+    # Một "process khác" đang giữ lease và sẽ ghi kết quả vào cache
+    lease = f"singleflight.{cache_key}"
+    assert main.shared_state.claim(lease, "other-process", 30)
+    outcome = []
+    waiter = threading.Thread(target=lambda: outcome.append(analyze(main, problem)))
+    waiter.start()
+    waiter.join(0.3)
+    assert waiter.is_alive()
+    from_holder = {"evaluation": f"kết quả của process khác {uuid.uuid4().hex}"}
+    main.response_cache.put(cache_key, from_holder)
+    waiter.join(10)
+    assert outcome[0][0] == from_holder
+    main.shared_state.release(lease, "other-process")
+
+def test_renamed_submission_reuses_result(main):
+    problem = new_problem()
+    result, _ = analyze(main, problem)
+    renamed = SOURCE.replace("result", "acc").replace("item", "value")
+    reused, stats = analyze(main, problem, renamed)
+    assert stats.get("near_duplicate") and not stats["model"]
+    assert reused["evaluation"] == result["evaluation"]
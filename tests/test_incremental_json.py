@@ -0,0 +1,27 @@
+"""IncrementalJSONParser: báo từng phần kết quả ngay khi phần đó đóng lại."""
+
+import json
+
+def feed_all(main, text, chunk_size):
+    parser = main.IncrementalJSONParser()
+    found = []
+    for i in range(0, len(text), chunk_size):
+        found.extend(parser.feed(text[i:i + chunk_size]))
+    return found
+
+def test_members_are_emitted_as_they_close(main):
+    parser = main.IncrementalJSONParser()
+    assert parser.feed('```json\n{"analysis": {"ok": tr') == []
+    assert parser.feed('ue}, "sugg') == [("analysis", {"ok": True})]
+    assert parser.feed('estions": ["a", "b"]}\n```') == [("suggestions", ["a", "b"])]
+    assert parser.feed('{"ignored": 1}') == []
+
+def test_strings_with_braces_and_escapes(main):
+    value = {"evaluation": 'dùng "{" và "}", dấu \\ và [,]', "simulation": {"steps": [{"line": 1}]}}
+    text = json.dumps(value, ensure_ascii=False)
+    for chunk_size in (1, 3, len(text)):
+        assert dict(feed_all(main, text, chunk_size)) == value
+
+def test_malformed_member_is_skipped(main):
+    found = feed_all(main, '{"analysis": {"ok": tru}, "evaluation": "tốt"}', 4)
+    assert found == [("evaluation", "tốt")]
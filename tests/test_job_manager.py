@@ -0,0 +1,28 @@
+"""JobManager: trạng thái job dùng chung giữa các worker process qua SQLite."""
+
+import threading
+
+def test_job_visible_from_another_manager(main, tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    # Hai instance cùng một file đóng vai hai worker process
+    runner = main.JobManager(1, 10, 3600, path, 0.05)
+    other = main.JobManager(1, 10, 3600, path, 0.05)
+    release = threading.Event()
+
+    def job(on_section, on_chunk):
+        on_section("summary", "tóm tắt")
+        release.wait(5)
+        return {"ok": True}, None
+
+    job_id = runner.submit(job, language="python")
+    seen = other.wait(job_id, 0, timeout=5)
+    assert seen is not None and seen["language"] == "python"
+    while seen["sections"].get("summary") is None:
+        seen = other.wait(job_id, seen["version"], timeout=5)
+    assert seen["sections"]["summary"] == "tóm tắt"
+
+    release.set()
+    while seen["status"] not in ("done", "error"):
+        seen = other.wait(job_id, seen["version"], timeout=5)
+    assert seen["status"] == "done" and seen["result"] == {"ok": True}
+    assert other.get("missing") is None
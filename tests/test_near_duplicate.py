@@ -0,0 +1,52 @@
+"""Nhận diện bài gần trùng: chỉ dùng lại kết quả khi hai bài thật sự là một chương trình."""
+
+import uuid
+
+LARGEST = """\
+def largest(nums):
+    best = max(nums)
+    nums.sort()
+    return best
+
+values = [int(x) for x in input().split()]
+print(largest(values))
+"""
+
+RESULT = {
+    "analysis": {"meets_requirements": True, "syntax_errors": [], "logical_errors": [], "runtime_errors": []},
+    "suggestions": [],
+    "simulation": {},
+    "evaluation": "Dùng max(nums) cho best là đúng.",
+}
+
+def index_source(main, problem, source_code, language="Python"):
+    result, _, fingerprint = main.find_near_duplicate(problem, source_code, language)
+    assert result is None
+    main.near_dup_index.add(*fingerprint, source_code, RESULT)
+
+def test_renamed_variables_reuse_result(main):
+    problem = f"Tìm số lớn nhất {uuid.uuid4().hex}"
+    index_source(main, problem, LARGEST)
+    renamed = LARGEST.replace("best", "answer").replace("values", "arr")
+    result, similarity, _ = main.find_near_duplicate(problem, renamed, "Python")
+    assert result is not None and similarity >= main.NEAR_DUP_THRESHOLD
+    assert result["analysis"]["meets_requirements"] is True
+
+def test_builtin_call_change_is_not_a_duplicate(main):
+    # max -> min đổi hẳn chương trình: không được dùng lại kết luận "đúng" của bài cũ
+    problem = f"Tìm số lớn nhất {uuid.uuid4().hex}"
+    index_source(main, problem, LARGEST)
+    result, _, _ = main.find_near_duplicate(problem, LARGEST.replace("max(", "min("), "Python")
+    assert result is None
+
+def test_method_call_change_is_not_a_duplicate(main):
+    problem = f"Tìm số lớn nhất {uuid.uuid4().hex}"
+    index_source(main, problem, LARGEST)
+    result, _, _ = main.find_near_duplicate(problem, LARGEST.replace(".sort()", ".reverse()"), "Python")
+    assert result is None
+
+def test_c_library_names_stay_literal(main):
+    source = "#include <math.h>\nint main() {\n    int n = 4;\n    double r = sqrt(n);\n    return 0;\n}\n"
+    kinds = {value: kind for kind, value, _ in main.lex_source(source, "C")}
+    assert kinds["sqrt"] == "NAME"
+    assert kinds["n"] == "ID" and kinds["r"] == "ID"
@@ -0,0 +1,68 @@
+"""QuotaLedger: bộ đếm SQLite dùng chung và đồng bộ hai chiều với key.json."""
+
+import json
+
+import pytest
+
+@pytest.fixture
+def ledger_files(main, tmp_path):
+    key_file = tmp_path / "key.json"
+    key_file.write_text(json.dumps({"a": 0, "b": 0}))
+
+    def make(limit=5):
+        return main.QuotaLedger(str(tmp_path / "quota.sqlite3"), str(key_file), limit, 3600, 60)
+    return key_file, make
+
+def read_keys(key_file):
+    return json.loads(key_file.read_text())
+
+def test_consume_counts_until_limit(ledger_files):
+    key_file, make = ledger_files
+    ledger = make(limit=2)
+    assert ledger.consume("a") == (True, None)
+    assert ledger.consume("a") == (True, None)
+    ok, message = ledger.consume("a")
+    assert not ok and "2" in message
+    assert ledger.consume("missing")[0] is False
+    ledger.flush()
+    assert read_keys(key_file)["a"] == 2
+
+def test_refund_returns_a_use(ledger_files):
+    key_file, make = ledger_files
+    ledger = make(limit=1)
+    assert ledger.consume("b")[0]
+    ledger.refund("b")
+    assert ledger.consume("b")[0]
+
+def test_flush_keeps_admin_edit_made_just_before(ledger_files):
+    key_file, make = ledger_files
+    ledger = make()
+    ledger.consume("a")
+    # Quản trị viên thêm key ngay trước flush, trước lượt kiểm tra file định kỳ
+    keys = read_keys(key_file)
+    keys["c"] = 0
+    key_file.write_text(json.dumps(keys))
+    ledger.flush()
+    assert read_keys(key_file) == {"a": 1, "b": 0, "c": 0}
+    assert ledger.consume("c")[0]
+
+def test_admin_reset_applies_without_losing_unflushed_uses(ledger_files):
+    key_file, make = ledger_files
+    ledger = make()
+    for _ in range(3):
+        ledger.consume("a")
+    ledger.flush()
+    ledger.consume("a")  # lượt chưa flush
+    # Quản trị viên đặt lại key "a" về 0 và nâng "b" lên 4
+    key_file.write_text(json.dumps({"a": 0, "b": 4}))
+    ledger._sync_key_file(force=True)
+    ledger.flush()
+    assert read_keys(key_file) == {"a": 1, "b": 4}
+
+def test_key_removed_from_file_is_revoked(ledger_files):
+    key_file, make = ledger_files
+    ledger = make()
+    assert ledger.consume("b")[0]
+    key_file.write_text(json.dumps({"a": 0}))
+    ledger._sync_key_file(force=True)
+    assert not ledger.knows("b")
@@ -0,0 +1,45 @@
+"""ResponseCache: hết hạn theo TTL và loại bản ghi ít dùng nhất khi vượt dung lượng."""
+
+import pytest
+
+@pytest.fixture
+def make_cache(main, tmp_path):
+    state = main.SharedState(str(tmp_path / "state.sqlite3"))
+
+    def make(max_bytes=10_000, ttl=3600):
+        cache = main.ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes, ttl, state)
+        cache.EVICT_INTERVAL = 0  # quét dọn ở mỗi lần put
+        return cache
+    return make
+
+def test_get_returns_what_was_put(make_cache):
+    cache = make_cache()
+    assert cache.get("k") is None
+    cache.put("k", {"evaluation": "tốt"})
+    assert cache.get("k") == {"evaluation": "tốt"}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+def test_least_recently_used_is_evicted(make_cache):
+    value = {"text": "x" * 100}
+    cache = make_cache(max_bytes=350)
+    cache.ACCESS_RESOLUTION = 0  # mỗi lần hit đều cập nhật thời điểm truy cập
+    cache.put("a", value)
+    cache.put("b", value)
+    cache.put("c", value)
+    assert cache.get("a") == value  # "b" giờ là bản ít dùng nhất
+    cache.put("d", value)
+    assert cache.get("b", record_stats=False) is None
+    assert all(cache.get(key, record_stats=False) == value for key in "acd")
+    assert cache.stats()["evictions"] == 1
+
+def test_expired_entries_are_dropped(make_cache):
+    cache = make_cache(ttl=-1)
+    cache.put("k", {"evaluation": "cũ"})
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+def test_oversized_value_is_not_cached(make_cache):
+    cache = make_cache(max_bytes=50)
+    cache.put("k", {"text": "x" * 100})
+    assert cache.get("k") is None
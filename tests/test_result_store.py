@@ -0,0 +1,17 @@
+"""Permalink và lịch sử: không lộ mã nguồn, owner không suy ngược được từ key."""
+
+import hashlib
+
+def test_owner_id_is_keyed(main):
+    owner = main.owner_id("test-key")
+    assert owner == main.owner_id("test-key")
+    assert owner != main.owner_id("other-key")
+    assert owner != hashlib.sha256(b"owner:test-key").hexdigest()[:32]
+
+def test_permalink_json_omits_source(main):
+    result = {"analysis": {"meets_requirements": True}}
+    result_id = main.result_store.save(main.owner_id("test-key"), "Đề bài", "print('bí mật')", "python", result)
+    data = main.app.test_client().get(f"/result/{result_id}?format=json").get_json()
+    assert data["result"] == result
+    assert "source_code" not in data
+    assert main.result_store.get(result_id)["source_code"] == "print('bí mật')"